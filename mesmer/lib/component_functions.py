@@ -34,7 +34,7 @@ def load_components( args, plugins, targets ):
 			sys.stdout.write("Component loading progress: %i%%\r" % (100.*i/len(files)+1) )
 			sys.stdout.flush()
 
-		temp = mesComponent()
+		temp = mesComponent(i)
 
 		if( not temp.load(f,plugins,targets) ):
 			raise mesComponentError("\nERROR:\tCould not load component file \"%s\"." % (f))
@@ -48,4 +48,8 @@ def load_components( args, plugins, targets ):
 
 	sys.stdout.write("\n")
 
+	# component data is now read-only, so let the plugins place it where the optimizer's worker processes can share it
+	for p in plugins:
+		p.share()
+
 	return components
\ No newline at end of file
@@ -5,8 +5,9 @@ from utility_functions	import print_msg,get_input_blocks
 
 class mesAttribute:
 
-	def __init__(self, restraint):
+	def __init__(self, restraint, index=None):
 		self.restraint = restraint
+		self.index = index
 		self.data = {}
 		return
 
@@ -15,16 +16,18 @@ class mesComponent:
 	Contains the various attributes (stoichiometries, SAXS profiles, absorbance curves, etc.) of a given component
 	"""
 
-	def __init__(self):
+	def __init__(self, index=None):
 		"""
 		Initialize the component
 
 		1. Sets name to an empty string
 		2. Sets attributes to an empty list
 		3. Sets plugin_data to an empty dict
+		4. Sets index, the component's position in the component database (passed on to its attributes)
 		"""
 
 		self.name = ''
+		self.index = index
 		self.attributes = []
 		self.plugin_data = {}
 		return
@@ -73,7 +76,7 @@ class mesComponent:
 					for r in targets[0].restraints:
 						if(b['type'] == r.type):
 
-							attribute = mesAttribute(r)
+							attribute = mesAttribute(r, self.index)
 
 							try:
 								messages = p.load_attribute( attribute, b, self.plugin_data[b['type']] )
@@ -1,14 +1,315 @@
+import copy
+import ctypes
 import random
+import scipy
+
+from multiprocessing.sharedctypes	import RawArray
 
 from exceptions			import *
 from utility_functions	import print_msg,get_input_blocks
 
-class mesEnsemble:
+# the ctypes equivalents of the population array types, for shared memory allocation
+_CTYPES = {scipy.int32:ctypes.c_int32, scipy.float64:ctypes.c_double, scipy.bool_:ctypes.c_bool}
+
+class mesPopulation(object):
+	"""
+	Array-backed storage of the component makeup, ratios, fitness and optimization state of a number of ensembles
+	"""
+
+	def __init__(self, plugins, targets, size, n=0, layout=None, shared=False):
+		"""
+		Initialize the arrays for n ensembles to sane starting values
+
+		Args:
+			plugins (list) The currently available mesPlugin modules
+			targets (list):	The mesTargets the ensembles will be evaluated against
+			size (int):	The size (number of components) in the ensembles
+			n (int): The number of ensembles
+			layout (dict): The target, restraint type and component name tables of another population to share, replaces plugins and targets
+			shared (bool): Allocate the arrays in shared memory, so processes forked afterwards can read and write them
+		"""
+
+		self.size = size
+
+		if( layout is None ):
+			layout = {'targets':[t.name for t in targets], 'types':[], 'names':[''], 'codes':{'':0}}
+			for p in plugins:
+				for type in p.types:
+					if( not type in layout['types'] ):
+						layout['types'].append(type)
+
+		# the component name table is only ever appended to, so populations can share it
+		self.layout = layout
+		self.target_columns = dict([(name,i) for (i,name) in enumerate(layout['targets'])])
+		self.type_columns = dict([(type,i) for (i,type) in enumerate(layout['types'])])
+
+		(T,R) = (len(layout['targets']),len(layout['types']))
+
+		def allocate( shape, dtype ):
+			if( shared ):
+				return scipy.frombuffer( RawArray(_CTYPES[dtype], int(scipy.prod(shape))), dtype=dtype ).reshape(shape)
+			return scipy.zeros( shape, dtype=dtype )
+
+		self.components	= allocate( (n,size), scipy.int32 )
+		self.ratios		= allocate( (n,T,size), scipy.float64 )
+		self.fitness	= allocate( (n,T,R), scipy.float64 )
+		self.optimized	= allocate( (n,T), scipy.bool_ )
+
+		# which components have changed since the ratios were last optimized, i.e. all of them for new ensembles
+		self.dirty		= allocate( (n,size), scipy.bool_ )
+
+		self.ratios[:] = 1.0 / size
+		self.dirty[:] = True
+
+		# python objects can't be shared, see the Optimizer for how status is passed between processes
+		self.opt_status	= scipy.empty( (n,T), dtype=object )
+
+		# plugin data is only created for an ensemble when something asks for it
+		self.plugin_data = {}
+
+		return
+
+	def __len__(self):
+		return len(self.components)
+
+	def get_code(self, name):
+		"""Get the integer code used to store a component name, adding it to the name table if new"""
+
+		try:
+			return self.layout['codes'][name]
+		except KeyError:
+			self.layout['codes'][name] = len(self.layout['names'])
+			self.layout['names'].append(name)
+			return self.layout['codes'][name]
+
+	def get_plugin_data(self, index):
+		"""Get the plugin data storage of an ensemble, creating empty storage if it doesn't exist yet"""
+
+		if( not index in self.plugin_data ):
+			self.plugin_data[index] = dict([(t,dict([(type,{}) for type in self.layout['types']])) for t in self.layout['targets']])
+
+		return self.plugin_data[index]
+
+	def get_ensembles(self):
+		"""Get a list of mesEnsemble views of every ensemble in the population"""
+
+		return [mesEnsemble(population=self, index=i) for i in xrange(len(self))]
+
+def get_component_layout( plugins, targets, components ):
+	"""
+	Get a population layout whose component name table already holds every component, at its component index (see mesComponent)
+
+	Name codes then agree between all populations created with the layout, even in different processes, so their rows can be copied between each other
+
+	Returns a layout dict, see mesPopulation
+
+	Arguments:
+	plugins		- A list of the loaded plugin modules
+	targets		- A list of mesTargets
+	components	- A dict of the available mesComponents, keyed by name
+	"""
+
+	layout = mesPopulation( plugins, targets, 1 ).layout
+
+	layout['names'] = [None] * (max([c.index for c in components.itervalues()])+1)
+	for (name,c) in components.iteritems():
+		layout['names'][c.index] = name
+	layout['codes'] = dict([(name,c.index) for (name,c) in components.iteritems()])
+
+	return layout
+
+def copy_ensembles( ensembles, plugin_data=False ):
+	"""
+	Copy a list of ensembles into a new population, e.g. to create the offspring of a generation
+
+	By default only the arrays are copied; the plugin data is not, as it is recalculated by get_fitness() whenever it is needed (see update_plugin_data())
+
+	Returns a list of mesEnsemble views into the new population, in the same order
+
+	Arguments:
+	ensembles	- A list of mesEnsembles sharing a layout, which may be from any number of populations
+	plugin_data	- Also make a deep copy of any plugin data, e.g. for a snapshot of the ensembles
+	"""
+
+	first = ensembles[0]._population
+	population = mesPopulation( None, None, first.size, len(ensembles), first.layout )
+
+	# gather the rows from each source population at once
+	for (source,positions,rows) in get_population_rows( ensembles ):
+		for name in ('components','ratios','fitness','optimized','dirty','opt_status'):
+			getattr(population,name)[positions] = getattr(source,name)[rows]
+
+		if( plugin_data ):
+			for (i,row) in zip(positions,rows):
+				if( row in source.plugin_data ):
+					population.plugin_data[i] = copy.deepcopy(source.plugin_data[row])
+
+	return population.get_ensembles()
+
+def get_population_rows( ensembles ):
+	"""
+	Group a list of ensembles by the population holding their data, for copying many rows at once
+
+	Returns a list of (population, positions in the list, rows in the population) tuples
+
+	Arguments:
+	ensembles	- A list of mesEnsembles
+	"""
+
+	sources = {}
+	for (i,e) in enumerate(ensembles):
+		sources.setdefault( id(e._population), (e._population,[],[]) )
+		sources[id(e._population)][1].append(i)
+		sources[id(e._population)][2].append(e._index)
+
+	return sources.values()
+
+def get_ensemble_keys( ensembles ):
+	"""
+	Get a hashable key for the component set of each ensemble, which is the same for ensembles containing the same components in any order
+
+	Keys are sorted tuples of component name codes, so they can only be compared between ensembles whose populations share a layout (e.g. copies made by copy_ensembles())
+
+	Returns a list of keys, in the same order
+
+	Arguments:
+	ensembles	- A list of mesEnsembles
+	"""
+
+	keys = [None] * len(ensembles)
+	for (source,positions,rows) in get_population_rows( ensembles ):
+		for (i,key) in zip(positions,scipy.sort(source.components[rows],1).tolist()):
+			keys[i] = tuple(key)
+
+	return keys
+
+class _ComponentNames(object):
+	"""List-like access to the component names of an ensemble"""
+
+	def __init__(self, ensemble):
+		self._codes = ensemble._population.components[ensemble._index]
+		self._population = ensemble._population
+
+	def __len__(self):
+		return len(self._codes)
+
+	def __getitem__(self, i):
+		if( isinstance(i, slice) ):
+			return list(self)[i]
+		return self._population.layout['names'][self._codes[i]]
+
+	def __setitem__(self, i, name):
+		self._codes[i] = self._population.get_code(name)
+
+	def __iter__(self):
+		names = self._population.layout['names']
+		return iter([names[c] for c in self._codes])
+
+	def __contains__(self, name):
+		return (name in self._population.layout['codes']) and (self._population.layout['codes'][name] in self._codes)
+
+	def __eq__(self, other):
+		return list(self) == list(other)
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __repr__(self):
+		return repr(list(self))
+
+	def index(self, name):
+		return list(self).index(name)
+
+class _TargetValues(object):
+	"""Dict-like access to an ensemble's per-target values of one of the population arrays"""
+
+	def __init__(self, ensemble, array):
+		self._population = ensemble._population
+		self._index = ensemble._index
+		self._array = array
+
+	def __getitem__(self, target_name):
+		j = self._population.target_columns[target_name]
+		if( self._array == 'ratios' ):
+			return list(self._population.ratios[self._index,j])
+		elif( self._array == 'fitness' ):
+			return _TypeValues(self._population, self._index, j)
+		elif( self._array == 'optimized' ):
+			return bool(self._population.optimized[self._index,j])
+		return self._population.opt_status[self._index,j]
+
+	def __setitem__(self, target_name, value):
+		j = self._population.target_columns[target_name]
+		if( self._array == 'fitness' ):
+			for (type,v) in value.items():
+				self._population.fitness[self._index,j,self._population.type_columns[type]] = v
+		else:
+			getattr(self._population,self._array)[self._index,j] = value
+
+	def __contains__(self, target_name):
+		return target_name in self._population.target_columns
+
+	def __iter__(self):
+		return iter(self._population.layout['targets'])
+
+	def __len__(self):
+		return len(self._population.layout['targets'])
+
+	def keys(self):
+		return list(self._population.layout['targets'])
+
+	def items(self):
+		return [(name,self[name]) for name in self]
+
+	def iteritems(self):
+		return iter(self.items())
+
+class _TypeValues(object):
+	"""Dict-like access to an ensemble's per-restraint type fitness values for a target"""
+
+	def __init__(self, population, index, column):
+		self._row = population.fitness[index,column]
+		self._columns = population.type_columns
+		self._types = population.layout['types']
+
+	def __getitem__(self, type):
+		return float(self._row[self._columns[type]])
+
+	def __setitem__(self, type, value):
+		self._row[self._columns[type]] = value
+
+	def __contains__(self, type):
+		return type in self._columns
+
+	def __iter__(self):
+		return iter(self._types)
+
+	def __len__(self):
+		return len(self._types)
+
+	def keys(self):
+		return list(self._types)
+
+	def values(self):
+		return [float(v) for v in self._row]
+
+	def itervalues(self):
+		return iter(self.values())
+
+	def items(self):
+		return zip(self._types,self.values())
+
+	def iteritems(self):
+		return iter(self.items())
+
+class mesEnsemble(object):
 	"""
 	A collection of components, their relative ratios, and once calculated, their fitness when compared to a target
+
+	The data are stored in a row of a mesPopulation, which ensembles created on their own have to themselves
 	"""
 
-	def __init__(self, plugins, targets, size):
+	def __init__(self, plugins=None, targets=None, size=None, population=None, index=0):
 		"""
 		Initialize the object's properties to sane starting values
 
@@ -16,60 +317,126 @@ class mesEnsemble:
 			plugins (list) The currently available mesPlugin modules
 			targets (list):	The mesTargets this ensemble will be evaluated against
 			size (int):	The size (number of components) in the ensembles
+			population (mesPopulation): The population holding the ensemble's data, replaces plugins, targets and size
+			index (int): The ensemble's row in the population
 		"""
 
-		self.size = size
-		self.component_names = [''] * self.size
+		if( population is None ):
+			population = mesPopulation( plugins, targets, size, 1 )
 
-		self.optimized = {}
-		self.opt_status = {}
-		self.ratios = {}
-		self.fitness = {}
-		self.plugin_data = {}
+		self._population = population
+		self._index = index
+		self.size = population.size
 
-		for t in targets:
-			self.optimized[t.name] = False
-			self.opt_status[t.name] = None
-			self.ratios[t.name] = [1.0/self.size] * self.size
-			self.fitness[t.name] = {}
+		self.optimized	= _TargetValues(self, 'optimized')
+		self.opt_status	= _TargetValues(self, 'opt_status')
+		self.ratios		= _TargetValues(self, 'ratios')
+		self.fitness	= _TargetValues(self, 'fitness')
 
-			self.plugin_data[t.name] = {}
-			for p in plugins:
-				for type in p.types:
-					self.plugin_data[t.name][type] = {}
-					self.fitness[t.name][type] = 0.0
+		# the changed component flags, by component position
+		self.dirty		= population.dirty[index]
+
+		return
+
+	def _get_component_names(self):
+		return _ComponentNames(self)
+
+	def _set_component_names(self, names):
+		self._population.components[self._index] = [self._population.get_code(name) for name in names]
+
+	component_names = property(_get_component_names, _set_component_names)
+
+	@property
+	def plugin_data(self):
+		return self._population.get_plugin_data(self._index)
+
+	def __getstate__(self):
+		"""Pickle a standalone copy of the ensemble (e.g. for the optimization workers), rather than the whole population"""
+
+		population = self._population
+		return {
+			'layout':		{'targets':population.layout['targets'], 'types':population.layout['types']},
+			'size':			self.size,
+			'names':		list(self.component_names),
+			'ratios':		population.ratios[self._index],
+			'fitness':		population.fitness[self._index],
+			'optimized':	population.optimized[self._index],
+			'dirty':		population.dirty[self._index],
+			'opt_status':	population.opt_status[self._index],
+			'plugin_data':	population.plugin_data.get(self._index)
+			}
+
+	def __setstate__(self, state):
+		layout = state['layout']
+		layout['names'],layout['codes'] = [''],{'':0}
+
+		population = mesPopulation( None, None, state['size'], 1, layout )
+		for name in ('ratios','fitness','optimized','dirty','opt_status'):
+			getattr(population,name)[0] = state[name]
+		if( state['plugin_data'] is not None ):
+			population.plugin_data[0] = state['plugin_data']
+
+		self.__init__( population=population )
+		self.component_names = state['names']
+
+	def assign(self, other):
+		"""
+		Copy another ensemble's components, ratios, fitness, optimization state and plugin data into this one
+
+		Args:
+			other (mesEnsemble): The ensemble to copy, e.g. one returned from an optimization worker
+		"""
+
+		self.component_names = list(other.component_names)
+		for name in ('ratios','fitness','optimized','dirty','opt_status'):
+			getattr(self._population,name)[self._index] = getattr(other._population,name)[other._index]
+
+		if( other._index in other._population.plugin_data ):
+			self._population.plugin_data[self._index] = other._population.plugin_data[other._index]
+		else:
+			self._population.plugin_data.pop(self._index, None)
 
 		return
 
+	def get_key(self):
+		"""Get a hashable key for the ensemble's component set, see get_ensemble_keys()"""
+
+		return tuple(sorted(self._population.components[self._index].tolist()))
+
 	def fill(self, component_names):
 
-		self.component_names = []
-		while(len(self.component_names) < self.size):
+		names = []
+		while(len(names) < self.size):
 			c = random.choice(component_names)
 
 			# enforce non-duplicate components
-			if( c not in self.component_names ):
-				self.component_names.append( c )
+			if( c not in names ):
+				names.append( c )
+
+		self.component_names = names
+		self.dirty[:] = True
 
 		return
 
 	def fill_uniform(self, index, component_names):
 
 		n = len(component_names)
-		self.component_names = [None]*self.size
+		names = [None]*self.size
 		for i in range(self.size):
-			if( component_names[index] not in self.component_names ):
-				self.component_names[i] = component_names[index]
+			if( component_names[index] not in names ):
+				names[i] = component_names[index]
 			elif( index+i >= n ):
-				self.component_names[i] = component_names[i]
+				names[i] = component_names[i]
 			else:
-				self.component_names[i] = component_names[index+i]
+				names[i] = component_names[index+i]
+
+		self.component_names = names
+		self.dirty[:] = True
 
 		return
 
 	def set_optimized( self, value=False ):
-		for t in self.optimized:
-			self.optimized[t] = value
+		self._population.optimized[self._index] = value
 		return
 
 	def mutate( self, component_names, ensembles, Gmutate, Gsource ):
@@ -94,14 +461,16 @@ class mesEnsemble:
 					name = random.choice( component_names )
 					if (name not in self.component_names):
 						self.component_names[ i ] = name
+						self.dirty[ i ] = True
+						self.set_optimized(False)
 
 				else: # mutate to a randomly-selected component from one present in another ensemble
 					e = random.choice( ensembles )
 					name = random.choice( e.component_names )
 					if (name not in self.component_names):
 						self.component_names[ i ] = name
-
-				self.set_optimized(False)
+						self.dirty[ i ] = True
+						self.set_optimized(False)
 
 		return
 
@@ -127,6 +496,7 @@ class mesEnsemble:
 					(self.component_names[i],partner.component_names[i]) = (partner.component_names[i],self.component_names[i])
 
 					# unset partner and self optimization flags
+					self.dirty[i] = partner.dirty[i] = True
 					self.set_optimized(False)
 					partner.set_optimized(False)
 
@@ -142,16 +512,94 @@ class mesEnsemble:
 		Returns: None
 		"""
 
-		total = sum(self.ratios[target_name])
+		ratios = self._population.ratios[self._index,self._population.target_columns[target_name]]
+
+		total = ratios.sum()
 		if( total == 0 ):
-			self.ratios[target_name] = [1.0/self.size] * self.size
+			ratios[:] = 1.0/self.size
 		else:
-			for i in range(self.size):
-				self.ratios[target_name][i] = self.ratios[target_name][i] / total
+			ratios /= total
+
+		return
+
+	def warm_start(self, target_name):
+		"""
+		Reset the ratios of the changed components for a target to an even share, keeping the relative ratios of the unchanged components
+
+		Used to restart ratio optimization from the ratios optimized before the ensemble was mutated or crossed, returns nothing.
+
+		Args:
+			target_name (string): The name of the target whose ratios to reset
+
+		Returns: None
+		"""
+
+		ratios = self._population.ratios[self._index,self._population.target_columns[target_name]]
+
+		changed = self.dirty.sum()
+		total = ratios[~self.dirty].sum()
+		if( changed == 0 or changed == self.size or total == 0 ):
+			return
+
+		ratios[~self.dirty] *= (1.0 - float(changed) / self.size) / total
+		ratios[self.dirty] = 1.0 / self.size
 
 		return
 
-	def get_fitness(self, components, plugins, target, ratios):
+	def get_attributes(self, components, type):
+		"""
+		Collect the attributes of the ensemble's components for a restraint type, in component order
+
+		Args:
+			components (list): List of mesComponents, i.e. the component database
+			type (string): The restraint type
+
+		Returns:
+			list: The mesAttributes
+		"""
+
+		attributes = []
+		for name in self.component_names:
+			for a in components[name].attributes:
+				if( a.restraint.type == type ):
+					attributes.append( a )
+
+		return attributes
+
+	def get_fitness_gradient(self, components, plugins, target, attributes=None):
+		"""
+		Calculate the gradient of the ensemble's fitness for a given target at its current component ratios
+		Must be called immediately after get_fitness() for the same target, as plugins reuse the ensemble data it calculated
+
+		Args:
+			components (list): List of mesComponents, i.e. the component database
+			plugins (list):	List of the plugin modules used to calculate the target-solution discrepancy
+			target (mesTarget):	The restraint-containing target the fitness was evaluated against
+			attributes (dict): (Optional) The ensemble's attributes for each restraint type, as returned by get_attributes(), to avoid collecting them again
+
+		Returns:
+			list: The partial derivatives of the weighted sum of all restraint discrepancies with respect to each (normalized) ratio, or None if any plugin can't provide them
+		"""
+
+		gradient = [0.0] * self.size
+		for r in target.restraints:
+			if( attributes is None ):
+				collected = self.get_attributes( components, r.type )
+			else:
+				collected = attributes[r.type]
+
+			for p in plugins:
+				if( r.type in p.types ):
+					partials = p.calc_fitness_gradient( r, target.plugin_data[r.type], self.plugin_data[target.name][r.type], collected, self.ratios[target.name] )
+					if( partials is None ):
+						return None
+
+					for i in range(self.size):
+						gradient[i] += r.scale * partials[i]
+
+		return gradient
+
+	def get_fitness(self, components, plugins, target, ratios, attributes=None):
 		"""
 		Calculate the fitness of the ensemble for a given target and component ratios
 		Saves the calculated fitness back to the object as well
@@ -161,14 +609,16 @@ class mesEnsemble:
 			plugins (list):	List of the plugin modules used to calculate the target-solution discrepancy
 			target (mesTarget):	The restraint-containing target to evaluate fitness against
 			ratios (list): The weighting vector used to determine each component's contribute to the solution
+			attributes (dict): (Optional) The ensemble's attributes for each restraint type, as returned by get_attributes(), to avoid collecting them again
 
 		Returns:
 			float: The weighted sum of all restraint/attribute discrepancies
 					"""
 
-		# always keep our component ratios normalized
+		# always keep our component ratios normalized, including the caller's (e.g. a minimization function's) vector
 		self.ratios[target.name] = ratios
 		self.normalize(target.name)
+		ratios[:] = self.ratios[target.name]
 
 		# set our optimization status to dirty (calling function will have to set this back)
 		self.optimized[target.name] = False
@@ -176,17 +626,14 @@ class mesEnsemble:
 		for r in target.restraints:
 
 			# build a list of our attributes to average together for a fit to the target data
-			attributes = []
-
-			# find the plugin to handle this type of data
-			for name in self.component_names:
-				for a in components[name].attributes:
-					if( a.restraint.type == r.type ):
-						attributes.append( a )
+			if( attributes is None ):
+				collected = self.get_attributes( components, r.type )
+			else:
+				collected = attributes[r.type]
 
 			# hand off the collected attributes to the correct plugin to score
 			for p in plugins:
 				if( r.type in p.types ):
-					self.fitness[target.name][r.type] = r.scale * p.calc_fitness( r, target.plugin_data[r.type], self.plugin_data[target.name][r.type], attributes, self.ratios[target.name] )
+					self.fitness[target.name][r.type] = r.scale * p.calc_fitness( r, target.plugin_data[r.type], self.plugin_data[target.name][r.type], collected, self.ratios[target.name] )
 					
 		return self.fitness[target.name]
@@ -1,12 +1,17 @@
 import sys
 
+from time					import time
 from datetime				import datetime
+from multiprocessing		import Queue,Event
+from Queue					import Empty
 
 from exceptions				import *
-from ga_objects				import Optimizer
+from ga_objects				import Optimizer,Island,Writer,get_telemetry_stats
 from ga_functions_misc		import *
 from ga_functions_stats		import *
 from ga_functions_output	import *
+from ensemble_objects		import get_component_layout
+from profile_objects		import mesProfile
 
 def run_ga( args, plugins, targets, components ):
 	"""
@@ -21,96 +26,259 @@ def run_ga( args, plugins, targets, components ):
 	components	- A list of possible components to be used in recreating/fitting the target data
 	"""
 
-	optimizer = Optimizer(args, plugins, targets, components)
+	# time each phase of the generations, and with -profile every plugin fitness calculation (before the worker processes inherit the plugins)
+	profile = mesProfile()
+	if( args.profile ):
+		profile.wrap_plugins( plugins )
+	started = time()
+
+	# the islands optimize their own ensembles, leaving only the bootstrap error analysis to the optimizer
+	if( args.islands > 0 ):
+		optimizer = Optimizer(args, plugins, targets, components, threads=1, profile=profile)
+	else:
+		optimizer = Optimizer(args, plugins, targets, components, profile=profile)
 
 	print_msg("\nAlgorithm starting on %s." % datetime.utcnow() )
 
-	print "\tCreating parent ensembles..."
-	sys.stdout.flush()
+	if( args.restart ):
+		# the parents are restored already optimized, along with the rest of the algorithm state
+		(generation_counter,parents,convergence) = read_checkpoint( args, plugins, targets, components, optimizer )
 
-	parents = make_ensembles( args, plugins, targets, components )
+		print_msg( "\tRestarted from the checkpoint before generation %i." % (generation_counter) )
 
-	print "\tOptimizing parent component ratios..."
-	sys.stdout.flush()
+	else:
+		print "\tCreating parent ensembles..."
+		sys.stdout.flush()
 
-	parents = optimizer.optimize( parents )
-	
-	generation_counter = 0
-	while( True ):
+		parents = make_ensembles( args, plugins, targets, components )
+
+		if( args.islands == 0 ):
+			print "\tOptimizing parent component ratios..."
+			sys.stdout.flush()
+
+			with profile.phase('optimize'):
+				parents = optimizer.optimize( parents )
+
+		generation_counter = 0
+
+		# the stall and restart counts, and the run time, see check_convergence()
+		convergence = {'started':started}
+
+	if( args.islands > 0 ):
+		generations = evolve_islands( args, plugins, targets, components, parents, generation_counter, profile )
+	else:
+		generations = evolve_generations( args, targets, components, optimizer, parents, profile )
+
+	# the per-generation output files are written in the background
+	writer = Writer(profile=profile)
+	writer.start()
+
+	last_checkpoint = time()
+
+	# the first generation's times include creating and optimizing the parents
+	last_generation = started
+
+	try:
+		while( True ):
 		
-		print_msg( "\nGeneration %i" % (generation_counter) )
-		sys.stdout.flush()
+			print_msg( "\nGeneration %i" % (generation_counter) )
+			sys.stdout.flush()
 
-		# create clones of the parents, and subject to genetic modification
-		offspring = copy.deepcopy(parents)
+			# retrieve the 1/2 best-scoring ensembles and some collected statistics
+			(best_scored,ensemble_stats) = generations.next()
 
-		print "\tEvolving offspring..."
-		sys.stdout.flush()
+			with profile.phase('statistics'):
+				# batch-scored ensembles carry no plugin data, so recalculate it for the best ensemble used in the output below
+				update_plugin_data( components, plugins, targets, best_scored[0] )
 
-		evolve_ensembles( args, components, offspring )
+				# get the relative fitness contribution for each restraint type
+				restraint_stats = get_restraint_stats( args, targets, best_scored )
 
-		print "\tOptimizing offspring component ratios..."
-		sys.stdout.flush()
+				# decide whether to stop after this generation, so the reason can be logged with it
+				(stop,restart) = check_convergence( args, convergence, ensemble_stats, generation_counter )
 
-		# optimize component ratios for newly-mutated/crossed offspring
-		offspring = optimizer.optimize( offspring )
+				# print the status and selected statistics
+				print_generation_state( args, generation_counter, ensemble_stats, restraint_stats )
 
-		# retrieve the 1/2 best-scoring ensembles and some collected statistics
-		(best_scored,ensemble_stats) = get_best_ensembles( args, targets, parents, offspring )
+				# write the output files from a snapshot of the ensembles in the background, while the next generation is evolved and optimized
+				snapshot = copy_ensembles( best_scored )
+				writer.put( write_generation_output, args, generation_counter, targets, snapshot, ensemble_stats, restraint_stats )
+
+			if(args.Pextra):
+				# the plugins' own output, e.g. plots, has to be made by this thread
+				with profile.phase('output'):
+					print_plugin_state( args, generation_counter, plugins, targets, best_scored )
+
+			if(args.Pbest):
+				# print information about the best-scoring ensemble
+
+				if(args.boots > 0):
+					print "\tCalculating best fit statistics..."
+					sys.stdout.flush()
+
+				# get the error intervals for the best ensemble component ratios
+				with profile.phase('bootstrap'):
+					best_ratio_errors = get_ratio_errors( args, plugins, targets, [best_scored[0]], optimizer )
+				print_ensemble_state( args, best_ratio_errors[0] )
+
+			# replace the stalled ensembles, which the next generation evolves from
+			if( restart ):
+				print_msg(  "\n%s, restarting with new ensembles (%i of %i)." % (ensemble_stats['restart'],convergence['restarts'],args.Grestarts) )
+				with profile.phase('restart'):
+					diversify_ensembles( args, plugins, targets, components, optimizer, best_scored )
+
+			# save the state to continue from with the next generation, after its output is written
+			if( ((args.checkpoint > 0) and ((generation_counter+1) % args.checkpoint == 0)) or ((args.Ctime > 0) and (time()-last_checkpoint > 60*args.Ctime)) ):
+				with profile.phase('checkpoint'):
+					writer.put( write_checkpoint, args, get_checkpoint(generation_counter+1, best_scored, optimizer, convergence) )
+				last_checkpoint = time()
 
-		# get the relative fitness contribution for each restraint type
-		restraint_stats = get_restraint_stats( args, targets, best_scored )
+			# the generation's times, except for its output which is written in the background while the next generation runs
+			times = profile.collect()
+			if( args.profile ):
+				writer.put( write_profile, args, generation_counter, time()-last_generation, times )
+			last_generation = time()
 
-		# print the status and selected statistics
-		print_generation_state( args, generation_counter, ensemble_stats, restraint_stats )
+			# loop exit criteron
+			if( stop is not None ):
+				print_msg(  "\n%s, exiting." % (stop) )
+				break
 
-		if(args.Pstats):
-			# print component correlations from the current ensembles
-			write_component_stats( args, generation_counter, best_scored )
+			# set up for the next generation
+			generation_counter += 1
 
-			# print collected information on the current ensembles
-			write_ensemble_stats( args, generation_counter, targets, best_scored )
+	finally:
+		# stop any islands
+		generations.close()
 
-		if(args.Pstate):
-			# save the current ensemble population ratios
-			write_ensemble_state( args, generation_counter, targets, best_scored )
+		# finish writing any queued output, including when interrupted
+		writer.close()
 
-		if(args.Popt):
-			# write the ratio optimization state for the current ensembles
-			write_optimization_state( args, generation_counter, targets, best_scored )
+	if( args.profile ):
+		profile.collect()
+		print_profile_summary( args, plugins, profile, time()-started )
 
-		if(args.Pbest):
-			# print information about the best-scoring ensemble
+	sys.stdout.flush()
+
+	return
 
-			if(args.boots > 0):
-				print "\tCalculating best fit statistics..."
-				sys.stdout.flush()
+def evolve_generations( args, targets, components, optimizer, parents, profile ):
+	"""
+	Evolve a single population of ensembles, optimizing the offspring of each generation with the optimizer's worker processes
 
-			# get the error intervals for the best ensemble component ratios
-			best_ratio_errors = get_ratio_errors( args, plugins, targets, [best_scored[0]], optimizer )
-			print_ensemble_state( args, best_ratio_errors[0] )
+	Yields a tuple of the best-scoring ensembles of each generation and their statistics, see get_best_ensembles()
 
-		if(args.Pextra):
-			# call the various output methods of the plugins
-			print_plugin_state( args, generation_counter, plugins, targets, best_scored )
+	Arguments:
+	args		- The MESMER parameters argument object
+	targets		- A list of targets containing the data to be fit
+	components	- A list of possible components to be used in recreating/fitting the target data
+	optimizer	- The ratio Optimizer
+	parents		- The optimized ensembles of the first generation
+	profile		- The mesProfile timing each phase
+	"""
 
-		# loop exit criteron
-		if( ensemble_stats['scores'][args.size] < args.Fmin ):
-			print_msg(  "\nMaximum ensemble score is less than Fmin, exiting." )
-			break
+	while( True ):
 
-		if( (ensemble_stats['total'][2]/ensemble_stats['total'][1]) < args.Smin ):
-			print_msg(  "\nEnsemble score RSD is less than Smin, exiting." )
-			break
+		print "\tEvolving offspring..."
+		sys.stdout.flush()
 
-		if (args.Gmax > -1) and (generation_counter >= args.Gmax):
-			print_msg(  "\nGeneration counter has reached Gmax, exiting." )
-			break
+		# create clones of the parents, and subject to genetic modification
+		with profile.phase('evolve'):
+			offspring = copy_ensembles(parents)
+			evolve_ensembles( args, components, offspring )
+
+		print "\tOptimizing offspring component ratios..."
+		sys.stdout.flush()
+
+		# optimize component ratios for newly-mutated/crossed offspring, giving up early on those that can't survive
+		with profile.phase('optimize'):
+			offspring = optimizer.optimize( offspring, cutoff=get_survival_cutoff(targets, parents) )
+
+		# retrieve the 1/2 best-scoring ensembles and some collected statistics
+		with profile.phase('selection'):
+			(best_scored,ensemble_stats) = get_best_ensembles( args, targets, parents, offspring )
+		ensemble_stats['cache'] = optimizer.get_cache_stats()
+		ensemble_stats['optimization'] = optimizer.get_optimization_stats()
+		if( args.Rabandon > 0 ):
+			ensemble_stats['abandoned'] = optimizer.get_abandon_stats()
+
+		yield (best_scored,ensemble_stats)
 
 		# set up for the next generation
 		parents = best_scored
-		generation_counter += 1
 
-	sys.stdout.flush()
+def evolve_islands( args, plugins, targets, components, parents, generation_counter, profile ):
+	"""
+	Evolve the ensembles as -islands separate sub-populations, each in its own process and without waiting for the others, see Island
 
-	return
+	Yields a tuple of the combined ensembles of each round of reports from the islands and their statistics, see merge_island_ensembles()
+
+	Arguments:
+	args				- The MESMER parameters argument object
+	plugins				- A list of plugin modules to interpret and evaluate the various types of target and component attributes
+	targets				- A list of targets containing the data to be fit
+	components			- A list of possible components to be used in recreating/fitting the target data
+	parents				- The ensembles of the first generation, which the islands optimize themselves
+	generation_counter	- The number of the first report, i.e. the output generation
+	profile				- The mesProfile timing each phase, the islands' own plugin times aren't included
+	"""
+
+	# the islands' populations have to agree on the component name codes to be combined
+	population = mesPopulation( None, None, args.size, len(parents), get_component_layout(plugins, targets, components) )
+	ensembles = population.get_ensembles()
+	for (e,parent) in zip(ensembles,parents):
+		e.assign(parent)
+
+	# each island migrates to the next, in a ring
+	bounds = [len(ensembles) * i // args.islands for i in xrange(args.islands+1)]
+	inboxes = [Queue() for i in xrange(args.islands)]
+	(reports,stop) = (Queue(),Event())
+
+	islands = []
+	for i in xrange(args.islands):
+		outbox = inboxes[(i+1) % args.islands] if args.islands > 1 else None
+		islands.append( Island(args, plugins, targets, components, i, ensembles[bounds[i]:bounds[i+1]], generation_counter * args.Gmigrate * args.Greport, inboxes[i], outbox, reports, stop) )
+		islands[-1].start()
+
+	def retrieve():
+		# wait with a timeout, to notice islands that have failed
+		while( True ):
+			try:
+				return reports.get( True, 1.0 )
+			except Empty:
+				for island in islands:
+					if( island.exitcode ):
+						raise mesError("ERROR:\tIsland %i stopped unexpectedly (exit code %i)." % (island.index,island.exitcode))
+
+	try:
+		rounds = {}
+		while( True ):
+
+			print "\tWaiting for island reports..."
+			sys.stdout.flush()
+
+			# islands may be several reports ahead of the others
+			with profile.phase('islands'):
+				while( len(rounds.get(generation_counter,{})) < args.islands ):
+					(index,round,generation,population,ratio,telemetry) = retrieve()
+					rounds.setdefault(round,{})[index] = (generation,population,ratio,telemetry)
+
+			(generations,populations,ratios,telemetry) = zip(*rounds.pop(generation_counter).values())
+
+			with profile.phase('selection'):
+				(best_scored,ensemble_stats) = merge_island_ensembles( args, targets, populations, ratios )
+			ensemble_stats['generation'] = max(generations)
+			ensemble_stats['optimization'] = get_telemetry_stats( targets, sum(telemetry,[]) )
+
+			print_msg( "\tIslands have completed generation %i." % (max(generations)) )
+
+			yield (best_scored,ensemble_stats)
+
+			generation_counter += 1
+
+	finally:
+		# the generations the islands are still working on won't be reported
+		stop.set()
+		for island in islands:
+			island.terminate()
+			island.join()
@@ -3,9 +3,14 @@ import os.path
 import sys
 import random
 import math
+import scipy
+import cPickle as pickle
 
+from time					import time
+from collections			import Counter
 from exceptions				import *
-from ensemble_objects		import mesEnsemble
+from log_objects			import mesLog
+from ensemble_objects		import mesEnsemble,mesPopulation,copy_ensembles,get_ensemble_keys,get_population_rows
 from utility_functions		import print_msg,mean_stdv
 
 def make_ensembles( args, plugins, targets, components ):
@@ -22,16 +27,14 @@ def make_ensembles( args, plugins, targets, components ):
 
 	component_names = components.keys()
 
-	ensembles = []
-	for i in range( args.ensembles ):
-
-		ensembles.append( mesEnsemble( plugins, targets, args.size ) )
+	ensembles = mesPopulation( plugins, targets, args.size, args.ensembles ).get_ensembles()
+	for (i,e) in enumerate(ensembles):
 
 		# randomly fill the new ensemble with components
 		if(not args.uniform):
-			ensembles[-1].fill( component_names )
+			e.fill( component_names )
 		else:
-			ensembles[-1].fill_uniform( i, component_names )
+			e.fill_uniform( i, component_names )
 
 	# if we're resuming from a previous run, fill the ensembles with the specified makeup
 	if( args.resume ):
@@ -39,6 +42,40 @@ def make_ensembles( args, plugins, targets, components ):
 
 	return ensembles
 
+def diversify_ensembles( args, plugins, targets, components, optimizer, ensembles ):
+	"""
+	Restart the evolution of ensembles that have stopped improving, by replacing all but the best-scoring copy of each distinct component set
+	in the best half with new, randomly filled and optimized ensembles
+
+	Returns the number of ensembles replaced
+
+	Arguments:
+	args		- The MESMER argument parameters
+	plugins		- A list of the loaded plugin modules
+	targets		- A list of mesTargets
+	components	- The component to be randomly incorporated into the new ensembles
+	optimizer	- The ratio Optimizer for the new ensembles
+	ensembles	- A list of mesEnsembles ordered by score, modified in place
+	"""
+
+	(kept,replaced) = (set(),[])
+	for (e,key) in zip(ensembles,get_ensemble_keys(ensembles)):
+		if( key in kept or len(kept) >= len(ensembles) // 2 ):
+			replaced.append(e)
+		else:
+			kept.add(key)
+
+	fresh = mesPopulation( plugins, targets, args.size, len(replaced) ).get_ensembles()
+	for e in fresh:
+		e.fill( components.keys() )
+
+	optimizer.optimize( fresh )
+
+	for (e,new) in zip(replaced,fresh):
+		e.assign(new)
+
+	return len(replaced)
+
 def evolve_ensembles( args, components, ensembles ):
 	"""
 	Applies genetic transformations to the provided ensembles.
@@ -86,21 +123,216 @@ def calculate_fitnesses( targets, ensembles ):
 
 	return scores
 
+def get_target_scores( targets, ensembles ):
+	"""
+	Get the total fitness score of every ensemble for each target, as summed by calculate_fitnesses()
+
+	Returns an N x targets array, in the order of the ensembles and targets
+
+	Arguments:
+	targets		- A list of mesTarget targets used to score the ensembles
+	ensembles	- A list of N mesEnsemble ensemble objects to be scored
+	"""
+
+	scores = scipy.zeros( (len(ensembles),len(targets)) )
+	for (source,positions,rows) in get_population_rows( ensembles ):
+		columns = [source.target_columns[t.name] for t in targets]
+		scores[positions] = source.fitness[rows][:,columns].sum(2)
+
+	return scores
+
+def get_fitness_array( targets, types, ensembles ):
+	"""
+	Gather the fitness of every ensemble for each target and restraint type
+
+	Returns an N x targets x types array, in the order of the ensembles, targets and types
+
+	Arguments:
+	targets		- A list of mesTargets
+	types		- A list of restraint types
+	ensembles	- A list of N mesEnsembles
+	"""
+
+	fitness = scipy.zeros( (len(ensembles),len(targets),len(types)) )
+	for (source,positions,rows) in get_population_rows( ensembles ):
+		columns = [source.target_columns[t.name] for t in targets]
+		type_columns = [source.type_columns[type] for type in types]
+		fitness[positions] = source.fitness[scipy.ix_(rows,columns,type_columns)]
+
+	return fitness
+
+def get_component_indices( components, ensembles ):
+	"""
+	Get the component database index of every component in the provided ensembles
+
+	Returns an N x size integer array, in the order of each ensemble's component_names
+
+	Arguments:
+	components	- A dict of the mesComponents in the ensembles, keyed by name
+	ensembles	- A list of N mesEnsembles
+	"""
+
+	return scipy.array( [[components[name].index for name in e.component_names] for e in ensembles], dtype=int )
+
+def get_batch_fitness( plugins, target, component_indices, ratios ):
+	"""
+	Score many ensembles against a target at once, using the plugins' calc_fitness_batch() functions
+
+	Returns a restraint-type-keyed dict of scaled fitness arrays, or None if any plugin can't batch-score its restraint
+
+	Arguments:
+	plugins				- A list of the plugin modules used to calculate the target-solution discrepancy
+	target				- The mesTarget to score the ensembles against
+	component_indices	- N x size integer array of component indices, see get_component_indices()
+	ratios				- N x size array of normalized component ratios
+	"""
+
+	fitness = {}
+	for r in target.restraints:
+		for p in plugins:
+			if( r.type in p.types ):
+				scores = p.calc_fitness_batch( r, target.plugin_data[r.type], component_indices, ratios )
+				if( scores is None ):
+					return None
+				fitness[r.type] = r.scale * scipy.array(scores, dtype=float)
+
+	return fitness
+
+def get_batch_fitness_gradient( plugins, target, component_indices, ratios ):
+	"""
+	Get the fitness gradients of many ensembles against a target at once, using the plugins' calc_fitness_gradient_batch() functions
+
+	Returns an N x size array of the partial derivatives of the total scaled fitness with respect to each ratio, or None if any plugin can't provide its restraint's
+
+	Arguments:
+	plugins				- A list of the plugin modules used to calculate the target-solution discrepancy
+	target				- The mesTarget to score the ensembles against
+	component_indices	- N x size integer array of component indices, see get_component_indices()
+	ratios				- N x size array of normalized component ratios
+	"""
+
+	gradient = scipy.zeros( ratios.shape )
+	for r in target.restraints:
+		for p in plugins:
+			if( r.type in p.types ):
+				partials = p.calc_fitness_gradient_batch( r, target.plugin_data[r.type], component_indices, ratios )
+				if( partials is None ):
+					return None
+				gradient += r.scale * scipy.array(partials, dtype=float)
+
+	return gradient
+
+def get_linear_systems( plugins, target, component_indices ):
+	"""
+	Collect the linear least-squares descriptions of a target's restraints from the plugins' get_linear_system() functions
+
+	Returns a list of (restraint weight, system) tuples, or None if any restraint's fitness isn't linear in the component ratios
+
+	Arguments:
+	plugins				- A list of the plugin modules used to calculate the target-solution discrepancy
+	target				- The mesTarget the ensemble is fit against
+	component_indices	- List of the ensemble's component indices
+	"""
+
+	systems = []
+	for r in target.restraints:
+		for p in plugins:
+			if( r.type in p.types ):
+				system = p.get_linear_system( r, target.plugin_data[r.type], component_indices )
+				if( system is None ):
+					return None
+				systems.append( (r.scale, system) )
+
+	return systems
+
+def score_ensembles( args, plugins, targets, components, ensembles ):
+	"""
+	Set the fitness of ensembles using equal (unoptimized) component ratios, scoring the whole population at once
+
+	Returns True if the ensembles were scored, False if a plugin doesn't support batch scoring
+
+	Arguments:
+	args		- The MESMER argument parameters
+	plugins		- A list of the plugin modules used to calculate the target-solution discrepancy
+	targets		- A list of mesTargets to score the ensembles against
+	components	- A dict of the mesComponents in the ensembles, keyed by name
+	ensembles	- The mesEnsembles to be scored
+	"""
+
+	if( len(ensembles) == 0 ):
+		return True
+
+	indices = get_component_indices( components, ensembles )
+	ratios = scipy.ones( indices.shape ) / args.size
+
+	# score everything before changing any ensemble
+	fitness = {}
+	for t in targets:
+		fitness[t.name] = get_batch_fitness( plugins, t, indices, ratios )
+		if( fitness[t.name] is None ):
+			return False
+
+	for (i,e) in enumerate(ensembles):
+		for t in targets:
+			e.ratios[t.name] = [1.0/args.size] * args.size
+			for (type,scores) in fitness[t.name].iteritems():
+				e.fitness[t.name][type] = float(scores[i])
+			e.optimized[t.name] = False
+			e.opt_status[t.name] = 'N/A'
+
+	return True
+
+def update_plugin_data( components, plugins, targets, ensemble ):
+	"""
+	Recalculate the plugin data of an ensemble at its current component ratios, e.g. after it was scored by score_ensembles()
+
+	The ensemble's optimization state is left unchanged
+
+	Arguments:
+	components	- A dict of the mesComponents in the ensemble, keyed by name
+	plugins		- A list of the plugin modules used to calculate the target-solution discrepancy
+	targets		- A list of mesTargets the ensemble is evaluated against
+	ensemble	- The mesEnsemble to update
+	"""
+
+	for t in targets:
+		optimized = ensemble.optimized[t.name]
+		ensemble.get_fitness( components, plugins, t, ensemble.ratios[t.name] )
+		ensemble.optimized[t.name] = optimized
+
+	return
+
 def get_unique_ensembles( ensembles ):
+	"""
+	Get the first of the ensembles containing each distinct set of components
 
-	# initialize the list with the first ensemble
-	unique = [ ensembles[0] ]
+	Returns a list of mesEnsembles, in their original order
+
+	Arguments:
+	ensembles	- A list of mesEnsembles sharing a layout
+	"""
 
 	# only append ensembles that contain different components
-	for e in ensembles:
-		for seen in unique:
-			if( set(seen.component_names) == set(e.component_names) ):
-				break
-		else:
+	seen,unique = set(),[]
+	for (e,key) in zip(ensembles,get_ensemble_keys(ensembles)):
+		if( key not in seen ):
+			seen.add(key)
 			unique.append(e)
 
 	return unique
 
+def get_ensemble_counts( ensembles ):
+	"""
+	Count the copies of each distinct set of components in a list of ensembles
+
+	Returns a Counter of the number of ensembles with each key, see get_ensemble_keys()
+
+	Arguments:
+	ensembles	- A list of mesEnsembles sharing a layout
+	"""
+
+	return Counter( get_ensemble_keys(ensembles) )
+
 def set_ensemble_state( args, ensembles, components ):
 
 	try:
@@ -134,5 +366,126 @@ def set_ensemble_state( args, ensembles, components ):
 	f.close()
 	return True
 
+# the checkpoint file in the run's results directory
+_CHECKPOINT_FILE = 'mesmer_checkpoint.dat'
+
+def get_checkpoint( generation, ensembles, optimizer, convergence ):
+	"""
+	Collect the complete state of the algorithm at the end of a generation, for write_checkpoint()
+
+	Must be called from the GA loop, once nothing else will draw random numbers before the next generation
+
+	Returns a dict of the checkpoint data
+
+	Arguments:
+	generation	- The number of the generation the run would continue with
+	ensembles	- The parent mesEnsembles of that generation, which are copied so the checkpoint can be written in the background
+	optimizer	- The ratio Optimizer, whose result cache is saved as well
+	convergence	- The convergence state of the run, see check_convergence()
+	"""
+
+	population = copy_ensembles( ensembles )[0]._population
+
+	# the run time so far rather than when it started, which is meaningless to the restarted run
+	state = dict( convergence )
+	state['elapsed'] = time() - state.pop('started')
+
+	return {
+		'generation':	generation,
+		'size':			population.size,
+		'layout':		{'targets':population.layout['targets'], 'types':population.layout['types'], 'names':list(population.layout['names'])},
+		'components':	population.components,
+		'ratios':		population.ratios,
+		'fitness':		population.fitness,
+		'optimized':	population.optimized,
+		'dirty':		population.dirty,
+		'opt_status':	population.opt_status,
+		'random':		random.getstate(),
+		'scipy_random':	scipy.random.get_state(),
+		'cache':		list(optimizer.cache.iteritems()),
+		'convergence':	state
+		}
+
+def write_checkpoint( args, checkpoint ):
+	"""
+	Save a checkpoint from get_checkpoint() to the results directory
+
+	The file is replaced atomically, so a run that is killed while writing still leaves the previous checkpoint intact
+
+	Arguments:
+	args		- The MESMER argument parameters
+	checkpoint	- The checkpoint data
+	"""
+
+	path = os.path.join( args.dir, _CHECKPOINT_FILE )
+
+	f = open( "%s.tmp" % path, 'wb' )
+	pickle.dump( checkpoint, f, pickle.HIGHEST_PROTOCOL )
+	f.flush()
+	os.fsync( f.fileno() )
+	f.close()
+
+	os.rename( "%s.tmp" % path, path )
+
+	return
+
+def read_checkpoint( args, plugins, targets, components, optimizer ):
+	"""
+	Restore the state of the algorithm from the checkpoint in the results directory
+
+	The random number generators, the optimizer result cache and the convergence state are restored, and any generations logged after the checkpoint are
+	discarded from the run log
+
+	Returns a tuple of the generation to continue with, its parent mesEnsembles, and the convergence state, see check_convergence()
+
+	Arguments:
+	args		- The MESMER argument parameters
+	plugins		- A list of the loaded plugin modules
+	targets		- A list of mesTargets
+	components	- A dict of the available mesComponents, keyed by name
+	optimizer	- The ratio Optimizer to restore the result cache of
+
+	Raises:
+	mesSetupError if the checkpoint can't be read, or doesn't match the loaded targets and components
+	"""
+
+	path = os.path.join( args.dir, _CHECKPOINT_FILE )
+	try:
+		f = open( path, 'rb' )
+		checkpoint = pickle.load( f )
+		f.close()
+	except (IOError,EOFError,pickle.UnpicklingError) as e:
+		raise mesSetupError("ERROR:\tCould not read checkpoint file \"%s\": %s" % (path,e))
+
+	population = mesPopulation( plugins, targets, checkpoint['size'], len(checkpoint['components']) )
+
+	if( checkpoint['size'] != args.size ):
+		raise mesSetupError("ERROR:\tCheckpoint ensemble size (%i) does not match the -size argument" % checkpoint['size'])
+	if( checkpoint['layout']['targets'] != population.layout['targets'] ):
+		raise mesSetupError("ERROR:\tCheckpoint targets (%s) do not match the loaded targets" % ", ".join(checkpoint['layout']['targets']))
+	if( checkpoint['layout']['types'] != population.layout['types'] ):
+		raise mesSetupError("ERROR:\tCheckpoint restraint types (%s) do not match the loaded plugins" % ", ".join(checkpoint['layout']['types']))
+
+	missing = [name for name in checkpoint['layout']['names'][1:] if not name in components]
+	if( len(missing) > 0 ):
+		raise mesSetupError("ERROR:\tComponent \"%s\" referenced in the checkpoint not found in loaded components" % missing[0])
+
+	codes = scipy.array( [population.get_code(name) for name in checkpoint['layout']['names']], dtype=scipy.int32 )
+	population.components[:] = codes[checkpoint['components']]
+	for name in ('ratios','fitness','optimized','dirty','opt_status'):
+		getattr(population,name)[:] = checkpoint[name]
+
+	random.setstate( checkpoint['random'] )
+	scipy.random.set_state( checkpoint['scipy_random'] )
+
+	optimizer.cache.clear()
+	optimizer.cache.update( checkpoint['cache'] )
+
+	# the stall and restart counts carry over, and the run time continues from where it was
+	convergence = dict( checkpoint.get('convergence',{'elapsed':0.0}) )
+	convergence['started'] = time() - convergence.pop('elapsed')
 
+	# the generations after the checkpoint will be run (and logged) again
+	mesLog( args.dir ).truncate( checkpoint['generation'] )
 
+	return (checkpoint['generation'],population.get_ensembles(),convergence)
@@ -5,11 +5,11 @@ Contains several useful functions for displaying or saving information/statistic
 import os
 import os.path
 import operator
-import shelve
 
 from datetime			import datetime
 
 from exceptions			import *
+from log_objects		import mesLog
 from ga_functions_misc	import *
 from ga_functions_stats	import *
 from utility_functions	import *
@@ -19,10 +19,11 @@ _MESMER_STATISTICS_FILE_FORMAT	= 'component_statistics_%s_%05i.tbl'
 _MESMER_CORRELATION_FILE_FORMAT	= 'component_correlations_%05i.tbl'
 _MESMER_RESTRAINTS_FILE_FORMAT	= 'restraints_%s_%s_%05i.out'
 _MESMER_OPT_STATUS_FILE_FORMAT	= 'optimization_state_%s_%05i.tbl'
+_MESMER_PROFILE_FILE			= 'profile.tbl'
 
 def print_generation_state( args, counter, ensemble_stats, restraint_stats ):
 	"""
-	Print the status of the current generation via print_msg()
+	Print the status of the current generation via print_msg(), see log_generation_state() for saving it to the run log
 
 	Args:
 		args (argparse namespace): MESMER argument parameters
@@ -35,6 +36,12 @@ def print_generation_state( args, counter, ensemble_stats, restraint_stats ):
 	print_msg( "" )
 	print_msg( "\tCurrent time: %s" % datetime.utcnow() )
 	print_msg( "\tParent survival percentage: %i%%, %i unique ensembles" % (100*ensemble_stats['ratio'],ensemble_stats['unique']) )
+	if( 'cache' in ensemble_stats ):
+		print_msg( "\tRatio optimization cache: %i hits, %i misses" % ensemble_stats['cache'] )
+	if( 'abandoned' in ensemble_stats ):
+		print_msg( "\tAbandoned offspring: %i, saving up to %i optimizer evaluations" % ensemble_stats['abandoned'] )
+	if( args.Gstall > 0 ):
+		print_msg( "\tGenerations without improvement: %i of %i" % (ensemble_stats['convergence']['stalled'],args.Gstall) )
 	print_msg( "\n\t\tBest Score\t|\tAverage\t\t|\tStdev" )
 	print_msg( "\t\t------------------------------------------------------------" )
 	print_msg( "\t\t%.3e\t|\t%.3e\t|\t%.3e" % (
@@ -65,20 +72,150 @@ def print_generation_state( args, counter, ensemble_stats, restraint_stats ):
 	print_msg( "" )
 	sys.stdout.flush()
 
-	# write to MESMER results db
-	db = shelve.open( os.path.join(args.dir,'mesmer_log.db') )
+	return
+
+def log_generation_state( args, counter, ensemble_stats, restraint_stats ):
+	"""
+	Append the status of the current generation to the MESMER run log
 
-	if(db.has_key('ensemble_stats')):
-		a,b = db['ensemble_stats'], db['restraint_stats']
-	else:
-		a,b = [],[]
+	Args:
+		args (argparse namespace): MESMER argument parameters
+		ensemble_stats (dict): A complex dictionary containing ensemble statistics. See get_best_ensembles() for more info.
+		restraint_stats (dict): A complex dictionary containing restraint statistics. See get_restraint_stats() for more info.
 
-	# large numbers of ensemble scores makes depickling run *extremely* slow, so no ensemble_stats['ratios']
-	a.append( (ensemble_stats['total'],ensemble_stats['ratio'],ensemble_stats['target']) )
-	b.append(restraint_stats)
+	Returns: None
+	"""
 
-	db['ensemble_stats'], db['restraint_stats'] = a, b
-	db.close()
+	# append to the MESMER run log
+	# large numbers of ensemble scores makes depickling run *extremely* slow, so no ensemble_stats['scores']
+	record = {
+		'ensemble_stats':	(ensemble_stats['total'],ensemble_stats['ratio'],ensemble_stats['target']),
+		'restraint_stats':	restraint_stats
+		}
+	if( 'cache' in ensemble_stats ):
+		record['cache_stats'] = ensemble_stats['cache']
+	if( 'abandoned' in ensemble_stats ):
+		record['abandon_stats'] = ensemble_stats['abandoned']
+	if( 'convergence' in ensemble_stats ):
+		record['convergence_stats'] = ensemble_stats['convergence']
+	if( 'optimization' in ensemble_stats ):
+		record['optimization_stats'] = ensemble_stats['optimization']
+
+	# why the run stopped or restarted after this generation, if it did
+	for key in ('stop','restart'):
+		if( key in ensemble_stats ):
+			record[key+'_reason'] = ensemble_stats[key]
+
+	mesLog( args.dir ).append( record )
+
+	return
+
+def write_profile( args, counter, elapsed, times ):
+	"""
+	Append the times collected from a mesProfile during a generation to the profile table in the MESMER results directory
+
+	Each row holds the number of calls, ensemble fitness evaluations and gradient evaluations, and the wall and CPU time in seconds, of either
+	a phase of the generation or the plugin functions for a restraint type. The plugins' CPU time includes that of the worker processes.
+
+	Args:
+		args (argparse namespace): MESMER argument parameters
+		counter (int): The generation number
+		elapsed (float): The wall time of the whole generation
+		times (dict): The collected times, see mesProfile.collect()
+
+	Returns: True on success, or False on failure
+	"""
+
+	path = os.path.abspath( os.path.join(args.dir,_MESMER_PROFILE_FILE) )
+	try:
+		new = not os.path.exists( path )
+		f = open( path, 'a' )
+	except IOError:
+		print_msg( "ERROR:\tCould not write profile to file \"%s\" " % (path) )
+		return False
+
+	if( new ):
+		f.write( "\t".join(['#generation','section','name','calls','evaluations','gradients','wall','cpu']) + "\n" )
+
+	rows = [('total','generation',[1,0,0,elapsed,0.0])]
+	rows.extend( [('phase',name,[calls,0,0,wall,cpu]) for (name,(calls,wall,cpu)) in times['phases'].iteritems()] )
+	rows.extend( [('restraint',type,values) for (type,values) in sorted(times['restraints'].iteritems())] )
+
+	for (section,name,(calls,evaluations,gradients,wall,cpu)) in rows:
+		f.write( "%05i\t%s\t%s\t%i\t%i\t%i\t%.6f\t%.6f\n" % (counter,section,name,calls,evaluations,gradients,wall,cpu) )
+
+	f.close()
+
+	return True
+
+def print_profile_summary( args, plugins, profile, elapsed ):
+	"""
+	Print the total times collected by a mesProfile over the run via print_msg(), see write_profile() for the per-generation times
+
+	Args:
+		args (argparse namespace): MESMER argument parameters
+		plugins (list): List of mesPlugins
+		profile (mesProfile): The run's profile
+		elapsed (float): The wall time of the whole run
+
+	Returns: None
+	"""
+
+	totals = profile.totals
+
+	print_msg( "\nProfile of the run, %.1f s wall time:" % (elapsed) )
+	print_msg( "\n\tPhase\t\tCalls\t|\tWall (s)\t|\tWall %\t|\tCPU (s)" )
+	print_msg( "\t\t------------------------------------------------------------" )
+	for (name,(calls,wall,cpu)) in totals['phases'].iteritems():
+		print_msg( "\t%-15s\t%i\t|\t%.3f\t\t|\t%.1f\t|\t%.3f" % (name,calls,wall,100.0*wall/max(elapsed,1E-9),cpu) )
+
+	if( len(totals['restraints']) == 0 ):
+		return
+
+	print_msg( "\n\tRestraint (plugin)\tCalls\t|\tFitness\t|\tGradients\t|\tWall (s)\t|\tCPU (s)" )
+	print_msg( "\t\t------------------------------------------------------------" )
+	for (type,(calls,evaluations,gradients,wall,cpu)) in sorted(totals['restraints'].iteritems()):
+		names = [p.name for p in plugins if type in p.types]
+		print_msg( "\t%s (%s)\t%i\t|\t%i\t|\t%i\t\t|\t%.3f\t\t|\t%.3f" % (type,",".join(names),calls,evaluations,gradients,wall,cpu) )
+
+	print_msg( "" )
+
+	return
+
+def write_generation_output( args, counter, targets, ensembles, ensemble_stats, restraint_stats ):
+	"""
+	Write all of the enabled per-generation output files and the run log entry, except for the plugins' own output (see print_plugin_state())
+
+	Called by the background output Writer, so the ensembles should be a snapshot that the GA loop no longer modifies (see copy_ensembles()).
+	Nothing here may call the plugins, which are still in use by the GA loop and aren't thread-safe (e.g. plotting with matplotlib).
+
+	Args:
+		args (argparse namespace): MESMER argument parameters
+		counter (int): The current generation number
+		targets (list): List of mesTargets
+		ensembles (list): List of mesEnsembles, ordered by fitness
+		ensemble_stats (dict): A complex dictionary containing ensemble statistics. See get_best_ensembles() for more info.
+		restraint_stats (dict): A complex dictionary containing restraint statistics. See get_restraint_stats() for more info.
+
+	Returns: None
+	"""
+
+	log_generation_state( args, counter, ensemble_stats, restraint_stats )
+
+	if(args.Pstats):
+		# print component correlations from the current ensembles
+		write_component_stats( args, counter, ensembles )
+
+		# print collected information on the current ensembles
+		write_ensemble_stats( args, counter, targets, ensembles )
+
+	if(args.Pstate):
+		# save the current ensemble population ratios
+		write_ensemble_state( args, counter, targets, ensembles )
+
+	if(args.Popt):
+		# write the ratio optimization state for the current ensembles
+		write_optimization_state( args, counter, targets, ensembles, ensemble_stats.get('optimization') )
 
 	return
 
@@ -108,9 +245,9 @@ def print_ensemble_state( args, ratio_stats ):
 
 def print_plugin_state( args, counter, plugins, targets, ensembles):
 	"""
-	Call the ensemble_state function for each plugin if the argument -Pstate is set
+	Call the ensemble_state function for each plugin if the argument -Pextra is set
 	
-	This function is called at each generation, and gives plugins a chance to print statistics or other aggregate information
+	This function is called at each generation from the GA loop rather than the background output Writer, and gives plugins a chance to print statistics or other aggregate information
 	
 	Args:
 		args (argparse namespace): MESMER argument parameters
@@ -175,23 +312,13 @@ def write_component_stats( args, counter, ensembles ):
 		f.write("\t%s" % name,)
 	f.write("\n")
 
-	toggle = 0
 	for i in range(n):
-		f.write("%s\t" % names[i])
-
-		for j in range(n):
 
-			# toggle from absolute to relative correlation
-			if( i == j ):
-				toggle = 1
-
-			if(toggle > 0):
-				f.write("%0.3f\t" % relative[i][j])
-			else:
-				f.write("%0.3f\t" % absolute[i][j])
+		# absolute correlations below the diagonal, relative correlations on and above it
+		row = absolute.getrow(i).toarray()[0]
+		row[i:] = relative.getrow(i).toarray()[0][i:]
 
-		f.write("\n")
-		toggle = 0
+		f.write("%s\t%s\n" % (names[i],''.join(["%0.3f\t" % value for value in row])))
 
 	f.close()
 
@@ -248,7 +375,7 @@ def write_ensemble_stats( args, counter, targets, ensembles ):
 
 	return True
 
-def write_optimization_state( args, counter, targets, ensembles ):
+def write_optimization_state( args, counter, targets, ensembles, optimization_stats=None ):
 	"""
 	Writes the optimizations state for each ensemble to a file
 
@@ -257,6 +384,7 @@ def write_optimization_state( args, counter, targets, ensembles ):
 		counter (int):Generation counter used to build the file output path
 		targets (list): List of mesTargets
 		ensembles (list): List of mesEnsembles
+		optimization_stats (dict): The cost of the generation's ratio optimizations for each target, written as a commented header. See get_telemetry_stats() for more info.
 
 	Returns: True on success, False on failure (also prints an error message to stdout)
 	"""
@@ -271,16 +399,20 @@ def write_optimization_state( args, counter, targets, ensembles ):
 			print_msg( "ERROR:\tCould not optimization state information to file \"%s\"" % (path) )
 			return False
 
+		if( optimization_stats is not None and t.name in optimization_stats ):
+			stats = optimization_stats[t.name]
+			f.write( "# %i optimizations\n" % (stats['optimizations']) )
+			f.write( "# %-12s\t%s\n" % ('',"\t".join(["%-9s" % (label) for label in ('Mean','Median','90%','Max')])) )
+			for (key,label,scale) in (('evaluations','Evaluations',1),('iterations','Iterations',1),('time','Time (ms)',1000)):
+				f.write( "# %-12s\t%s\n" % (label,"\t".join(["%.3e" % (scale*v) for v in stats[key]])) )
+			f.write( "# Status\t%s\n" % (", ".join(["%s: %i" % (status,count) for (status,count) in sorted(stats['status'].iteritems())])) )
+
 		for (i,e) in enumerate(ensembles):
 			f.write("%i\t" % (i))
+			f.write("%s\n" % ("\t".join([str(e.opt_status[u.name]) for u in targets])) )
 
-			a = []
-			for t in targets:
-				a.append( str(e.opt_status[t.name]) )
-
-			f.write("%s\n" % ("\t".join(a)) )
+		f.close()
 
-	f.close()
 	return True
 
 def write_ensemble_state( args, counter, targets, ensembles ):
@@ -1,9 +1,13 @@
 import copy
 import random
+import scipy
 
-from operator			import itemgetter
+from time				import time
+from collections		import Counter
+from scipy				import sparse
 
 from exceptions			import *
+from ensemble_objects	import get_population_rows,copy_ensembles
 from utility_functions	import mean_stdv
 from ga_functions_misc	import *
 from target_objects		import mesRestraint
@@ -45,19 +49,15 @@ def get_component_correlations( args, ensembles ):
 	"""
 	Generate an NxN correlation table of the components present in the ensemble population
 
+	Returns the component names, most heavily populated first, and the relative and absolute correlation tables as sparse NxN matrices
+
 	Arguments:
 	args		- MESMER argument parameters
 	ensembles	- list of ensembles to generate the correlation map for
 	"""
 
 	# generate an initial dict of components
-	component_counts = {}
-	for e in ensembles:
-		for name in e.component_names:
-			if (name in component_counts):
-				component_counts[name]+= 1
-			else:
-				component_counts[name] = 1
+	component_counts = Counter( [name for e in ensembles for name in e.component_names] )
 
 	n = len(ensembles)
 	# filter out all components that are lightly-populated
@@ -68,21 +68,77 @@ def get_component_correlations( args, ensembles ):
 	# sort to make most heavily populated first
 	names = sorted(component_counts, key=component_counts.get, reverse=True)
 
-	# initialize correlation table
+	# build the sparse ensemble x component incidence matrix of the remaining components
 	m = len(names)
-	relative_correlations = [[0] * m for i in range(m)]
-	absolute_correlations = [[0] * m for i in range(m)]
+	columns = dict([(name,i) for (i,name) in enumerate(names)])
+	(rows,cols) = ([],[])
+	for (source,positions,indices) in get_population_rows( ensembles ):
+		lookup = scipy.array([columns.get(name,-1) for name in source.layout['names']], dtype=int)
+		incidence = lookup[source.components[indices]]
+		(i,j) = scipy.nonzero(incidence >= 0)
+		rows.extend( scipy.array(positions)[i] )
+		cols.extend( incidence[i,j] )
+	incidence = sparse.csr_matrix( (scipy.ones(len(rows)),(rows,cols)), shape=(n,m) )
 
 	# count all examples of the correlation between components in the ensemble pool
-	for e in ensembles:
-		for i in range(m):
-			for j in range(m):
-				if(names[i] in e.component_names) and (names[j] in e.component_names):
-					relative_correlations[i][j] += 1.0/component_counts[names[j]]
-					absolute_correlations[i][j] += 1.0/n
+	cooccurrence = (incidence.T * incidence).tocsr()
+	counts = scipy.array([component_counts[name] for name in names], dtype=float)
+
+	relative_correlations = (cooccurrence * sparse.diags(1.0/counts)).tocsr() if m > 0 else cooccurrence
+	absolute_correlations = cooccurrence / float(n)
 
 	return (names,relative_correlations,absolute_correlations)
 
+def get_survival_cutoff( targets, parents ):
+	"""
+	Get the total score that offspring have to beat to survive selection by get_best_ensembles(), i.e. that of the worst parent
+
+	Arguments:
+	targets		- list of mesTargets ensembles have been fitted against
+	parents		- list of ensembles
+
+	Returns the cutoff score
+	"""
+
+	return float( get_target_scores( targets, parents ).sum(1).max() )
+
+def merge_island_ensembles( args, targets, populations, ratios ):
+	"""
+	Combine the sub-populations reported by the islands (see Island) into a single list of ensembles, ordered by score
+
+	Arguments:
+	args		- MESMER argument parameters
+	targets		- list of mesTargets ensembles have been fitted against
+	populations	- list of the islands' mesPopulations, whose layouts must agree on the component name codes (see get_component_layout())
+	ratios		- list of the parent survival ratios of the islands' latest generations
+
+	Returns a tuple of the ordered ensembles and the same statistics as get_best_ensembles()
+	(best_scored,stats)
+	"""
+
+	ensembles = copy_ensembles( [e for p in populations for e in p.get_ensembles()] )
+
+	scores = get_target_scores( targets, ensembles )
+	totals = scores.sum(1)
+	order = scipy.argsort( totals, kind='mergesort' )
+
+	best_scored = [ensembles[i] for i in order]
+
+	(total_stats,target_stats) = get_score_stats( targets, scores[order] )
+
+	multiplicity = get_ensemble_counts(best_scored)
+
+	stats = {
+	'scores':		scipy.column_stack( (order, totals[order], totals[order]) ),
+	'total':		total_stats,
+	'target':		target_stats,
+	'ratio':		sum([r*len(p) for (r,p) in zip(ratios,populations)]) / len(ensembles),
+	'unique':		len(multiplicity),
+	'multiplicity':	multiplicity
+	}
+
+	return (best_scored,stats)
+
 def get_restraint_stats( args, targets, ensembles ):
 	"""
 	Generate the per-restraint scores for the provided ensembles
@@ -93,24 +149,19 @@ def get_restraint_stats( args, targets, ensembles ):
 	ensembles	- list of ensembles to run error estimation on
 	"""
 
-	# initialize the return dict structure
-	stats = {}
-	for r in targets[0].restraints:
-		stats[r.type] = {}
-		for t in targets:
-			stats[r.type][t.name] = []
+	types = [r.type for r in targets[0].restraints]
+	fitness = get_fitness_array( targets, types, ensembles )
 
-	# extract the fitness values from the ensembles
-	for t in targets:
-		for r in targets[0].restraints:
-			for e in ensembles:
-				stats[r.type][t.name].append(e.fitness[t.name][r.type])
+	(means,stdevs) = (fitness.mean(0),scipy.zeros(fitness.shape[1:]))
+	if( len(ensembles) > 1 ):
+		stdevs = fitness.std(0, ddof=1)
 
-	#  replace the return dict values with the best ensemble restraint score, mean and stdev
-	for r in targets[0].restraints:
-		for t in targets:
-			(mean,stdev) = mean_stdv( stats[r.type][t.name] )
-			stats[r.type][t.name] = (ensembles[0].fitness[t.name][r.type],mean,stdev)
+	# the best ensemble restraint score, mean and stdev
+	stats = {}
+	for (k,type) in enumerate(types):
+		stats[type] = {}
+		for (j,t) in enumerate(targets):
+			stats[type][t.name] = (float(fitness[0,j,k]),float(means[j,k]),float(stdevs[j,k]))
 
 	return stats
 
@@ -151,16 +202,19 @@ def get_ratio_errors( args, plugins, targets, ensembles, optimizer ):
 					#sys.stdout.write("\r\tBootstrap progress: %i%%" % (100.*i/args.boots+1) )
 					#sys.stdout.flush()
 
+				# the optimizer writes its results back into the ensembles it is given, so fit a copy and leave the ensemble itself as it is
+				trial = copy_ensembles( [e] )[0]
+
 				# make estimation of target restraints via bootstrapping
 				estimates = []
 				for t in targets:
 					estimates.append( t.make_bootstrap(plugins,e) )
 
 					# unset optimization flag!
-					e.optimized[t.name] = False
+					trial.optimized[t.name] = False
 
 				# optimize the component ratios
-				optimized = optimizer.optimize( [e], print_status=False )
+				optimized = optimizer.optimize( [trial], print_status=False, cache=False, record=False )
 
 				for t in targets:
 					ratios[t.name].append( optimized[0].ratios[t.name] )
@@ -182,6 +236,99 @@ def get_ratio_errors( args, plugins, targets, ensembles, optimizer ):
 
 	return stats
 
+def check_convergence( args, state, ensemble_stats, generation ):
+	"""
+	Decide whether to stop the algorithm, or restart it with new ensembles, from the statistics of the latest generation
+
+	Besides the Fmin, Smin, Gmax and Gtime limits, the algorithm has stalled once neither the best nor the average ensemble score has improved
+	by Gimprove in Gstall generations, and has lost its diversity once the fraction of unique ensembles drops below Gdiversity. Either leads to
+	a restart while any of the Grestarts are left.
+
+	Arguments:
+	args			- MESMER argument parameters
+	state			- dict of the convergence state kept between generations, initially containing the 'started' time of the run
+	ensemble_stats	- the generation's statistics, see get_best_ensembles(), to which the 'convergence' statistics and any 'stop' or 'restart' reason are added
+	generation		- the generation counter
+
+	Returns a tuple of the reason to stop or None to continue, and whether to restart
+	(stop,restart)
+	"""
+
+	(best,mean) = ensemble_stats['total'][:2]
+
+	# count the generations since either score last improved by enough
+	if( 'reference' not in state or best < state['reference'][0] - args.Gimprove * abs(state['reference'][0]) or mean < state['reference'][1] - args.Gimprove * abs(state['reference'][1]) ):
+		(state['reference'],state['stalled']) = ((best,mean),0)
+	else:
+		state['stalled'] += 1
+
+	unique = float(ensemble_stats['unique']) / args.ensembles
+
+	# Fmin is compared to the score of the worst ensemble selected for the next generation. It used to be compared to a whole row of
+	# ensemble_stats['scores'], which in Python 2 is never less than a number, so Fmin didn't stop runs before
+	(stop,restart) = (None,None)
+	if( ensemble_stats['scores'][args.ensembles-1][1] < args.Fmin ):
+		stop = "Maximum ensemble score is less than Fmin"
+
+	elif( (ensemble_stats['total'][2]/ensemble_stats['total'][1]) < args.Smin ):
+		stop = "Ensemble score RSD is less than Smin"
+
+	# the islands count their own generations
+	elif( (args.Gmax > -1) and (ensemble_stats.get('generation',generation) >= args.Gmax) ):
+		stop = "Generation counter has reached Gmax"
+
+	elif( (args.Gtime > 0) and (time() - state['started'] >= 60 * args.Gtime) ):
+		stop = "Run time has reached Gtime"
+
+	elif( (args.Gstall > 0) and (state['stalled'] >= args.Gstall) ):
+		restart = "Ensemble scores have not improved by Gimprove in Gstall generations"
+
+	elif( unique < args.Gdiversity ):
+		restart = "Fraction of unique ensembles is less than Gdiversity"
+
+	if( restart is not None and state.get('restarts',0) >= args.Grestarts ):
+		(stop,restart) = (restart,None)
+
+	if( restart is not None ):
+		state['restarts'] = state.get('restarts',0) + 1
+		del state['reference']
+		ensemble_stats['restart'] = restart
+
+	if( stop is not None ):
+		ensemble_stats['stop'] = stop
+
+	ensemble_stats['convergence'] = {
+	'stalled':		state['stalled'],
+	'unique':		unique,
+	'restarts':		state.get('restarts',0),
+	'elapsed':		time() - state['started']
+	}
+
+	return (stop,restart is not None)
+
+def get_score_stats( targets, scores ):
+	"""
+	Calculate the best, mean and stdev of the total scores of ensembles, and of their scores for each target
+
+	Arguments:
+	targets	- list of mesTargets ensembles have been fitted against
+	scores	- N x targets array of the ensembles' scores (see get_target_scores()), best-scoring first
+
+	Returns a tuple of the [best,mean,stdev] lists for the total scores, and a dict of them for each target's scores
+	(total_stats,target_stats)
+	"""
+
+	scores = scipy.column_stack( (scores.sum(1),scores) )
+
+	means = scores.mean(0)
+	stdevs = scipy.zeros(len(means))
+	if( len(scores) > 1 ):
+		stdevs = scores.std(0, ddof=1)
+
+	stats = [[float(scores[0,j]),float(means[j]),float(stdevs[j])] for j in xrange(len(means))]
+
+	return (stats[0],dict([(t.name,stats[j+1]) for (j,t) in enumerate(targets)]))
+
 def get_best_ensembles( args, targets, parents, offspring ):
 	"""
 	Return only the best-scoring ensembles from parent and offspring populations
@@ -196,75 +343,47 @@ def get_best_ensembles( args, targets, parents, offspring ):
 	(best_scored,stats)
 	"""
 
-	# calculate total fitness values for each population, parent and offspring
-	p_scores = calculate_fitnesses( targets, parents )
-	o_scores = calculate_fitnesses( targets, offspring )
+	# the parents are numbered first, then the offspring
+	ensembles = parents + offspring
 
-	# combine the overall parent and offspring score sums into a list of key-score pairs
-	scores = []
-
-	for i in range( args.ensembles ):
-		scores.append( [i, 0.0, 0.0] ) # third value will contain fuzzy value ensemble tolerance
-		for t in targets:
-			scores[-1][1] += p_scores[t.name][i]
-		scores[-1][2] = scores[-1][1]
+	# calculate total fitness values for each ensemble, parent and offspring
+	scores = get_target_scores( targets, ensembles )
+	totals = scores.sum(1)
 
-	for i in range( args.ensembles ):
-		scores.append( [i +args.ensembles, 0.0, 0.0] )
-		for t in targets:
-			scores[-1][1] += o_scores[t.name][i]
-		scores[-1][2] = scores[-1][1]
-	
-	score_min = min(zip(*scores)[1])
+	fuzzy = totals.copy()
 	if args.Gtolerance > 0: # add a small amount of variation to generate "fuzzy" tolerance during sorting
-		for i in range( args.ensembles*2 ):
-			scores[i][2] += scores[i][1] + (score_min * args.Gtolerance * random.random())
-
-	# sort the array by the fitness scores
-	sorted_scores = sorted(scores, key=itemgetter(2))
-
-	# keep track of per-target scores as well
-	target_scores = {}
-	for t in targets:
-		target_scores[t.name] = []
+		fuzzy += totals + (totals.min() * args.Gtolerance * scipy.random.random(len(totals)))
 
 	# select only the 1/2 best scoring from the combined parent and offspring ensembles for the next step
-	best_scored, total_scores, fuzzy_scores = [], [], []
-	counter = 0
-	for (i, (key,score,fuzzy) ) in enumerate(sorted_scores):
-		total_scores.append( score )
-		fuzzy_scores.append( fuzzy )
-
-		if( key < args.ensembles ):
-			best_scored.append( parents[key] )
-			for t in targets:
-				target_scores[t.name].append( p_scores[t.name][key] )
-		else:
-			counter += 1
-			best_scored.append( offspring[key % args.ensembles] )
-			for t in targets:
-				target_scores[t.name].append( o_scores[t.name][key % args.ensembles] )
+	# ties at the cutoff go to the lowest numbered ensembles, as they would with a stable sort
+	n = args.ensembles
+	kth = scipy.partition( fuzzy, n-1 )[n-1]
+	below = scipy.flatnonzero( fuzzy < kth )
+	selected = scipy.concatenate( (below, scipy.flatnonzero( fuzzy == kth )[:n-len(below)]) )
+	selected = selected[ scipy.lexsort( (selected, fuzzy[selected]) ) ]
+
+	best_scored = [ensembles[i] for i in selected]
 
-		# quit once we've reached the required number of offspring
-		if( i == (args.ensembles -1) ):
-			break
+	# the number of offspring that survived
+	counter = int( (selected >= len(parents)).sum() )
 
 	# calculate the minimum, average and stdev scores for the total and also for each target individually
-	total_stats = [total_scores[0]]
-	total_stats.extend(mean_stdv(total_scores))
+	(total_stats,target_stats) = get_score_stats( targets, scores[selected] )
 
-	target_stats = {}
-	for t in targets:
-		target_stats[t.name] = [target_scores[t.name][0]]
-		target_stats[t.name].extend(mean_stdv(target_scores[t.name]))
+	# the number of copies of each distinct component set among the selected ensembles
+	multiplicity = get_ensemble_counts(best_scored)
+
+	# the key, score and fuzzy score of every ensemble, in order of the fuzzy scores
+	order = scipy.argsort( fuzzy, kind='mergesort' )
 
 	# create the statistics dict
 	stats = {
-	'scores':	sorted_scores,
-	'total':	total_stats,
-	'target':	target_stats,
-	'ratio':	float(args.ensembles - counter) / args.ensembles,
-	'unique':	len(get_unique_ensembles(best_scored))
+	'scores':		scipy.column_stack( (order, totals[order], fuzzy[order]) ),
+	'total':		total_stats,
+	'target':		target_stats,
+	'ratio':		float(args.ensembles - counter) / args.ensembles,
+	'unique':		len(multiplicity),
+	'multiplicity':	multiplicity
 	}
 
 	return (best_scored,stats)
@@ -1,125 +1,1021 @@
 import sys
 import os.path
+import copy
+import random
+import scipy
 
-from math					import fabs
-from scipy					import optimize
+from math					import fabs,ceil
+from time					import time
+from collections			import OrderedDict
+from scipy					import optimize,array,frombuffer,int32,float64,inf
+from threading				import Thread
+from Queue					import Queue as ThreadQueue,Full,Empty
 from multiprocessing		import Process,Queue
+from multiprocessing.sharedctypes	import RawArray
 
 from exceptions				import *
+from utility_functions		import print_msg
+from ensemble_objects		import mesEnsemble,mesPopulation,copy_ensembles,get_population_rows,get_component_layout
+from ga_functions_misc		import score_ensembles,get_linear_systems,evolve_ensembles,get_component_indices,get_batch_fitness,get_batch_fitness_gradient
+from ga_functions_stats		import get_best_ensembles,get_survival_cutoff
+from optimization_functions	import blind_random_min,localized_random_min,linear_ratio_min,projected_gradient_min
+
+# ratio optimization status values, which are passed between processes as their index in this list
+_STATUSES = [None, 0, 1, 2, 'N/A', 'Not converged', 'Unknown', 'Abandoned'] + sorted(optimize.tnc.RCSTRINGS.values())
+_STATUS_CODES = dict([(status,i) for (i,status) in enumerate(_STATUSES)])
+_STATUSES = array(_STATUSES, dtype=object)
+
+# the statuses of converged ratio optimizations, whose results are final and can be cached: 0 from the algorithms that report success that way,
+# and the convergence messages of tnc, the default algorithm
+_CONVERGED = set([0] + [optimize.tnc.RCSTRINGS[rc] for rc in (optimize.tnc.LOCALMINIMUM,optimize.tnc.FCONVERGED,optimize.tnc.XCONVERGED)])
+
+# the approximate time each worker should spend on a chunk of ensembles, in seconds
+_CHUNK_TIME = 0.1
+
+def encode_status( status ):
+	"""Get the integer code of an optimization status value"""
+	return _STATUS_CODES.get( status, _STATUS_CODES['Unknown'] )
+
+def get_telemetry_stats( targets, telemetry ):
+	"""
+	Summarize the cost of ratio optimizations for each target
+
+	Returns: an OrderedDict keyed by the names of the targets that were optimized against, of dicts containing the number of 'optimizations',
+	the (mean, median, 90th percentile, maximum) fitness 'evaluations', optimizer 'iterations' and wall 'time' in seconds, and the number of
+	optimizations ending with each 'status'
+
+	Arguments:
+	targets		- List of mesTargets
+	telemetry	- List of (target index, evaluations, iterations, wall time, status code) tuples, one for each optimization, see Worker
+	"""
+
+	records = array( telemetry, dtype=float ).reshape( (-1,5) )
+
+	stats = OrderedDict()
+	for (i,t) in enumerate(targets):
+		rows = records[records[:,0] == i]
+		if( len(rows) == 0 ):
+			continue
+
+		stats[t.name] = {'optimizations':len(rows), 'status':{}}
+		for (key,column) in (('evaluations',1),('iterations',2),('time',3)):
+			values = rows[:,column]
+			stats[t.name][key] = (values.mean(),) + tuple(scipy.percentile(values, [50,90])) + (values.max(),)
+
+		(codes,counts) = scipy.unique( rows[:,4].astype(int), return_counts=True )
+		for (code,count) in zip(codes,counts):
+			stats[t.name]['status'][_STATUSES[code]] = int(count)
+
+	return stats
 
 class Optimizer:
-	def __init__(self,args,plugins,targets,components):
-		self.workers = [None]*args.threads
-		self.in_Queue,self.out_Queue = Queue(maxsize=args.threads),Queue()
+	def __init__(self,args,plugins,targets,components,threads=None,profile=None):
+		self.args = args
+		self.plugins = plugins
+		self.targets = targets
+		self.components = components
+
+		# the mesProfile to merge the workers' plugin times into
+		self.profile = profile
+
+		# least-recently-used cache of ratio optimization results, keyed by target name and (sorted) component names
+		self.cache = OrderedDict()
+		self.hits,self.misses = 0,0
+
+		# offspring abandoned early for having no chance of surviving, and the optimizer evaluation budget that saved
+		self.abandoned,self.saved = 0,0
+
+		# the cost of each ratio optimization, see Worker, and whether to keep it for get_optimization_stats()
+		self.telemetry = []
+		self.record = True
+
+		# work buffer for the ensembles being optimized, in shared memory so the workers can update them in place
+		# component names are stored as their component index (see mesComponent), which all processes agree on
+		self.buffer = mesPopulation( plugins, targets, args.size, args.ensembles, get_component_layout(plugins, targets, components), shared=True )
+		self.status = frombuffer( RawArray('i', args.ensembles * len(targets)), dtype=int32 ).reshape( (args.ensembles,len(targets)) )
+
+		# the survival cutoff score of the ensembles being optimized, see optimize()
+		self.cutoff = frombuffer( RawArray('d', 1), dtype=float64 )
+
+		# the random seed of the first ensemble in the work buffer, drawn in this process so that a restored checkpoint also restores the workers' random numbers
+		self.seed = frombuffer( RawArray('i', 1), dtype=int32 )
+
+		# component name codes to component index translation arrays, by population name table
+		self.lookup = {}
+
+		# running average of the time taken to optimize one ensemble, for sizing work chunks
+		self.cost = None
+
+		# the number of worker processes, defaults to -threads
+		if( threads is None ):
+			threads = args.threads
+		self.threads = threads
+
+		self.workers = [None]*threads
+		self.in_Queue,self.out_Queue = Queue(maxsize=threads),Queue()
 						
-		for i in xrange(args.threads):
-			self.workers[i] = Worker(args, plugins, targets, components, self.in_Queue, self.out_Queue)
+		for i in xrange(threads):
+			self.workers[i] = Worker(args, plugins, targets, components, self.buffer, self.status, self.in_Queue, self.out_Queue, self.cutoff, profile, self.seed)
 			self.workers[i].start()
 
+		# workers on other hosts take chunks from the same queue
+		self.remote = None
+		if( args.listen ):
+			from remote_objects import Coordinator
+			self.remote = Coordinator(args, self.buffer, self.status, self.in_Queue, self.out_Queue, self.cutoff, self.seed)
+			self.remote.start()
+
 		return
 		
-	def optimize(self,ensembles,print_status=True):
-		n,i = len(ensembles),0
-		divisor = int(max(n/100,1))
-		ret = []
-		
-		# submit ensembles to the queue
-		for i in xrange(n):
-			self.in_Queue.put( ensembles[i] )
-		
-			if(i % divisor == 0 and print_status):
-				sys.stdout.write("\tComponent ratio optimization progress: %i%%\r" % (1+100.*i/n) )
+	def optimize(self,ensembles,print_status=True,cache=True,cutoff=None,record=True):
+		"""Optimize the component ratios of ensembles against every target they aren't optimized for yet
+
+		Arguments:
+		ensembles		- A list of mesEnsembles
+		print_status	- Print the optimization progress
+		cache			- Reuse the results for component sets that have already been optimized, if -Rcache is enabled
+		cutoff			- The total score that offspring have to beat to survive selection, see -Rabandon
+		record			- Include the optimizations in get_optimization_stats(), e.g. not those of the bootstrap error analysis
+
+		Returns: The same list of mesEnsembles
+		"""
+
+		if( cutoff is None or self.args.Rabandon <= 0 ):
+			self.cutoff[0] = inf
+		else:
+			self.cutoff[0] = cutoff
+
+		self.record = record
+
+		# without ratio optimization, score the whole population at once if all the plugins support it
+		if( self.args.Ralgorithm == 0 and score_ensembles( self.args, self.plugins, self.targets, self.components, ensembles ) ):
+			return ensembles
+
+		# reuse the results for component sets that have already been optimized
+		cache = cache and (self.args.Rcache > 0) and not self.args.Rforce
+		if( cache ):
+			pending = [e for e in ensembles if not self.recall(e)]
+		else:
+			pending = ensembles
+
+		# optimize as many ensembles at once as fit in the work buffer
+		capacity = len(self.buffer)
+		for first in xrange(0,len(pending),capacity):
+			self.load( pending[first:first+capacity] )
+			self.seed[0] = scipy.random.randint( 2**31 - capacity )
+			self.dispatch( min(capacity,len(pending)-first), print_status )
+			self.unload( pending[first:first+capacity] )
+
+		if( cache ):
+			for e in pending:
+				self.remember(e)
+
+		return ensembles
+
+	def load(self,ensembles):
+		"""Copy ensembles into the start of the shared work buffer"""
+
+		for (source,positions,rows) in get_population_rows( ensembles ):
+
+			# translate the source population's component name codes into component indices
+			names = source.layout['names']
+			(table,lookup) = self.lookup.get( id(names), (None,[]) )
+			if( table is not names or len(lookup) < len(names) ):
+				lookup = array([self.components[name].index if name in self.components else 0 for name in names], dtype=int32)
+				self.lookup[id(names)] = (names,lookup)
+
+			self.buffer.components[positions] = lookup[source.components[rows]]
+			for name in ('ratios','fitness','optimized','dirty'):
+				getattr(self.buffer,name)[positions] = getattr(source,name)[rows]
+			self.status[positions] = [[encode_status(status) for status in row] for row in source.opt_status[rows]]
+
+		return
+
+	def unload(self,ensembles):
+		"""Copy the optimization results for ensembles from the start of the shared work buffer"""
+
+		for (source,positions,rows) in get_population_rows( ensembles ):
+			for name in ('ratios','fitness','optimized','dirty'):
+				getattr(source,name)[rows] = getattr(self.buffer,name)[positions]
+			source.opt_status[rows] = _STATUSES[self.status[positions]]
+
+		return
+
+	def dispatch(self,n,print_status):
+		"""Have the workers optimize the first n ensembles in the work buffer, in chunks sized by the measured cost per ensemble"""
+
+		divisor = max(n/100,1)
+		(start,done) = (0,0)
+
+		# remote workers may come and go, but there has to be at least one worker to wait for
+		workers = self.threads
+		if( self.remote is not None ):
+			workers += self.remote.count()
+		workers = max(workers,1)
+
+		def retrieve( block ):
+			(first,last,elapsed,abandoned,saved,times,telemetry) = self.out_Queue.get(block)
+			self.abandoned += abandoned
+			self.saved += saved
+			if( self.record ):
+				self.telemetry.extend( telemetry )
+			if( times is not None and self.profile is not None ):
+				self.profile.add( times )
+
+			if( self.cost is None ):
+				self.cost = elapsed / (last-first)
+			else:
+				self.cost = (0.8 * self.cost) + (0.2 * elapsed / (last-first))
+
+			if(print_status and (done // divisor) != ((done + last-first) // divisor)):
+				sys.stdout.write("\tComponent ratio optimization progress: %i%%\r" % (100.*(done + last-first)/n) )
 				sys.stdout.flush()
-			
+
+			return last-first
+
+		# submit chunks of ensembles to the queue
+		while start < n:
+
+			# aim for a fixed amount of time per chunk, but always leave enough work for all workers
+			size = int(ceil( (n-start) / float(workers*4) ))
+			if( self.cost is not None and self.cost > 0 ):
+				size = min( int(_CHUNK_TIME / self.cost), int(ceil( (n-start) / float(workers) )) )
+
+			stop = min( n, start + max(size,1) )
+			self.in_Queue.put( (start,stop) )
+			start = stop
+
 			# do we have any optimized ensembles to retrieve?
 			try:
-				ret.append( self.out_Queue.get(False) )
+				done += retrieve( False )
 			except:
 				pass
-		
+
 		# retrieve optimized ensembles
-		while len(ret) < n:
-			ret.append( self.out_Queue.get(True) )
-						
+		while done < n:
+			done += retrieve( True )
+
+		return
+
+	def recall(self,e):
+		"""Set an ensemble's ratios, fitness and status from the cache for every target it needs to be optimized against
+
+		Arguments:
+		e	- The mesEnsemble to look up
+
+		Returns: True if the ensemble needs no further optimization this generation, False if it has to be sent to the workers
+		"""
+
+		names = sorted(e.component_names)
+		keys = [(t.name,tuple(names)) for t in self.targets if not e.optimized[t.name]]
+
+		if( len(keys) == 0 ):
+			return True
+
+		if( not all([key in self.cache for key in keys]) ):
+			self.misses += 1
+			return False
+
+		self.hits += 1
+		for key in keys:
+			# move the entry to the most-recently-used end
+			(ratios,fitness,status) = self.cache[key] = self.cache.pop(key)
+
+			e.ratios[key[0]] = [ratios[names.index(name)] for name in e.component_names]
+			e.fitness[key[0]] = dict(fitness)
+			e.opt_status[key[0]] = status
+
+			# flagged the same way as by the workers, see Worker.optimize_ensemble()
+			e.optimized[key[0]] = (status == 0) and not self.args.Rforce
+
+		e.dirty[:] = False
+		return True
+
+	def remember(self,e):
+		"""Add an ensemble's converged ratios, fitness and status for each target to the cache, discarding the least recently used entries if full
+
+		Arguments:
+		e	- The optimized mesEnsemble
+
+		Returns: None
+		"""
+
+		order = sorted(range(len(e.component_names)), key=lambda i: e.component_names[i])
+		key = tuple([e.component_names[i] for i in order])
+
+		for t in self.targets:
+			# only converged ratios are final, the others are optimized further from where they are in the next generation
+			if( e.opt_status[t.name] not in _CONVERGED ):
+				continue
+
+			self.cache.pop((t.name,key), None)
+			self.cache[(t.name,key)] = ([e.ratios[t.name][i] for i in order], dict(e.fitness[t.name]), e.opt_status[t.name])
+
+		while( len(self.cache) > self.args.Rcache ):
+			self.cache.popitem(last=False)
+
+		return
+
+	def get_abandon_stats(self):
+		"""Get the number of ensembles abandoned early, and the optimizer evaluation budget that saved, since the last call
+
+		Returns: (abandoned, saved)
+		"""
+
+		ret = (self.abandoned,self.saved)
+		self.abandoned,self.saved = 0,0
+		return ret
+
+	def get_cache_stats(self):
+		"""Get the cache hit and miss counts since the last call
+
+		Returns: (hits, misses)
+		"""
+
+		ret = (self.hits,self.misses)
+		self.hits,self.misses = 0,0
+		return ret
+
+	def get_optimization_stats(self):
+		"""Get the function evaluations, iterations, time and termination status of the ratio optimizations since the last call
+
+		Returns: The statistics for each target, see get_telemetry_stats()
+		"""
+
+		ret = get_telemetry_stats( self.targets, self.telemetry )
+		self.telemetry = []
 		return ret
 		
 	def close(self):
 		for w in self.workers:
 			self.in_Queue.put(None)	
+
+		# workers that have disconnected never take theirs, and one that disconnects now leaves its sentinel in the queue
+		if( self.remote is not None ):
+			for w in self.remote.workers:
+				if( w.is_alive() ):
+					try:
+						self.in_Queue.put( None, True, 3 * self.args.heartbeat )
+					except Full:
+						pass
 		
 		for w in self.workers:
 			w.join()
 		return
 
 class Worker(Process):
-	def __init__(self,args,plugins,targets,components,in_queue,out_queue):
+	def __init__(self,args,plugins,targets,components,buffer,status,in_queue,out_queue,cutoff=None,profile=None,seed=None):
 		super(Worker, self).__init__()
 		self.args = args
 		self.plugins = plugins
 		self.targets = targets
 		self.components = components
+		self.buffer = buffer
+		self.status = status
 		self.iQ = in_queue
 		self.oQ = out_queue
+		self.cutoff = cutoff
+		self.seed = seed
 		self.daemon = True
 
+		# the mesProfile whose plugin times are reported with each chunk, this process' copy of the one wrapped around the plugins (see mesProfile.wrap_plugins())
+		self.profile = profile
+
+		# the ensembles abandoned since the last report to the parent process, and the evaluation budget that saved
+		self.abandoned,self.saved = 0,0
+
+		# (target index, fitness evaluations, iterations, wall time, status code) of each optimization since the last report
+		self.telemetry = []
+
+		# whether the plugins provide fitness gradients for each target, and whether they can score it in batches, determined on first use
+		self.gradients = {}
+		self.batches = {}
+
+		# the restraint types of all targets, whose attributes are collected once per ensemble
+		self.types = sorted(set([r.type for t in targets for r in t.restraints]))
+
 	def run(self):
-		"""Consume ensembles from the input queue, and calculate their cumulative fitness score
+		"""Consume chunks of work buffer rows from the input queue, and optimize the ensembles in place
 		
 		Arguments: None
 		
 		Returns: None
 		"""
 		
-		# retrieve ensembles from the queue
-		for e in iter(self.iQ.get, None):
-		
-			# set up a bounding array for bounded optimizers
-			ratio_bounds = [(0.0,1.0)] * self.args.size
+		# discard the times inherited from the parent process
+		if( self.profile is not None ):
+			self.profile.collect()
+
+		# retrieve chunks from the queue
+		for (start,stop) in iter(self.iQ.get, None):
+			began = time()
+
+			# plugin data isn't returned to the parent process
+			self.buffer.plugin_data.clear()
+
+			# an infinite cutoff disables abandonment
+			cutoff = self.cutoff[0] if self.cutoff[0] < inf else None
+
+			ensembles = [mesEnsemble( population=self.buffer, index=row ) for row in xrange(start,stop)]
+
+			for (row,e,optimized) in zip(xrange(start,stop),ensembles,self.optimize_batch(ensembles, cutoff, self.seed[0]+start)):
+				for i in optimized:
+					self.status[row,i] = encode_status( e.opt_status[self.targets[i].name] )
+	
+			self.oQ.put( (start,stop,time()-began,self.abandoned,self.saved,self.profile.collect() if self.profile is not None else None,self.telemetry) )
+			self.abandoned,self.saved = 0,0
+			self.telemetry = []
 		
-			# optimize for each target individually
+		return
+
+	def optimize_ensemble(self, e, cutoff=None):
+		"""Optimize the component ratios of an ensemble against every target it isn't optimized for yet
+
+		With a cutoff, only the -Rabandon fraction of the budget is spent at first. If the ensemble's total score is then still more than -Rmargin
+		above the cutoff, it is abandoned with an 'Abandoned' status instead of being optimized any further.
+
+		Arguments:
+		e		- The mesEnsemble to optimize
+		cutoff	- The total score the ensemble has to beat to survive selection, or None to always optimize fully
+
+		Returns: A list of the indices of the targets the ensemble was optimized against
+		"""
+
+		# ensembles that differ from their optimized parent by a single component should need less work
+		budget = self.args.Rn
+		if( e.dirty.sum() == 1 ):
+			budget = max( int(self.args.Rn * self.args.Rwarm), 1 )
+
+		# the component set is the same for every target, so only collect the attributes once
+		attributes = dict([(type,e.get_attributes(self.components, type)) for type in self.types])
+
+		# spend only part of the budget at first if the ensemble may not be worth optimizing
+		fraction = 1.0
+		if( cutoff is not None and self.args.Rabandon > 0 ):
+			fraction = self.args.Rabandon
+
+		# optimize for each target individually, keeping track of the budget left for each, and the evaluations, iterations and time spent
+		remaining = {}
+		spent = {}
+		previous = None
+		for (i,t) in enumerate(self.targets):
+
+			if(e.optimized[t.name]):
+				previous = t
+				continue
+
+			# neighboring titration points should have similar optima, so start from the previous one's
+			if( self.args.titration and previous is not None ):
+				e.ratios[t.name] = e.ratios[previous.name]
+				total = max( int(self.args.Rn * self.args.Rwarm), 1 )
+
+			# otherwise restart from the previously-optimized ratios of the unchanged components
+			else:
+				e.warm_start(t.name)
+				total = budget
+
+			initial = max( int(total * fraction), 1 )
+			began = time()
+			spent[i] = list(self.optimize(e, t, self.args.Ralgorithm, initial, attributes)) + [time()-began]
+			remaining[i] = total - initial
+
+			# normalize ensemble ratios for the target
+			e.normalize(t.name)
+
+			previous = t
+
+		if( fraction < 1.0 and len(remaining) > 0 ):
+
+			# the fitness last calculated by the optimizer isn't necessarily that of the ratios it returned
+			score = 0.0
 			for (i,t) in enumerate(self.targets):
-	
-				# delta function for fitness algorithm to pass to minimization function
-				def wrapper( ratios ):
-					return sum(e.get_fitness( self.components, self.plugins, t, ratios ).itervalues())
-	
+				if( i in remaining ):
+					score += sum(e.get_fitness( self.components, self.plugins, t, e.ratios[t.name], attributes ).itervalues())
+				else:
+					score += sum(e.fitness[t.name].itervalues())
+
+			if( score > cutoff * (1.0 + self.args.Rmargin) ):
+				for i in remaining:
+					e.opt_status[self.targets[i].name] = 'Abandoned'
+				self.abandoned += 1
+				self.saved += sum(remaining.values())
+
+			else:
+				for i in remaining:
+					if( remaining[i] > 0 ):
+						began = time()
+						(evaluations,iterations) = self.optimize(e, self.targets[i], self.args.Ralgorithm, remaining[i], attributes)
+						spent[i] = [spent[i][0]+evaluations, spent[i][1]+iterations, spent[i][2]+time()-began]
+						e.normalize(self.targets[i].name)
+
+		optimized = sorted(remaining.keys())
+		for i in optimized:
+			t = self.targets[i]
+
+			# set optimization flag!
+			if( (e.opt_status[t.name] != 0) or self.args.Rforce ):
+				e.optimized[t.name] = False
+			else:
+				e.optimized[t.name] = True
+
+			self.telemetry.append( (i,spent[i][0],spent[i][1],spent[i][2],encode_status(e.opt_status[t.name])) )
+
+		e.dirty[:] = False
+
+		return optimized
+
+	def optimize_batch(self, ensembles, cutoff=None, seed=None):
+		"""Optimize the component ratios of many ensembles against every target they aren't optimized for yet, see optimize_ensemble()
+
+		With -Ralgorithm 8 all of the ensembles are optimized together, see optimize_target_batch(). Otherwise, or if a plugin can't batch-score
+		the targets, each ensemble is optimized in turn.
+
+		Arguments:
+		ensembles	- A list of mesEnsembles
+		cutoff		- The total score the ensembles have to beat to survive selection, or None to always optimize fully
+		seed		- Seed the random number generator with seed+k before optimizing the k-th ensemble in turn, so that the results don't depend on
+					  which process optimizes it, or None to carry on with the process' random numbers
+
+		Returns: A list of the indices of the targets each ensemble was optimized against
+		"""
+
+		def optimize_each():
+			optimized = []
+			for (k,e) in enumerate(ensembles):
+				if( seed is not None ):
+					scipy.random.seed( seed + k )
+				optimized.append( self.optimize_ensemble(e, cutoff) )
+			return optimized
+
+		if( self.args.Ralgorithm != 8 or len(ensembles) == 0 ):
+			return optimize_each()
+
+		indices = get_component_indices( self.components, ensembles )
+
+		for t in self.targets:
+			if( not t.name in self.batches ):
+				self.batches[t.name] = (get_batch_fitness( self.plugins, t, indices[:1], scipy.ones((1,self.args.size)) / self.args.size ) is not None)
+
+			if( not self.batches[t.name] ):
+				return optimize_each()
+
+		# see optimize_ensemble()
+		warm = max( int(self.args.Rn * self.args.Rwarm), 1 )
+		budgets = [warm if e.dirty.sum() == 1 else self.args.Rn for e in ensembles]
+
+		fraction = 1.0
+		if( cutoff is not None and self.args.Rabandon > 0 ):
+			fraction = self.args.Rabandon
+
+		# the budget left for each ensemble, and the evaluations, iterations and time spent on it, by target index
+		remaining = [{} for e in ensembles]
+		spent = [{} for e in ensembles]
+
+		def optimize_rows( rows, i, budgets ):
+			began = time()
+			(evaluations,iterations) = self.optimize_target_batch( ensembles, indices, rows, self.targets[i], budgets )
+
+			# the ensembles are optimized together, so share the time between them
+			elapsed = (time()-began) / max(len(rows),1)
+			for (k,n,m) in zip(rows,evaluations,iterations):
+				spent[k][i] = [a+b for (a,b) in zip(spent[k].get(i,[0,0,0.0]),(n,m,elapsed))]
+
+		for (i,t) in enumerate(self.targets):
+			rows,initial = [],[]
+			for (k,e) in enumerate(ensembles):
 				if(e.optimized[t.name]):
 					continue
-				elif( self.args.Ralgorithm == 0 ):
-					e.get_fitness( components, plugins, t, [1.0/self.args.size] * self.args.size )
-					e.opt_status[t.name] = 'N/A'
-	
-				elif( self.args.Ralgorithm == 1 ):
-					e.ratios[t.name] = blind_random_min( wrapper, e.ratios[t.name], self.args.Rprecision, self.args.Rn )
-					e.opt_status[t.name] = 'N/A'
-	
-				elif( self.args.Ralgorithm == 2 ):
-					e.ratios[t.name] = localized_random_min( wrapper, e.ratios[t.name], self.args.Rprecision, self.args.Rn )
-					e.opt_status[t.name] = 'N/A'
-	
-				elif( self.args.Ralgorithm == 3 ):
-					(e.ratios[t.name],nfeval,status) = optimize.fmin_tnc( wrapper, e.ratios[t.name], fprime=None, approx_grad=True, bounds=ratio_bounds, maxfun=self.args.Rn, messages=0, accuracy=self.args.Rprecision )
-					e.opt_status[t.name] = optimize.tnc.RCSTRINGS[status]
-	
-				elif( self.args.Ralgorithm == 4 ):
-					(e.ratios[t.name],fopt,status) = optimize.fmin_l_bfgs_b( wrapper, e.ratios[t.name], fprime=None, approx_grad=True, bounds=ratio_bounds, maxfun=self.args.Rn, disp=False, epsilon=self.args.Rprecision)
-					e.opt_status[t.name] = status['warnflag']
-	
-				elif( self.args.Ralgorithm == 5 ):
-					(e.ratios[t.name],fopt,direc,iters,funcalls,e.opt_status[t.name]) = optimize.fmin_powell(wrapper, e.ratios[t.name], disp=0, full_output=True, maxfun=self.args.Rn, xtol=self.args.Rprecision)
-	
-				elif( self.args.Ralgorithm == 6 ):
-					(e.ratios[t.name],fopt,iters,funcalls,e.opt_status[t.name]) = optimize.fmin( wrapper, e.ratios[t.name], xtol=self.args.Rprecision, maxfun=self.args.Rn, full_output=True, disp=False)
-	
+
+				if( self.args.titration and i > 0 ):
+					e.ratios[t.name] = e.ratios[self.targets[i-1].name]
+					total = warm
+				else:
+					e.warm_start(t.name)
+					total = budgets[k]
+
+				rows.append(k)
+				initial.append( max( int(total * fraction), 1 ) )
+				remaining[k][i] = total - initial[-1]
+
+			optimize_rows( rows, i, initial )
+
+		if( fraction < 1.0 ):
+			for (k,e) in enumerate(ensembles):
+				if( len(remaining[k]) == 0 ):
+					continue
+
+				score = sum([sum(e.fitness[t.name].itervalues()) for t in self.targets])
+				if( score > cutoff * (1.0 + self.args.Rmargin) ):
+					for i in remaining[k]:
+						e.opt_status[self.targets[i].name] = 'Abandoned'
+					self.abandoned += 1
+					self.saved += sum(remaining[k].values())
+					remaining[k] = dict([(i,0) for i in remaining[k]])
+
+			for (i,t) in enumerate(self.targets):
+				rows = [k for k in xrange(len(ensembles)) if remaining[k].get(i,0) > 0]
+				optimize_rows( rows, i, [remaining[k][i] for k in rows] )
+
+		optimized = [sorted(r.keys()) for r in remaining]
+		for (k,(e,targets)) in enumerate(zip(ensembles,optimized)):
+			for i in targets:
+				t = self.targets[i]
+
 				# set optimization flag!
-				if( (e.opt_status[t.name] != 0) or self.args.Rforce ):
-					e.optimized[t.name] = False
+				e.optimized[t.name] = (e.opt_status[t.name] == 0) and not self.args.Rforce
+
+				self.telemetry.append( tuple([i] + spent[k][i] + [encode_status(e.opt_status[t.name])]) )
+
+			e.dirty[:] = False
+
+		return optimized
+
+	def optimize_target_batch(self, ensembles, indices, rows, t, budgets):
+		"""Optimize the component ratios of many ensembles against a single target at once, by projected gradient descent
+
+		The fitness and its gradient are evaluated for all of the ensembles still being optimized in one call to the plugins, using their
+		calc_fitness_batch() and calc_fitness_gradient_batch() functions. Gradients the plugins can't provide are estimated by finite differences.
+
+		Arguments:
+		ensembles	- A list of mesEnsembles
+		indices		- The ensembles' component indices, see get_component_indices()
+		rows		- List of the positions of the ensembles to optimize
+		t			- The mesTarget to optimize against
+		budgets		- List of the maximum number of iterations for each ensemble
+
+		Returns: (the number of fitness evaluations, the number of iterations) of each ensemble, the ensembles' ratios, fitness and opt_status are set
+		"""
+
+		if( len(rows) == 0 ):
+			return ([],[])
+
+		indices = indices[rows]
+		evaluations = scipy.zeros( len(rows), dtype=int )
+
+		def fitness( subset, ratios ):
+			evaluations[subset] += 1
+			return sum( get_batch_fitness( self.plugins, t, indices[subset], ratios ).values() )
+
+		def gradient( subset, ratios, scores ):
+			partials = get_batch_fitness_gradient( self.plugins, t, indices[subset], ratios )
+			if( partials is not None ):
+				return partials
+
+			# the batch fitness normalizes the ratios, so these are the derivatives along the simplex
+			partials = scipy.zeros( ratios.shape )
+			for j in xrange(ratios.shape[1]):
+				shifted = ratios.copy()
+				shifted[:,j] += 1E-6
+				partials[:,j] = (fitness( subset, shifted ) - scores) / 1E-6
+			return partials
+
+		start = array( [ensembles[k].ratios[t.name] for k in rows], dtype=float )
+		(ratios,iters,converged) = projected_gradient_min( fitness, gradient, start, self.args.Rprecision, array(budgets) )
+
+		scores = get_batch_fitness( self.plugins, t, indices, ratios )
+		evaluations += 1
+		for (n,k) in enumerate(rows):
+			e = ensembles[k]
+			e.ratios[t.name] = ratios[n]
+			for (type,values) in scores.iteritems():
+				e.fitness[t.name][type] = float(values[n])
+
+			if( converged[n] ):
+				e.opt_status[t.name] = 0
+			else:
+				e.opt_status[t.name] = 'Not converged'
+
+		return (evaluations,iters)
+
+	def optimize(self, e, t, algorithm, budget=None, attributes=None):
+		"""Optimize the component ratios of an ensemble against a single target
+
+		Arguments:
+		e			- The mesEnsemble to optimize
+		t			- The mesTarget to optimize against
+		algorithm	- The ratio optimization algorithm to use, see -Ralgorithm
+		budget		- The maximum number of iterations or function evaluations, defaults to -Rn
+		attributes	- The ensemble's attributes for each restraint type, see mesEnsemble.get_fitness()
+
+		Returns: (the number of fitness evaluations, the number of iterations the algorithm reports), the ensemble's ratios, fitness and opt_status are set
+		"""
+
+		if( budget is None ):
+			budget = self.args.Rn
+
+		# set up a bounding array for bounded optimizers
+		ratio_bounds = [(0.0,1.0)] * self.args.size
+
+		# the random searches try every candidate they're given the budget for, the other algorithms report their own iterations
+		evaluations = [0]
+		iters = 0
+
+		# delta function for fitness algorithm to pass to minimization function
+		def wrapper( ratios ):
+			evaluations[0] += 1
+			return sum(e.get_fitness( self.components, self.plugins, t, ratios, attributes ).itervalues())
+
+		# fitness and its gradient with respect to the unnormalized ratios, for gradient-based minimization functions
+		def wrapper_gradient( ratios ):
+			total = sum(ratios)
+			fitness = wrapper( list(ratios) )
+			if( total == 0 ):
+				return (fitness, array([0.0] * self.args.size))
+
+			partials = e.get_fitness_gradient( self.components, self.plugins, t, attributes )
+			weighted = sum([g*w for (g,w) in zip(partials,e.ratios[t.name])])
+			return (fitness, array([(g - weighted) / total for g in partials]))
+
+		# the fitness of many candidate ratio vectors, for the random search minimization functions
+		def wrapper_block( matrix ):
+			if( self.batches[t.name] ):
+				evaluations[0] += len(matrix)
+				indices = array( [[self.components[name].index for name in e.component_names]] * len(matrix) )
+				return sum( get_batch_fitness( self.plugins, t, indices, matrix ).values() )
+			return array( [wrapper( list(ratios) ) for ratios in matrix] )
+
+		if( algorithm in (1,2) and not t.name in self.batches ):
+			self.batches[t.name] = (get_batch_fitness( self.plugins, t, array([[self.components[name].index for name in e.component_names]]), array([e.ratios[t.name]]) ) is not None)
+
+		if( algorithm in (3,4) and not t.name in self.gradients ):
+			wrapper( list(e.ratios[t.name]) )
+			self.gradients[t.name] = (e.get_fitness_gradient( self.components, self.plugins, t, attributes ) is not None)
+
+		if( algorithm == 0 ):
+			e.get_fitness( self.components, self.plugins, t, [1.0/self.args.size] * self.args.size, attributes )
+			e.opt_status[t.name] = 'N/A'
+			evaluations[0] += 1
+
+		elif( algorithm == 1 ):
+			wrapper( blind_random_min( wrapper_block, e.ratios[t.name], budget ) )
+			e.opt_status[t.name] = 'N/A'
+			iters = budget
+
+		elif( algorithm == 2 ):
+			wrapper( localized_random_min( wrapper_block, e.ratios[t.name], self.args.Rprecision, budget ) )
+			e.opt_status[t.name] = 'N/A'
+			iters = budget
+
+		elif( algorithm == 3 and self.gradients[t.name] ):
+			result = optimize.minimize( wrapper_gradient, e.ratios[t.name], method='TNC', jac=True, bounds=ratio_bounds, options={'maxiter':budget,'accuracy':self.args.Rprecision} )
+			(e.ratios[t.name],iters) = (result.x,result.nit)
+			e.opt_status[t.name] = optimize.tnc.RCSTRINGS[result.status]
+
+		elif( algorithm == 3 ):
+			result = optimize.minimize( wrapper, e.ratios[t.name], method='TNC', jac=None, bounds=ratio_bounds, options={'maxiter':budget,'accuracy':self.args.Rprecision} )
+			(e.ratios[t.name],iters) = (result.x,result.nit)
+			e.opt_status[t.name] = optimize.tnc.RCSTRINGS[result.status]
+
+		elif( algorithm == 4 and self.gradients[t.name] ):
+			(e.ratios[t.name],fopt,status) = optimize.fmin_l_bfgs_b( wrapper_gradient, e.ratios[t.name], bounds=ratio_bounds, maxfun=budget, disp=False )
+			e.opt_status[t.name] = status['warnflag']
+			iters = status['nit']
+
+		elif( algorithm == 4 ):
+			(e.ratios[t.name],fopt,status) = optimize.fmin_l_bfgs_b( wrapper, e.ratios[t.name], fprime=None, approx_grad=True, bounds=ratio_bounds, maxfun=budget, disp=False, epsilon=self.args.Rprecision)
+			e.opt_status[t.name] = status['warnflag']
+			iters = status['nit']
+
+		elif( algorithm == 5 ):
+			(e.ratios[t.name],fopt,direc,iters,funcalls,e.opt_status[t.name]) = optimize.fmin_powell(wrapper, e.ratios[t.name], disp=0, full_output=True, maxfun=budget, xtol=self.args.Rprecision)
+
+		elif( algorithm == 6 ):
+			(e.ratios[t.name],fopt,iters,funcalls,e.opt_status[t.name]) = optimize.fmin( wrapper, e.ratios[t.name], xtol=self.args.Rprecision, maxfun=budget, full_output=True, disp=False)
+
+		elif( algorithm == 7 ):
+			systems = get_linear_systems( self.plugins, t, [self.components[name].index for name in e.component_names] )
+
+			# fall back to the truncated newtonian optimizer for non-linear fitness metrics
+			if( systems is None ):
+				return self.optimize(e, t, 3, budget, attributes)
+
+			(ratios,iters,converged) = linear_ratio_min( systems, e.ratios[t.name], self.args.Rprecision, budget )
+			wrapper( ratios )
+
+			if( converged ):
+				e.opt_status[t.name] = 0
+			else:
+				e.opt_status[t.name] = 'Not converged'
+
+		elif( algorithm == 8 ):
+			# ensembles are only optimized one at a time when a plugin can't batch-score the target, see optimize_batch()
+			return self.optimize(e, t, 3, budget, attributes)
+
+		return (evaluations[0],iters)
+
+class Island(Worker):
+	"""Process evolving its own sub-population of ensembles, without waiting for the other islands
+
+	Each generation is the same as in run_ga(), except that the island optimizes its offspring itself. Every -Gmigrate generations copies of
+	the island's best ensembles are sent to the next island, and those received from the previous island replace its worst ones. Every
+	-Greport migrations, and after the last generation, a copy of the whole sub-population is reported to the parent process for the output.
+	"""
+
+	def __init__(self,args,plugins,targets,components,index,parents,generation,inbox,outbox,reports,stop):
+		"""
+		Arguments:
+		args		- The MESMER argument parameters
+		plugins		- A list of the loaded plugin modules
+		targets		- A list of mesTargets
+		components	- A dict of the available mesComponents, keyed by name
+		index		- The island's number
+		parents		- The island's initial parent mesEnsembles, in a population with a get_component_layout() layout
+		generation	- The number of the generation to start from
+		inbox		- Queue of the populations migrating to this island
+		outbox		- Queue of the populations migrating from this island (the next island's inbox), or None for no migration
+		reports		- Queue to send the island's (index, report number, generation, population, parent survival ratio) reports to
+		stop		- Event set by the parent process to stop the island
+		"""
+
+		# the island's generations only ever involve its own ensembles
+		args = copy.copy(args)
+		args.ensembles = len(parents)
+
+		super(Island, self).__init__(args,plugins,targets,components,None,None,None,None)
+		self.index = index
+		self.parents = parents
+		self.generation = generation
+		self.inbox,self.outbox = inbox,outbox
+		self.reports,self.stop = reports,stop
+
+	def run(self):
+		"""Evolve the island's ensembles until the last generation, or until stopped
+
+		Arguments: None
+
+		Returns: None
+		"""
+
+		# forked islands would otherwise all draw the same random numbers, a run restarted at a later generation draws new ones
+		seed = (self.args.seed + self.generation * self.args.islands + self.index) % 2**32
+		random.seed( seed )
+		scipy.random.seed( seed )
+
+		# migrants may never be collected if the next island has already finished
+		if( self.outbox is not None ):
+			self.outbox.cancel_join_thread()
+
+		interval = self.args.Gmigrate * self.args.Greport
+		migrants = int(round(self.args.Gmigrants * self.args.ensembles))
+
+		parents = self.optimize_ensembles( self.parents )
+
+		while( not self.stop.is_set() ):
+			offspring = copy_ensembles( parents )
+
+			evolve_ensembles( self.args, self.components, offspring )
+
+			offspring = self.optimize_ensembles( offspring, get_survival_cutoff(self.targets, parents) )
+
+			(parents,stats) = get_best_ensembles( self.args, self.targets, parents, offspring )
+
+			last = (self.args.Gmax > -1) and (self.generation >= self.args.Gmax)
+
+			if( (self.generation+1) % interval == 0 or last ):
+				self.reports.put( (self.index, self.generation // interval, self.generation, copy_ensembles(parents)[0]._population, stats['ratio'], self.telemetry) )
+				self.telemetry = []
+
+			if( last ):
+				break
+
+			if( (self.generation+1) % self.args.Gmigrate == 0 ):
+				self.migrate( parents, migrants )
+
+			self.generation += 1
+
+		return
+
+	def optimize_ensembles(self, ensembles, cutoff=None):
+		"""Optimize the component ratios of ensembles in this process, see Optimizer.optimize()
+
+		Arguments:
+		ensembles	- A list of mesEnsembles
+		cutoff		- The total score that offspring have to beat to survive selection, see -Rabandon
+
+		Returns: The same list of mesEnsembles
+		"""
+
+		if( self.args.Ralgorithm == 0 and score_ensembles( self.args, self.plugins, self.targets, self.components, ensembles ) ):
+			return ensembles
+
+		if( self.args.Rabandon <= 0 ):
+			cutoff = None
+
+		self.optimize_batch(ensembles, cutoff)
+
+		return ensembles
+
+	def migrate(self, parents, n):
+		"""Send copies of the best ensembles to the next island, and replace the worst ensembles with any that have arrived from the previous one
+
+		Arguments:
+		parents	- The island's mesEnsembles, ordered by score
+		n		- The number of ensembles to send
+
+		Returns: None
+		"""
+
+		if( self.outbox is None or n < 1 ):
+			return
+
+		self.outbox.put( copy_ensembles(parents[:n])[0]._population )
+
+		immigrants = []
+		while( True ):
+			try:
+				immigrants.extend( self.inbox.get(False).get_ensembles() )
+			except Empty:
+				break
+
+		for (e,immigrant) in zip(reversed(parents),immigrants[-n:]):
+			e.assign(immigrant)
+
+		return
+
+class Writer(Thread):
+	"""Background thread running the per-generation output, so that writing files overlaps with the next generation
+
+	At most a bounded number of generations can be waiting to be written, after which the GA loop blocks in put(). The queued output must not call
+	the plugins, see write_generation_output()
+
+	If a queued function fails, the rest of the queue is skipped, and the exception is raised again from the next put() or close() in the GA loop
+	"""
+
+	def __init__(self,maxsize=1,profile=None):
+		super(Writer, self).__init__()
+		self.queue = ThreadQueue(maxsize=maxsize)
+		self.profile = profile
+		self.daemon = True
+
+		# whether a function has failed, and its sys.exc_info() until raised again
+		self.failed = False
+		self.error = None
+
+	def run(self):
+		"""Call the queued functions in order until closed
+
+		Arguments: None
+
+		Returns: None
+		"""
+
+		# a None function is queued by close()
+		for (function,args) in iter(self.queue.get, (None,())):
+			if( self.failed ):
+				continue
+			try:
+				if( self.profile is not None ):
+					with self.profile.phase('output'):
+						function(*args)
 				else:
-					e.optimized[t.name] = True
-	
-				# normalize ensemble ratios for the target
-				e.normalize(t.name)
-	
-			self.oQ.put( e )
-		
+					function(*args)
+			except Exception as e:
+				print_msg( "ERROR:\tBackground output failed: %s" % (e) )
+				(self.failed,self.error) = (True,sys.exc_info())
+
+		return
+
+	def check(self):
+		"""Raise the exception of a failed function again, once"""
+
+		if( self.error is not None ):
+			(error,self.error) = (self.error,None)
+			raise error[0], error[1], error[2]
+
+	def put(self,function,*args):
+		"""Queue a function call, waiting for room in the queue if needed
+
+		Arguments:
+		function	- The function to call
+		args		- The arguments to call it with, which must not be modified afterwards
+
+		Returns: None
+		"""
+
+		self.check()
+		self.enqueue( (function,args) )
+
+	def enqueue(self,item):
+		"""Put an item on the queue, waiting for room if needed"""
+
+		# wait with a timeout, as an untimed wait can't be interrupted by Ctrl-C
+		while( True ):
+			try:
+				self.queue.put( item, True, 0.1 )
+				return
+			except Full:
+				pass
+
+	def close(self):
+		"""Finish all queued output and stop the thread
+
+		Returns: None
+		"""
+
+		self.enqueue( (None,()) )
+		while( self.is_alive() ):
+			self.join( 0.1 )
+
+		self.check()
+
 		return
@@ -1,21 +1,20 @@
 import os
-import shelve
 import Tkinter as tk
 import tkMessageBox
 
-from win_log	import LogWindow
+from .. log_objects	import mesLog
+from win_log		import LogWindow
 
 def openRunDir( w, path ):
 
-	p1 = os.path.join(path,'mesmer_log.db')
-	p2 = os.path.join(path,'mesmer_log.db.db') # some DB schemes do this
-
-	if not os.access(p1, os.R_OK) and not os.access(p2, os.R_OK):
+	try:
+		w.resultsDB = mesLog( path )
+	except:
 		tkMessageBox.showerror("Error","Could not find a results DB in \"%s\"" % path,parent=w)
 		return
 
 	w.path = path
-	w.resultsDBPath = p1
+	w.resultsDBPath = path
 	w.activeDir.set(path)
 	w.currentSelection = [None,None,None]
 	w.openLogButton.config(state=tk.NORMAL)
@@ -29,22 +28,21 @@ def openRunDir( w, path ):
 def updateGenerationList( w ):
 
 	try:
-		w.resultsDB = shelve.open( w.resultsDBPath, 'r' )
+		records = w.resultsDB.read( w.generationsList.size() )
 	except Exception as e:
 		w.master.config(cursor='')
-		tkMessageBox.showerror("Error",'Error opening results DB: %s' % (e),parent=w)
+		tkMessageBox.showerror("Error",'Error reading results DB: %s' % (e),parent=w)
 		raise e
 
-	# append new generations to the list
-	if(w.resultsDB.has_key('ensemble_stats')):
-		for i in range(w.generationsList.size(),len(w.resultsDB['ensemble_stats'])):
-			string = "%s%s%s%s" % (
-			"%05i".ljust(14) % i,
-			"%.3e".ljust(6) % w.resultsDB['ensemble_stats'][i][0][0],
-			"%.3e".ljust(6) % w.resultsDB['ensemble_stats'][i][0][1],
-			"%.3e".ljust(6) % w.resultsDB['ensemble_stats'][i][0][2]
-			)
-			w.generationsList.insert(tk.END, string )
+	# append only the new generations to the list
+	for (i,record) in enumerate(records,w.generationsList.size()):
+		string = "%s%s%s%s" % (
+		"%05i".ljust(14) % i,
+		"%.3e".ljust(6) % record['ensemble_stats'][0][0],
+		"%.3e".ljust(6) % record['ensemble_stats'][0][1],
+		"%.3e".ljust(6) % record['ensemble_stats'][0][2]
+		)
+		w.generationsList.insert(tk.END, string )
 
 	return
 
@@ -146,7 +146,7 @@ def plotAttributes( w ):
 			return
 
 def plotHistogram( w ):
-	if( not w.resultsDB.has_key('ensemble_stats') ):
+	if( len(w.resultsDB) == 0 ):
 		return
 
 	generation_count,target_name,data_type = w.currentSelection
@@ -159,12 +159,12 @@ def plotHistogram( w ):
 		tkMessageBox.showerror("Error","Could not import matplotlib's pylab",parent=w)
 		return
 
-	n, bins, patches = P.hist(w.resultsDB['ensemble_stats'][generation_count]['scores'], 50, normed=1, histtype='stepfilled')
+	n, bins, patches = P.hist(w.resultsDB.get(generation_count)['ensemble_stats']['scores'], 50, normed=1, histtype='stepfilled')
 	P.setp(patches, 'facecolor', 'r', 'alpha', 0.75)
 	P.show()
 
 def plotScoreProgress( w ):
-	if not w.resultsDB.has_key('ensemble_stats'):
+	if( len(w.resultsDB) == 0 ):
 		return
 
 	try:
@@ -174,7 +174,7 @@ def plotScoreProgress( w ):
 		return
 
 	generations, best_scores, avg_scores, score_deviations = [],[],[],[]
-	for (i,(scores,ratio,targets)) in enumerate(w.resultsDB['ensemble_stats']):
+	for (i,(scores,ratio,targets)) in enumerate([record['ensemble_stats'] for record in w.resultsDB.read()]):
 		generations.append( i )
 		best_scores.append( scores[0] )
 		avg_scores.append( scores[1] )
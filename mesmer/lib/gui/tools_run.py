@@ -1,6 +1,5 @@
 import os
 import sys
-import shelve
 import shutil
 import time
 import Tkinter as tk
@@ -10,6 +9,7 @@ from subprocess		import Popen,PIPE,STDOUT
 from threading		import Thread
 from Queue			import Queue, Empty
 
+from .. log_objects	import mesLog
 from tools_setup	import makeMESMERArgsFromWindow,makeStringFromArgs
 from tools_analysis	import openLogWindow,updateGenerationList
 from win_analysis	import AnalysisWindow
@@ -84,8 +84,8 @@ def connectToRun( w, path, pHandle ):
 		return
 
 	try: # try for ten seconds to find results DB
-		w.resultsDBPath = os.path.join(path,'mesmer_log.db')
-		w.resultsDB = shelve.open( w.resultsDBPath, 'r' )
+		w.resultsDBPath = path
+		w.resultsDB = mesLog( w.resultsDBPath )
 	except:
 		w.updateHandle = w.after( 1000, connectToRun, *(w,path,pHandle) )
 		return
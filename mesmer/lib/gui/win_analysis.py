@@ -1,5 +1,4 @@
 import os
-import shelve
 import Tkinter as tk
 import tkFont
 import tkFileDialog
@@ -90,12 +89,12 @@ class AnalysisWindow(tk.Frame):
 		self.currentSelection[0] = int(self.generationsList.curselection()[0])
 
 		self.targetsList.delete(0, tk.END)
-		for name in self.resultsDB['ensemble_stats'][self.currentSelection[0] ][2]:
+		for name in self.resultsDB.get( self.currentSelection[0] )['ensemble_stats'][2]:
 			string = "%s%s%s%s" % (
 				name[:14].ljust(14),
-				"%.3e".ljust(6) % self.resultsDB['ensemble_stats'][ self.currentSelection[0] ][2][name][0],
-				"%.3e".ljust(6) % self.resultsDB['ensemble_stats'][ self.currentSelection[0] ][2][name][1],
-				"%.3e".ljust(6) % self.resultsDB['ensemble_stats'][ self.currentSelection[0] ][2][name][2]
+				"%.3e".ljust(6) % self.resultsDB.get( self.currentSelection[0] )['ensemble_stats'][2][name][0],
+				"%.3e".ljust(6) % self.resultsDB.get( self.currentSelection[0] )['ensemble_stats'][2][name][1],
+				"%.3e".ljust(6) % self.resultsDB.get( self.currentSelection[0] )['ensemble_stats'][2][name][2]
 				)
 			self.targetsList.insert(tk.END, string )
 
@@ -109,19 +108,19 @@ class AnalysisWindow(tk.Frame):
 		if(len(self.targetsList.curselection())<1):
 			return
 
-		for (i,name) in enumerate(self.resultsDB['ensemble_stats'][ self.currentSelection[0] ][2].keys()):
+		for (i,name) in enumerate(self.resultsDB.get( self.currentSelection[0] )['ensemble_stats'][2].keys()):
 			if(i == int(self.targetsList.curselection()[0])):
 				self.currentSelection[1] = name
 
 		self.restraintsList.delete(0, tk.END)
-		for type in self.resultsDB['restraint_stats'][ self.currentSelection[0] ]:
+		for type in self.resultsDB.get( self.currentSelection[0] )['restraint_stats']:
 			if(type == 'Total'):
 				break
 			string = "%s%s%s%s" % (
 			type.ljust(14),
-			"%.3e".ljust(6) % self.resultsDB['restraint_stats'][ self.currentSelection[0] ][type][ self.currentSelection[1] ][0],
-			"%.3e".ljust(6) % self.resultsDB['restraint_stats'][ self.currentSelection[0] ][type][ self.currentSelection[1] ][1],
-			"%.3e".ljust(6) % self.resultsDB['restraint_stats'][ self.currentSelection[0] ][type][ self.currentSelection[1] ][2]
+			"%.3e".ljust(6) % self.resultsDB.get( self.currentSelection[0] )['restraint_stats'][type][ self.currentSelection[1] ][0],
+			"%.3e".ljust(6) % self.resultsDB.get( self.currentSelection[0] )['restraint_stats'][type][ self.currentSelection[1] ][1],
+			"%.3e".ljust(6) % self.resultsDB.get( self.currentSelection[0] )['restraint_stats'][type][ self.currentSelection[1] ][2]
 			)
 			self.restraintsList.insert(tk.END, string )
 
@@ -135,7 +134,7 @@ class AnalysisWindow(tk.Frame):
 		if(len(self.restraintsList.curselection())<1):
 			return
 
-		for (i,type) in enumerate(self.resultsDB['restraint_stats'][ self.currentSelection[0] ].keys()):
+		for (i,type) in enumerate(self.resultsDB.get( self.currentSelection[0] )['restraint_stats'].keys()):
 			if(i == int(self.restraintsList.curselection()[0])):
 				self.currentSelection[2] = type
 
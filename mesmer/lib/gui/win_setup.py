@@ -183,7 +183,7 @@ class SetupWindow(tk.Frame):
 		self.pluginExtrasCheck.set(1) #enabled by default
 		self.optimizationStateCheck = tk.IntVar()
 		self.optMethod			= tk.IntVar()
-		self.optMethodOptions = ('None','Blind Random','Local Random','Truncated Newtonian','L-BFGS-B','Powell','Simplex')
+		self.optMethodOptions = ('None','Blind Random','Local Random','Truncated Newtonian','L-BFGS-B','Powell','Simplex','Least Squares','Batched Gradient')
 		self.optMethodOption	= tk.StringVar()
 		self.optTolerance		= tk.DoubleVar()
 		self.optIterations		= tk.IntVar()
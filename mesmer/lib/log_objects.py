@@ -0,0 +1,176 @@
+import os
+import struct
+import cPickle as pickle
+
+from exceptions			import *
+
+# the record data and index files of a run log, in the run's results directory
+_MESMER_LOG_DATA_FILE	= 'mesmer_log.dat'
+_MESMER_LOG_INDEX_FILE	= 'mesmer_log.idx'
+
+# each index entry is the (offset,length) of a record in the data file
+_INDEX_FORMAT = '<qq'
+_INDEX_SIZE = struct.calcsize(_INDEX_FORMAT)
+
+class mesLog:
+	"""
+	Append-only log of a MESMER run, with one record per generation
+
+	Records are pickled one after another into a data file, following a header record containing the run arguments.
+	An index file of fixed-size (offset,length) entries is appended to after each record is complete, so that readers
+	(e.g. the GUI, while the run is in progress) can find and fetch any range of generations without reading the others.
+	"""
+
+	def __init__(self, path):
+		"""
+		Open the log of an existing run
+
+		Args:
+			path (string): The run's results directory
+
+		Raises:
+			mesSetupError: If the directory does not contain a log
+		"""
+
+		self.data_path = os.path.join(path,_MESMER_LOG_DATA_FILE)
+		self.index_path = os.path.join(path,_MESMER_LOG_INDEX_FILE)
+
+		if( not os.access(self.data_path, os.R_OK) or not os.access(self.index_path, os.R_OK) ):
+			raise mesSetupError("ERROR:\tCould not find a MESMER run log in \"%s\"" % path)
+
+		# records never change once written, so keep the ones already read
+		self._records = {}
+
+		return
+
+	@staticmethod
+	def create(path, args):
+		"""
+		Create a new, empty log
+
+		Args:
+			path (string): The run's results directory
+			args (argparse namespace): MESMER argument parameters, saved as the log header
+
+		Returns: mesLog
+		"""
+
+		f = open( os.path.join(path,_MESMER_LOG_DATA_FILE), 'wb' )
+		pickle.dump( args, f, pickle.HIGHEST_PROTOCOL )
+		f.close()
+
+		open( os.path.join(path,_MESMER_LOG_INDEX_FILE), 'wb' ).close()
+
+		return mesLog(path)
+
+	def __len__(self):
+		return os.path.getsize(self.index_path) // _INDEX_SIZE
+
+	def get_args(self):
+		"""Get the run arguments saved in the log header"""
+
+		f = open( self.data_path, 'rb' )
+		try:
+			return pickle.load(f)
+		finally:
+			f.close()
+
+	def append(self, record):
+		"""
+		Append a generation's record to the end of the log
+
+		Args:
+			record (dict): The generation's statistics, must be picklable
+
+		Returns: None
+		"""
+
+		data = pickle.dumps( record, pickle.HIGHEST_PROTOCOL )
+
+		f = open( self.data_path, 'ab' )
+		f.seek(0, os.SEEK_END)
+		offset = f.tell()
+		f.write(data)
+		f.close()
+
+		# only index the record once it has been written in full, after any partly written entry of a run that was killed
+		f = open( self.index_path, 'r+b' )
+		f.seek( len(self) * _INDEX_SIZE )
+		f.truncate()
+		f.write( struct.pack(_INDEX_FORMAT, offset, len(data)) )
+		f.close()
+
+		return
+
+	def read(self, first=0, last=None):
+		"""
+		Read a range of generation records
+
+		Args:
+			first (int): The first generation to read
+			last (int): The generation after the last one to read, defaults to the most recent generation logged
+
+		Returns: list of records
+		"""
+
+		if( last is None or last > len(self) ):
+			last = len(self)
+
+		missing = [i for i in xrange(first,last) if i not in self._records]
+		if( len(missing) > 0 ):
+			(start,stop) = (missing[0],missing[-1]+1)
+
+			f = open( self.index_path, 'rb' )
+			f.seek( start * _INDEX_SIZE )
+			index = f.read( (stop-start) * _INDEX_SIZE )
+			f.close()
+			entries = [struct.unpack_from(_INDEX_FORMAT, index, i*_INDEX_SIZE) for i in xrange(stop-start)]
+
+			# the records are contiguous, so fetch them all at once
+			base = entries[0][0]
+			f = open( self.data_path, 'rb' )
+			f.seek( base )
+			data = f.read( entries[-1][0] + entries[-1][1] - base )
+			f.close()
+
+			for (i,(offset,length)) in enumerate(entries):
+				self._records[start+i] = pickle.loads( data[offset-base:offset-base+length] )
+
+		return [self._records[i] for i in xrange(first,last)]
+
+	def get(self, generation):
+		"""Get a single generation's record, see read()"""
+
+		return self.read(generation,generation+1)[0]
+
+	def truncate(self, length):
+		"""
+		Discard every record after the first length generations, e.g. those logged after the checkpoint a run is restarted from
+
+		Args:
+			length (int): The number of generation records to keep
+
+		Returns: None
+		"""
+
+		if( length >= len(self) ):
+			return
+
+		f = open( self.index_path, 'r+b' )
+		f.seek( length * _INDEX_SIZE )
+		(offset,size) = struct.unpack( _INDEX_FORMAT, f.read(_INDEX_SIZE) )
+		f.truncate( length * _INDEX_SIZE )
+		f.close()
+
+		f = open( self.data_path, 'r+b' )
+		f.truncate( offset )
+		f.close()
+
+		for i in [i for i in self._records if i >= length]:
+			del self._records[i]
+
+		return
+
+	def close(self):
+		self._records = {}
+		return
@@ -1,96 +1,286 @@
-from random import gauss
+import scipy
+
+from scipy.optimize import nnls
 
 # Reference: James C. Spall, Handbook of Computational Statistics (2004), pgs 177-178
 # see: http://www.jhuapl.edu/spsa/PDF-SPSA/Handbook04_StochasticOptimization.pdf
 # also http://fedc.wiwi.hu-berlin.de/xplore/ebooks/html/csa/node51.html
 
-def blind_random_min( fitFunc, startVec, stdDev, maxIter, allowNeg=False ):
+def blind_random_min( fitFunc, startVec, maxIter, blockSize=32 ):
 	"""
-	Minimizes the fitFunc function return value by blind stochastic modification of its input vector
+	Minimizes the fitFunc function return value by blind random search over normalized vectors
 	See James C. Spall, Handbook of Computational Statistics (2004), pgs 177-178
-	
+
+	Candidates are drawn uniformly from the simplex (a flat Dirichlet distribution), independently of the current best vector, and scored in blocks.
+
 	Returns the optimized vector.
-	
+
 	Arguments:
-	fitFunc		- The function to be minimized, must take a single input vector (list) and return a single float value
+	fitFunc		- The function to be minimized, must take a K x size array of candidate vectors and return an array of their K float values
 	startVec	- List, the starting coefficient vector
-	stdDev		- Float, the gaussian standard dev. to be used in the creation of the perturbation vector
-	maxIter		- Integer, the number of iterations to optimize the function over
-	allowNeg	- Boolean, are negative perturbation vector components allowed?
+	maxIter		- Integer, the number of candidate vectors to try
+	blockSize	- Integer, the number of candidate vectors to score at once
 	"""
 
 	vecSize = len(startVec)
-	
-	# currVec is the vector that we will perturb
-	currVec = startVec[:]
-	
-	bestScore = fitFunc( currVec )
-	
-	for i in range( maxIter ):
-		# make a copy of our old vector
-		oldVec = currVec[:]
-	
-		# modify our current vector by a gaussian random
-		for j in range( vecSize ):
-			currVec[ j ] = gauss(currVec[ j ], stdDev)
-			
-			if (currVec[ j ] < 0) and (not allowNeg):
-				currVec[ j ] = 0.0
-		
-		# see if our new vector has minimized our loss function
-		testScore = fitFunc( currVec )
-		
-		if (testScore < bestScore):
-			bestScore = testScore
-		else: # if we've not improved, reset
-			newVec = oldVec[:]
-			
-	return newVec
-			
-def localized_random_min( fitFunc, startVec, stdDev, maxIter, allowNeg=False ):
+
+	bestVec = normalize_rows( scipy.array([startVec],dtype=float) )[0]
+	bestScore = fitFunc( bestVec[scipy.newaxis] )[0]
+
+	done = 0
+	while( done < maxIter ):
+		block = scipy.random.dirichlet( scipy.ones(vecSize), min(blockSize,maxIter-done) )
+		done += len(block)
+
+		# see if the best candidate has minimized our loss function
+		scores = fitFunc( block )
+		best = scores.argmin()
+		if (scores[best] < bestScore):
+			(bestVec,bestScore) = (block[best],scores[best])
+
+	return list(bestVec)
+
+def localized_random_min( fitFunc, startVec, stdDev, maxIter, allowNeg=False, blockSize=8 ):
 	"""
 	Minimizes the fitFunc function return value by a localized stochastic modification of its input vector
 	See James C. Spall, Handbook of Computational Statistics (2004), pgs 177-178
-	
+
+	Candidates are gaussian perturbations of the current best vector, normalized, and scored in blocks. After a perturbation improves the vector, half of
+	the next block repeats it 1, 2, 3... times over, as successive iterations would.
+
 	Returns the optimized vector.
-	
+
 	Arguments:
-	fitFunc		- The function to be minimized, must take a single input vector (list) and return a single float value
+	fitFunc		- The function to be minimized, must take a K x size array of candidate vectors and return an array of their K float values
 	startVec	- List, the starting coefficient vector
 	stdDev		- Float, the gaussian standard dev. to be used in the creation of the perturbation vector
-	maxIter		- Integer, the number of iterations to optimize the function over
+	maxIter		- Integer, the number of candidate vectors to try
 	allowNeg	- Boolean, are negative perturbation vector components allowed?
+	blockSize	- Integer, the number of candidate vectors to score at once
+	"""
+
+	vecSize = len(startVec)
+
+	currVec = normalize_rows( scipy.array([startVec],dtype=float) )[0]
+	bestScore = fitFunc( currVec[scipy.newaxis] )[0]
+	pertVec = None
+
+	done = 0
+	while( done < maxIter ):
+		perts = scipy.random.normal( 0.0, stdDev, (min(blockSize,maxIter-done),vecSize) )
+		done += len(perts)
+
+		# keep going in the direction of a successful perturbation, as repeating it would, for half of the block
+		steps = scipy.ones( len(perts) )
+		if( pertVec is not None ):
+			repeats = max( len(perts) // 2, 1 )
+			steps[:repeats] = scipy.arange( 1, repeats+1 )
+			perts[:repeats] = steps[:repeats,scipy.newaxis] * pertVec
+
+		block = currVec + perts
+		if( not allowNeg ):
+			block = scipy.maximum( block, 0.0 )
+		block = normalize_rows( block )
+
+		# see if the function value for the best perturbed vector is smaller than our previous attempt
+		scores = fitFunc( block )
+		best = scores.argmin()
+		if ( scores[best] < bestScore ):
+			(currVec,bestScore,pertVec) = (block[best],scores[best],perts[best] / steps[best])
+		else: # our perturbation vectors are no good, get rid of them
+			pertVec = None
+
+	return list(currVec)
+
+def normalize_rows( matrix ):
+	"""
+	Scale each row of a matrix to sum to one, setting rows that sum to zero to an even share
+
+	Returns the normalized array.
+
+	Arguments:
+	matrix	- N x size array of vectors
+	"""
+
+	totals = matrix.sum(1)
+	matrix[totals == 0] = 1.0
+	totals[totals == 0] = matrix.shape[1]
+
+	return matrix / totals[:,scipy.newaxis]
+
+def linear_ratio_min( systems, startVec, precision, maxIter ):
+	"""
+	Minimizes the sum of linear least-squares restraint fitnesses (see mesPluginBasic.get_linear_system) over non-negative, normalized ratios
+	Each iteration solves a single non-negative least squares problem, with the sum-to-one constraint added as a heavily-weighted row.
+	Restraint scaling factors are linearized about the current ratios (Gauss-Newton), and norm 1 (e.g. RMS) terms are majorized by a weighted norm 2 term.
+	Steps that would increase the fitness are shortened, so the returned vector never scores worse than the starting vector.
+
+	Returns (the optimized vector, the number of iterations, convergence flag).
+
+	Arguments:
+	systems		- List of (weight, system) tuples, one per restraint, where system is the dict from the plugin's get_linear_system()
+	startVec	- List, the starting ratio vector
+	precision	- Float, the relative change in fitness at which to stop iterating
+	maxIter		- Integer, the maximum number of iterations
 	"""
-	
+
 	vecSize = len(startVec)
-	
-	pertVec = [0.0] * vecSize
-	currVec = startVec[:]
-
-	bestScore = fitFunc( currVec )
-	
-	def vec_add( vec1, vec2 ):
-		vecOut = vec1[:]
-		for i in range(len(vec1)):
-			vecOut[ i ] += vec2[ i ]
-		return vecOut
-	
-	for i in range( maxIter ):
-				
-		# add our current vector to our existing oe
-		newVec = vec_add( currVec, pertVec )
-		
-		for j in range( vecSize ):
-			if (newVec[ j ] < 0) and (not allowNeg):
-				newVec[ j ] = 0.0
-		
-		# see if the function value for the perturbed vector is smaller than our previous attempt
-		testScore = fitFunc( newVec )
-		if ( testScore < bestScore ):
-			currVec = newVec
-			bestScore = testScore
-		else: # our perturbation vector is no good, get rid of it
-			for j in range(vecSize):
-				pertVec[j] = gauss(0, stdDev)
-					
-	return currVec
+
+	# the projected restraint values and component matrices don't change between iterations
+	projected = [(weight,system,scipy.dot(system['P'],system['b']),scipy.dot(system['P'],system['A'])) for (weight,system) in systems]
+	fitted = [(scipy.dot(system.get('Q',system['P']),system['b']),scipy.dot(system.get('Q',system['P']),system['A'])) for (weight,system) in systems]
+	nScales = len([system for (weight,system) in systems if system['scale']])
+
+	def get_terms( vec ):
+		fitness = 0.0
+		terms = []
+		for ((weight,system,b,A),(Qb,QA)) in zip(projected,fitted):
+			f = scipy.dot(A,vec)
+
+			# the best scale for a given set of ratios has a closed form
+			scale = 1.0
+			if( system['scale'] ):
+				g = scipy.dot(QA,vec)
+				a = scipy.dot(g,g)
+				scale = scipy.dot(g,Qb) / a if a > 0 else 0.0
+
+			norm = scipy.sqrt( scipy.sum(scipy.square(b - (scale * f))) )
+			terms.append( (f,scale,norm) )
+			fitness += weight * system['coefficient'] * norm**system['norm']
+
+		return (fitness,terms)
+
+	currVec = scipy.array(startVec,dtype=float)
+	currVec /= currVec.sum()
+	(bestScore,terms) = get_terms( currVec )
+
+	i = 0
+	while( i < maxIter ):
+		i += 1
+
+		# stack the restraints' weighted systems, with an extra column for each restraint's scale
+		rows,values,j = [],[],vecSize
+		for ((weight,system,b,A),(f,scale,norm)) in zip(projected,terms):
+			alpha = weight * system['coefficient']
+			if( system['norm'] == 1 ):
+				alpha /= 2.0 * max(norm, 1E-12)
+
+			block = scipy.zeros( (len(b),vecSize+nScales) )
+			block[:,:vecSize] = scale * A
+			if( system['scale'] ):
+				block[:,j] = f
+				b = b + (scale * f)
+				j += 1
+
+			rows.append( scipy.sqrt(alpha) * block )
+			values.append( scipy.sqrt(alpha) * b )
+
+		matrix = scipy.vstack( rows )
+		penalty = 1E3 * max(1.0, scipy.fabs(matrix).max())
+		sumRow = scipy.zeros( vecSize+nScales )
+		sumRow[:vecSize] = penalty
+		matrix = scipy.vstack( (matrix, sumRow) )
+		values = scipy.concatenate( values + [[penalty]] )
+
+		newVec = nnls( matrix, values )[0][:vecSize]
+		if( newVec.sum() <= 0 ):
+			break
+		newVec /= newVec.sum()
+
+		# each step should not increase the fitness, so backtrack towards the current ratios if it does
+		for step in range(5):
+			(testScore,newTerms) = get_terms( newVec )
+			if( testScore <= bestScore ):
+				break
+			newVec = (currVec + newVec) / 2.0
+		else:
+			break
+
+		converged = (bestScore - testScore) <= precision * bestScore
+		currVec,bestScore,terms = newVec,testScore,newTerms
+
+		if( converged ):
+			return (list(currVec), i, True)
+
+	return (list(currVec), i, False)
+
+def simplex_projection( matrix ):
+	"""
+	Get the closest (Euclidean) normalized, non-negative vector to each row of a matrix
+	See Duchi et al., Efficient Projections onto the l1-Ball for Learning in High Dimensions (2008)
+
+	Returns an array of the projected rows.
+
+	Arguments:
+	matrix	- N x size array of vectors
+	"""
+
+	sortMat = -scipy.sort( -matrix, 1 )
+	cumSums = scipy.cumsum( sortMat, 1 ) - 1.0
+	counts = scipy.arange( 1, matrix.shape[1]+1 )
+
+	# the number of components left non-zero by each projection
+	kept = (sortMat - cumSums / counts > 0).sum(1)
+	theta = cumSums[scipy.arange(len(matrix)),kept-1] / kept
+
+	return scipy.maximum( matrix - theta[:,scipy.newaxis], 0.0 )
+
+def projected_gradient_min( fitFunc, gradFunc, startMat, precision, maxIter ):
+	"""
+	Minimizes many functions of normalized, non-negative vectors at once, by projected gradient descent with a separate step length for each vector
+	Each iteration takes a single step for every vector that hasn't converged or run out of iterations, so the functions are always evaluated for many vectors in one call.
+	Step lengths double after each successful step, while steps that would increase the function value are rejected and retried at half the length,
+	so the returned vectors never score worse than the starting vectors.
+
+	Returns (the optimized vectors, the number of iterations of each, convergence flags).
+
+	Arguments:
+	fitFunc		- The function to be minimized, must take an array of row indices and the matching N x size array of vectors and return an array of N float values
+	gradFunc	- The function's gradient, taking the row indices, the vectors and their function values, and returning an N x size array of partial derivatives
+	startMat	- N x size array, the starting vectors
+	precision	- Float, the largest change in any component of a vector by a successful step at which to stop iterating
+	maxIter		- Integer or array of N integers, the maximum number of iterations for each vector
+	"""
+
+	currMat = normalize_rows( scipy.array(startMat,dtype=float) )
+
+	n = len(currMat)
+	maxIter = scipy.zeros(n,dtype=int) + maxIter
+	iters = scipy.zeros(n,dtype=int)
+	converged = scipy.zeros(n,dtype=bool)
+
+	rows = scipy.arange(n)
+	bestScores = scipy.array( fitFunc(rows, currMat), dtype=float )
+	grads = scipy.array( gradFunc(rows, currMat, bestScores), dtype=float )
+
+	# the first step could move a whole component's ratio
+	steps = 1.0 / scipy.maximum( scipy.fabs(grads).max(1), 1E-12 )
+
+	active = (iters < maxIter)
+	while( active.any() ):
+		rows = scipy.flatnonzero( active )
+
+		newMat = simplex_projection( currMat[rows] - steps[rows,scipy.newaxis] * grads[rows] )
+		testScores = scipy.array( fitFunc(rows, newMat), dtype=float )
+		iters[rows] += 1
+
+		# a step that no longer changes the vector means it's at a minimum on the simplex
+		converged[rows[scipy.fabs(newMat - currMat[rows]).max(1) <= 1E-12]] = True
+
+		better = (testScores < bestScores[rows])
+		accepted = rows[better]
+		converged[accepted] |= scipy.fabs(newMat[better] - currMat[accepted]).max(1) <= precision
+
+		currMat[accepted] = newMat[better]
+		bestScores[accepted] = testScores[better]
+		steps[accepted] *= 2.0
+		steps[rows[~better]] /= 2.0
+
+		active = ~converged & (iters < maxIter)
+
+		# only the vectors that moved need new gradients
+		moved = accepted[active[accepted]]
+		if( len(moved) > 0 ):
+			grads[moved] = gradFunc(moved, currMat[moved], bestScores[moved])
+
+	return (currMat, iters, converged)
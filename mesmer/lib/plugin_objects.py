@@ -1,5 +1,5 @@
 import os
-import shelve
+import scipy
 import tempfile
 import uuid
 import argparse
@@ -170,19 +170,100 @@ class mesPluginBasic:
 		"""
 		return None
 
+	def calc_fitness_gradient( self, restraint, target_data, ensemble_data, attributes, ratios ):
+		"""(Optional) Calculate the gradient of the fitness with respect to the ratios of a set of attributes
+
+		Always called immediately after calc_fitness() for the same attributes and ratios, so ensemble_data can be reused.
+
+		Args:
+			restraint (mesRestraint): The restraint serving as the template for the sample
+			target_data (variable): The plugin's data storage variable for the target
+			ensemble_data (variable): The plugin's data storage variable for this ensemble
+			attributes (list): List of the mesAttributes previously filled by load_attribute
+			ratios (list): The normalized relative weighting (ratio) of each attribute
+
+		Returns:
+			list: The partial derivative of the fitness score with respect to each ratio, treating them as independent, or None if not available
+		"""
+		return None
+
+	def calc_fitness_batch( self, restraint, target_data, component_index_matrix, ratio_matrix ):
+		"""(Optional) Calculate the fitness of many ensembles against a given restraint in a single call
+
+		Unlike calc_fitness(), no ensemble data is saved, so MESMER will call calc_fitness() for any ensemble that needs it (e.g. for output).
+
+		Args:
+			restraint (mesRestraint): The restraint serving as the template for the sample
+			target_data (variable): The plugin's data storage variable for the target
+			component_index_matrix (array): N x size integer array of the component (database) index of each ensemble's components, see mesAttribute.index
+			ratio_matrix (array): N x size array of the normalized relative weighting (ratio) of each component
+
+		Returns:
+			array: The N numeric fitness scores, or None if the plugin can't batch-score this restraint
+		"""
+		return None
+
+	def calc_fitness_gradient_batch( self, restraint, target_data, component_index_matrix, ratio_matrix ):
+		"""(Optional) Calculate the fitness gradients of many ensembles against a given restraint in a single call, see calc_fitness_gradient()
+
+		Args:
+			restraint (mesRestraint): The restraint serving as the template for the sample
+			target_data (variable): The plugin's data storage variable for the target
+			component_index_matrix (array): N x size integer array of the component (database) index of each ensemble's components, see mesAttribute.index
+			ratio_matrix (array): N x size array of the normalized relative weighting (ratio) of each component
+
+		Returns:
+			array: N x size partial derivatives of each fitness score with respect to each ratio, treating them as independent, or None if not available
+		"""
+		return None
+
+	def get_linear_system( self, restraint, target_data, component_indices ):
+		"""(Optional) Describe the restraint's fitness as a linear least-squares problem in the component ratios
+
+		The fitness must equal coefficient * |P(b - s*Aw)|**norm, where w are the normalized component ratios and s is either 1.0 or, if scale is set, the scaling factor minimizing |Q(b - s*Aw)|.
+
+		Args:
+			restraint (mesRestraint): The restraint to describe
+			target_data (variable): The plugin's data storage variable for the target
+			component_indices (list): The component (database) index of each of the ensemble's components, see mesAttribute.index
+
+		Returns:
+			dict: Containing 'A' (points x size array of component values), 'b' (the restraint values), 'P' (points x points projection and weighting array),
+			'scale' (bool), 'norm' (1 or 2), 'coefficient' (float) and optionally 'Q' (defaults to P), or None if the fitness is not linear in the component ratios
+		"""
+		return None
+
+	def share( self ):
+		"""(Optional) Move data loaded from the component files into storage that can be shared between processes
+
+		Called once after all components have been loaded and before the worker processes are started. No further components will be loaded afterwards.
+
+		Args: None
+
+		Returns: None
+
+		Raises:
+			mesPluginError: Any error that causes the data to not be shared
+		"""
+		pass
+
 	def close( self ):
 		pass
 
 class mesPluginDB( mesPluginBasic ):
-	"""An extended data-handling MESMER plugin that provides access to a persistent database"""
+	"""An extended data-handling MESMER plugin that provides access to a persistent database
+
+	Data saved with put() is flattened into a scratch file of floats, which is memory-mapped read-only on demand, so get() returns
+	slices of the map instead of unpickling a database record.
+	"""
 	
 	def __init__( self, args ):
 		"""Initialize the plugin
 
-		Opens a handle to a shelve database for later usage.		
+		Opens a scratch file to store component data in for later usage.
 	
 		Raises:
-			mesPluginError on failure to make a db connection
+			mesPluginError on failure to create the scratch file
 		"""
 		mesPluginBasic.__init__( self, args )
 		
@@ -194,9 +275,24 @@ class mesPluginDB( mesPluginBasic ):
 		
 		self._db_handle = None
 		try:
-			self._db_handle = shelve.open(self._db_path,'c')
+			self._db_handle = open(self._db_path,'wb')
 		except:
 			raise mesPluginError("Could not create temporary scratch DB to store component data: \"%s\"" % self._db_path)
+
+		# the read-only map of the scratch file, and the number of values written to the file
+		self._db_map = None
+		self._db_length = 0
+
+		# the layout of each put() record, and the record index of any explicitly provided keys
+		self._db_records = []
+		self._db_keys = {}
+
+		# dense per-group matrices of component data, see put_row()
+		self._rows = {}
+
+		# memory-mapped files backing the matrices once they've been shared, see share()
+		self._row_files = {}
+		self._owner = True
 				
 	def __getstate__(self):
 		"""Return the state of plugin, properly closing the db handle temporarily in anticipation of serialization
@@ -217,10 +313,15 @@ class mesPluginDB( mesPluginBasic ):
 		if (self._db_handle != None):
 			self._db_handle.close()
 			self._db_handle = None
-		return self.__dict__
+
+		# the scratch file and shared matrices are re-mapped from their files rather than serialized
+		d = dict(self.__dict__)
+		d['_db_map'] = None
+		d['_rows'] = dict( (group,[None,n] if group in self._row_files else [matrix,n]) for (group,(matrix,n)) in self._rows.iteritems() )
+		return d
 			
 	def __setstate__(self, d):
-		"""Regenerate the plugin, and re-open the db handle
+		"""Regenerate the plugin, and re-map the shared data
 		
 		Args:
 			d (dict): The dictionary representation previously generated by __getstate__()
@@ -231,46 +332,203 @@ class mesPluginDB( mesPluginBasic ):
 		"""
 		self.__dict__ = d
 		
-		# Reconnect to the database
+		# Reconnect to the database, the scratch files remain owned by the original plugin
+		self._owner = False
 		try:
-			self._db_handle = shelve.open(self._db_path,'r')
+			self._map()
 		except:
 			raise mesPluginError("Could not reconnect to scratch DB containing component data: \"%s\"" % self._db_path)
 
+		for (group,(path,shape)) in self._row_files.iteritems():
+			try:
+				self._rows[group][0] = scipy.asarray(scipy.memmap(path, dtype=float, mode='r', shape=shape))
+			except:
+				raise mesPluginError("Could not reconnect to scratch file containing component data: \"%s\"" % path)
+
 	def __del__( self ):
 		try:
 			if (self._db_handle != None):
 				self._db_handle.close()
+			self._db_map = None
 
-			# some db implementations append a .db to the provided path
-			if( os.path.exists(self._db_path)):
-				os.unlink(self._db_path)
-			elif( os.path.exists("%s%s" % (self._db_path,'.db')) ):
-				os.unlink("%s%s" % (self._db_path,'.db'))
+			if( self._owner ):
+				for path in [self._db_path] + [path for (path,shape) in self._row_files.values()]:
+					if( os.path.exists(path) ):
+						os.unlink(path)
 	
 		except AttributeError:
 			pass
 
+	def _map( self ):
+		"""Map the scratch file up to the last value written to it
+
+		Args: None
+
+		Returns: None
+		"""
+		if( self._db_handle != None ):
+			self._db_handle.flush()
+		if( self._db_length > 0 ):
+			self._db_map = scipy.asarray(scipy.memmap(self._db_path, dtype=float, mode='r', shape=(self._db_length,)))
+
+	def _write( self, item, nested=False ):
+		"""Append data to the scratch file, see put()
+
+		Args:
+			item (variable): The data to store
+			nested (bool): Whether the data is a member of a tuple or list, which are only flattened one level deep
+
+		Returns tuple: The layout of the data, used to read it back with _read()
+		"""
+		try:
+			values = scipy.array(item, dtype=float)
+		except (TypeError,ValueError):
+			if( nested or not isinstance(item,(tuple,list)) ):
+				return ('o',item)
+			return (type(item),[self._write(i,True) for i in item])
+
+		if( values.ndim == 0 ):
+			return ('o',item)
+
+		offset = self._db_length
+		self._db_handle.write( values.tostring() )
+		self._db_length += values.size
+		return ('a',(offset,offset+values.size,values.shape))
+
+	def _read( self, record ):
+		"""Read data back from the scratch file
+
+		Args:
+			record (tuple): The layout of the data returned by _write()
+
+		Returns (variable): The data
+		"""
+		(kind,item) = record
+		if( kind == 'a' ):
+			(start,stop,shape) = item
+			if( self._db_map is None or stop > len(self._db_map) ):
+				self._map()
+			return self._db_map[start:stop].reshape(shape)
+		elif( kind == 'o' ):
+			return item
+		return kind([self._read(i) for i in item])
+
 	def put( self, data, key=None ):
 		"""Put some data into storage
+
+		Numbers, arrays and lists of numbers are stored in the scratch file, as are the members of a tuple or list of them (e.g. a spline representation).
+		Anything else is kept in memory as-is.
 		
 		Args:
 			data (variable): The data to store
-			key (defaults to None): If not provided, generates a unique key for the newly-inserted data
+			key (defaults to None): If not provided, the record index of the newly-inserted data is used
 		
-		Returns string: Key for the newly-inserted data
+		Returns int or key: Key for the newly-inserted data
+
+		Raises: mesPluginError if the data has already been shared
 		"""
+		if( self._db_handle == None ):
+			raise mesPluginError("Can not store data after it has been shared")
+
+		self._db_records.append( self._write(data) )
 		if( key == None ):
-			key = uuid.uuid1().hex
-		self._db_handle[key] = data
+			return len(self._db_records)-1
+
+		self._db_keys[key] = len(self._db_records)-1
 		return key
 
 	def get( self, key ):
 		"""Get some data from storage
 		
 		Args:
-			key (string): Key for the data to return
+			key (int or key): Key for the data to return
 			
-		Returns (variable): The data previously stored
+		Returns (variable): The data previously stored, with arrays and lists of numbers returned as read-only arrays
 		"""
-		return self._db_handle[key]
\ No newline at end of file
+		return self._read( self._db_records[self._db_keys.get(key,key)] )
+
+	def put_row( self, group, data, index=None ):
+		"""Put a row of floats into a dense matrix of component data
+
+		Rows of a group are kept in a single contiguous matrix (components x points), so that averaging
+		a set of components is a row-gather instead of a database lookup for each one.
+
+		Args:
+			group (string): Name of the matrix to insert into, e.g. the restraint type
+			data (list): The row of values, must be the same length as all other rows in the group
+			index (int): Row to store the data at, e.g. the attribute's component index. If not provided, the row is appended.
+
+		Returns int: Row index of the newly-inserted data
+
+		Raises: mesPluginError if the row length does not match the rest of the group, or the group has already been shared
+		"""
+		data = scipy.array(data, dtype=float)
+
+		if( group in self._row_files ):
+			raise mesPluginError("Can not add rows to \"%s\" after it has been shared" % group)
+
+		if( group not in self._rows ):
+			self._rows[group] = [scipy.zeros((16,len(data))), 0]
+
+		(matrix,n) = self._rows[group]
+		if( len(data) != matrix.shape[1] ):
+			raise mesPluginError("Row length (%i) does not match that of the other rows in \"%s\" (%i)" % (len(data),group,matrix.shape[1]))
+
+		if( index == None ):
+			index = n
+
+		# grow the matrix by doubling to keep the number of copies small
+		while( index >= len(matrix) ):
+			matrix = scipy.vstack( (matrix,scipy.zeros(matrix.shape)) )
+
+		matrix[index] = data
+		self._rows[group] = [matrix, max(n,index+1)]
+		return index
+
+	def get_rows( self, group ):
+		"""Get the dense matrix of rows previously stored with put_row()
+
+		Args:
+			group (string): Name of the matrix
+
+		Returns (array): The matrix, one row per call to put_row()
+		"""
+		(matrix,n) = self._rows[group]
+		return matrix[:n]
+
+	def share( self ):
+		"""Move the dense matrices of component data into read-only memory-mapped files next to the scratch DB
+
+		Forked worker processes then all read the same pages through the OS page cache, instead of each process gradually
+		acquiring a private copy of the matrices, and serialized copies of the plugin re-map the files instead of carrying the data.
+
+		Args: None
+
+		Returns: None
+
+		Raises: mesPluginError if a scratch file could not be written
+		"""
+		for (group,(matrix,n)) in self._rows.items():
+			if( group in self._row_files ):
+				continue
+
+			path = "%s.%s" % (self._db_path,uuid.uuid1().hex)
+			shape = (n,matrix.shape[1])
+			try:
+				temp = scipy.memmap(path, dtype=float, mode='w+', shape=shape)
+				temp[:] = matrix[:n]
+				temp.flush()
+				del temp
+				self._row_files[group] = (path,shape)
+				self._rows[group] = [scipy.asarray(scipy.memmap(path, dtype=float, mode='r', shape=shape)), n]
+			except:
+				raise mesPluginError("Could not create scratch file to share component data: \"%s\"" % path)
+
+		# the scratch file is complete, so map it once here rather than in each worker process
+		if( self._db_handle != None ):
+			try:
+				self._map()
+				self._db_handle.close()
+				self._db_handle = None
+			except:
+				raise mesPluginError("Could not map scratch DB containing component data: \"%s\"" % self._db_path)
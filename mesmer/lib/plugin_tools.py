@@ -160,6 +160,31 @@ def interpolate_curve( x, int_x, int_y ):
 
 	return scipy.interpolate.splev( x, scipy.interpolate.splrep( int_x, int_y ) )
 
+def average_rows( matrix, index_matrix, ratio_matrix ):
+	"""
+	Get the weighted averages of many sets of rows from a matrix at once
+
+	Returns an N x m array, containing the average of each set of rows
+
+	Arguments:
+	matrix			- array of rows m values wide, e.g. from mesPluginDB.get_rows()
+	index_matrix	- N x size array of integers, the row indices of each set
+	ratio_matrix	- N x size array of floats, the weighting of each row in a set
+	"""
+
+	# create local numpy copies
+	index_matrix,ratio_matrix = scipy.array(index_matrix,dtype=int),scipy.array(ratio_matrix,dtype=float)
+
+	total = ratio_matrix.sum(1)
+	total[total == 0] = 1.0
+
+	# accumulate one column of the index matrix at a time to avoid creating an N x size x m array
+	ret = scipy.zeros( (len(index_matrix),matrix.shape[1]) )
+	for j in range(index_matrix.shape[1]):
+		ret += (ratio_matrix[:,j] / total)[:,scipy.newaxis] * matrix[index_matrix[:,j]]
+
+	return ret
+
 def make_bootstrap_sample( y, y_fit ):
 	"""
 	Return a bootstrap estimate dataset for an experimental curve and associated best estimate
@@ -0,0 +1,127 @@
+import sys
+import resource
+
+from time					import time
+from threading				import Lock
+from contextlib				import contextmanager
+from collections			import OrderedDict
+
+# the CPU time of the calling thread rather than the whole process, where available (Linux)
+_RUSAGE_THREAD = getattr( resource, 'RUSAGE_THREAD', 1 if sys.platform.startswith('linux') else resource.RUSAGE_SELF )
+
+# the plugin functions timed for each restraint type, and whether they score many ensembles in one call
+_PLUGIN_FUNCTIONS = (
+	('calc_fitness',				False,	False),
+	('calc_fitness_batch',			True,	False),
+	('calc_fitness_gradient',		False,	True),
+	('calc_fitness_gradient_batch',	True,	True) )
+
+def cpu_time():
+	"""Get the CPU time used by the calling thread, in seconds"""
+
+	usage = resource.getrusage( _RUSAGE_THREAD )
+	return usage.ru_utime + usage.ru_stime
+
+class mesProfile:
+	"""
+	Wall and CPU time spent in each phase of a MESMER run, and in the plugins' fitness functions for each restraint type
+
+	The times accumulate until collected, e.g. once per generation. Worker processes inherit a copy of the profile when they are started, and
+	send what they have collected back to be merged into the original.
+	"""
+
+	def __init__(self):
+		# phases are timed from several threads, e.g. the background output
+		self.lock = Lock()
+
+		# phase name: [calls,wall,cpu]
+		self.phases = OrderedDict()
+
+		# restraint type: [calls,evaluations,gradients,wall,cpu]
+		self.restraints = {}
+
+		# everything collected so far, for the summary at the end of the run
+		self.totals = {'phases':OrderedDict(), 'restraints':{}}
+
+		return
+
+	@contextmanager
+	def phase(self, name):
+		"""
+		Time the enclosed block of code as part of a phase, e.g. with profile.phase('evolve'):
+
+		Args:
+			name (string): The name of the phase
+
+		Returns: None
+		"""
+
+		(wall,cpu) = (time(),cpu_time())
+		try:
+			yield
+		finally:
+			self.add( {'phases':{name:[1, time()-wall, cpu_time()-cpu]}} )
+
+	def wrap_plugins(self, plugins):
+		"""
+		Time every call of the plugins' fitness functions, counting the ensembles scored
+
+		Args:
+			plugins (list): The loaded plugin modules, which are modified in place
+
+		Returns: None
+		"""
+
+		def wrap( function, batch, gradient ):
+			def timed( restraint, target_data, *args ):
+				(wall,cpu) = (time(),cpu_time())
+				try:
+					return function( restraint, target_data, *args )
+				finally:
+					n = len(args[0]) if batch else 1
+					self.add( {'restraints':{restraint.type:[1, 0 if gradient else n, n if gradient else 0, time()-wall, cpu_time()-cpu]}} )
+			return timed
+
+		for p in plugins:
+			for (name,batch,gradient) in _PLUGIN_FUNCTIONS:
+				if( hasattr(p, name) ):
+					setattr( p, name, wrap(getattr(p, name), batch, gradient) )
+
+		return
+
+	def add(self, times):
+		"""
+		Add to the accumulated times
+
+		Args:
+			times (dict): Containing 'phases' and/or 'restraints' dicts of lists of counts and times to add, as returned by collect()
+
+		Returns: None
+		"""
+
+		with self.lock:
+			for (key,accumulated) in (('phases',self.phases),('restraints',self.restraints)):
+				for (name,values) in times.get(key,{}).iteritems():
+					if( name in accumulated ):
+						accumulated[name] = [a+b for (a,b) in zip(accumulated[name],values)]
+					else:
+						accumulated[name] = list(values)
+
+		return
+
+	def collect(self):
+		"""
+		Get the times accumulated since the last call, and add them to the totals
+
+		Returns: dict containing 'phases' and 'restraints' dicts of lists of counts and times, see __init__()
+		"""
+
+		with self.lock:
+			times = {'phases':self.phases, 'restraints':self.restraints}
+			self.phases,self.restraints = OrderedDict(),{}
+
+		for (key,accumulated) in self.totals.iteritems():
+			for (name,values) in times[key].iteritems():
+				accumulated[name] = [a+b for (a,b) in zip(accumulated.get(name,[0]*len(values)),values)]
+
+		return times
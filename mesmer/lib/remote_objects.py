@@ -0,0 +1,362 @@
+import os
+import copy
+
+from time							import time,sleep
+from threading						import Thread,Lock
+from Queue							import Empty
+from multiprocessing.connection		import Listener,Client,AuthenticationError
+from scipy							import array,int32,inf
+
+from exceptions				import *
+from utility_functions		import print_msg
+from ensemble_objects		import mesEnsemble,mesPopulation,get_component_layout
+from ga_objects				import Worker,_STATUSES,encode_status
+from profile_objects		import mesProfile
+
+def parse_address( address ):
+	"""
+	Split a HOST:PORT network address
+
+	Returns a (host, port) tuple
+
+	Arguments:
+	address	- The address string, the host defaults to the local host only if omitted
+	"""
+
+	(host,sep,port) = address.rpartition(':')
+	try:
+		return (host or '127.0.0.1', int(port))
+	except ValueError:
+		raise mesSetupError("ERROR:\tInvalid network address \"%s\", expected HOST:PORT." % (address))
+
+class Coordinator(Thread):
+	"""Accepts connections from mesmer-worker processes, usually on other hosts, and starts a RemoteWorker thread for each
+
+	Remote workers take chunks of work buffer rows from the Optimizer's queue just like its local Worker processes do
+	"""
+
+	def __init__(self,args,buffer,status,in_queue,out_queue,cutoff,seed):
+		"""
+		Arguments:
+		args		- The MESMER argument parameters
+		buffer		- The Optimizer's shared work buffer mesPopulation
+		status		- The Optimizer's shared optimization status code array
+		in_queue	- Queue of (start,stop) work buffer row chunks to optimize
+		out_queue	- Queue to put (start,stop,elapsed time,abandoned,saved,plugin times,telemetry) tuples of optimized chunks on
+		cutoff		- The Optimizer's shared survival cutoff score array
+		seed		- The Optimizer's shared random seed array
+		"""
+
+		super(Coordinator, self).__init__()
+		self.args = args
+		self.buffer = buffer
+		self.status = status
+		self.iQ = in_queue
+		self.oQ = out_queue
+		self.cutoff = cutoff
+		self.seed = seed
+		self.daemon = True
+
+		# workers on other hosts load the targets and components themselves, so have to be given absolute paths
+		self.setup = copy.copy(args)
+		self.setup.target = [os.path.abspath(f) for f in args.target]
+		self.setup.components = [[os.path.abspath(f) for f in c] for c in args.components]
+
+		# workers have to store the results in the buffer's target and restraint type columns, and look up its component name codes
+		self.layout = {'targets':buffer.layout['targets'], 'types':buffer.layout['types'], 'names':buffer.layout['names']}
+
+		self.workers = []
+
+		try:
+			self.listener = Listener( parse_address(args.listen), authkey=args.authkey )
+		except (IOError,OSError) as e:
+			raise mesSetupError("ERROR:\tCould not listen for remote workers at \"%s\": %s" % (args.listen,e))
+
+		print_msg("INFO:\tListening for remote workers at %s:%i." % self.listener.address)
+
+	def run(self):
+		"""Accept connections until the program exits
+
+		Arguments: None
+
+		Returns: None
+		"""
+
+		while( True ):
+			try:
+				conn = self.listener.accept()
+			except (AuthenticationError,IOError,EOFError) as e:
+				print_msg("WARNING:\tRejected remote worker connection: %s" % (e))
+				continue
+
+			worker = RemoteWorker(self, conn, self.listener.last_accepted)
+			worker.start()
+
+			# forget the workers that have disconnected, as workers may reconnect any number of times
+			self.workers = [w for w in self.workers if w.is_alive()] + [worker]
+
+	def count(self):
+		"""Get the number of remote workers currently taking work"""
+
+		return len([w for w in self.workers if w.ready])
+
+class RemoteWorker(Thread):
+	"""Thread relaying chunks of work buffer rows to a connected mesmer-worker process, and copying back the results
+
+	The worker sends a heartbeat every -heartbeat seconds, which are also checked while it waits for work. If a result or heartbeat doesn't
+	arrive in time, or the connection fails, the connection is abandoned and any chunk the worker held is put back on the queue for another
+	worker to optimize.
+	"""
+
+	def __init__(self,coordinator,conn,address):
+		super(RemoteWorker, self).__init__()
+		self.coordinator = coordinator
+		self.conn = conn
+		self.address = address
+		self.daemon = True
+
+		# whether the worker has finished loading, and is taking work
+		self.ready = False
+
+		# when the worker was last heard from
+		self.heard = None
+
+	def run(self):
+		"""Optimize chunks of ensembles from the input queue on the remote worker until the connection is lost
+
+		Arguments: None
+
+		Returns: None
+		"""
+
+		c = self.coordinator
+
+		try:
+			self.conn.send( (c.setup,c.layout) )
+
+			# wait for the worker to load its targets and components, however long that takes, a worker that can't match the layout says why
+			reply = self.conn.recv()
+			if( reply != 'ready' ):
+				raise EOFError(reply if isinstance(reply,str) else "unexpected reply")
+		except (IOError,EOFError) as e:
+			print_msg("WARNING:\tRemote worker at %s:%i failed to start: %s" % (self.address[0],self.address[1],e))
+			self.conn.close()
+			return
+
+		self.ready = True
+		self.heard = time()
+
+		while( True ):
+			# the queue is closed from under the thread when the program exits
+			try:
+				chunk = c.iQ.get( True, c.args.heartbeat )
+			except Empty:
+				# an idle worker that is gone mustn't be counted on for the next chunks, see Coordinator.count()
+				try:
+					self.listen()
+				except (IOError,EOFError) as e:
+					self.lost(e)
+					break
+				continue
+			except (IOError,EOFError):
+				break
+			if( chunk is None ):
+				break
+
+			(start,stop) = chunk
+			began = time()
+
+			try:
+				self.conn.send( (
+					c.buffer.components[start:stop],
+					c.buffer.ratios[start:stop],
+					c.buffer.optimized[start:stop],
+					c.buffer.dirty[start:stop],
+					c.status[start:stop],
+					c.cutoff[0],
+					c.seed[0]+start) )
+				(ratios,fitness,optimized,dirty,status,abandoned,saved,times,telemetry) = self.receive()
+
+			except (IOError,EOFError) as e:
+				# let another worker optimize the chunk
+				self.lost(e)
+				c.iQ.put( (start,stop) )
+				break
+
+			c.buffer.ratios[start:stop] = ratios
+			c.buffer.fitness[start:stop] = fitness
+			c.buffer.optimized[start:stop] = optimized
+			c.buffer.dirty[start:stop] = dirty
+			c.status[start:stop] = status
+
+			c.oQ.put( (start,stop,time()-began,abandoned,saved,times,telemetry) )
+
+		self.ready = False
+		self.conn.close()
+
+		return
+
+	def lost(self,e):
+		"""Stop counting on the worker after its connection failed with error e"""
+
+		self.ready = False
+		print_msg("WARNING:\tLost remote worker at %s:%i: %s" % (self.address[0],self.address[1],e))
+
+	def receive(self):
+		"""Wait for the next message from the worker other than a heartbeat
+
+		Raises:
+		IOError if no message arrives within three heartbeat intervals
+		"""
+
+		while( True ):
+			if( not self.conn.poll( 3 * self.coordinator.args.heartbeat ) ):
+				raise IOError("no heartbeat for %.0f seconds" % (3 * self.coordinator.args.heartbeat))
+
+			message = self.conn.recv()
+			self.heard = time()
+			if( message != 'heartbeat' ):
+				return message
+
+	def listen(self):
+		"""Read the heartbeats of an idle worker
+
+		Raises:
+		IOError if the last heartbeat is more than three heartbeat intervals old
+		EOFError if the connection was closed, or the worker sent something else
+		"""
+
+		while( self.conn.poll(0) ):
+			if( self.conn.recv() != 'heartbeat' ):
+				raise EOFError("unexpected message")
+			self.heard = time()
+
+		if( time()-self.heard > 3 * self.coordinator.args.heartbeat ):
+			raise IOError("no heartbeat for %.0f seconds" % (time()-self.heard))
+
+def connect_worker( address, authkey, timeout=60 ):
+	"""
+	Connect a mesmer-worker to a coordinating MESMER run, retrying while the run is starting up
+
+	Returns a tuple of the connection, and the run's argument parameters and work buffer layout (see Coordinator)
+
+	Arguments:
+	address	- The run's (host, port) -listen address
+	authkey	- The run's -authkey
+	timeout	- The number of seconds to keep retrying for
+	"""
+
+	began = time()
+	while( True ):
+		try:
+			conn = Client( address, authkey=authkey )
+			break
+		except (IOError,OSError) as e:
+			if( time()-began > timeout ):
+				raise mesSetupError("ERROR:\tCould not connect to MESMER run at %s:%i: %s" % (address[0],address[1],e))
+			sleep(1)
+		except AuthenticationError as e:
+			raise mesSetupError("ERROR:\tMESMER run at %s:%i rejected the connection: %s" % (address[0],address[1],e))
+
+	(args,layout) = conn.recv()
+
+	return (conn,args,layout)
+
+def serve_worker( conn, args, layout, plugins, targets, components ):
+	"""
+	Optimize the ensembles sent by a coordinating MESMER run until it closes the connection, see RemoteWorker
+
+	Arguments:
+	conn		- The connection from connect_worker()
+	args		- The run's MESMER argument parameters
+	layout		- The run's work buffer layout, with its target, restraint type and component name tables
+	plugins		- A list of the loaded plugin modules
+	targets		- The run's mesTargets, loaded locally
+	components	- The run's mesComponents, loaded locally
+
+	Returns: None
+	"""
+
+	# the results are copied back into the run's fitness columns as they are, so the worker has to evaluate the same restraint types
+	local = get_component_layout( plugins, targets, components )
+	if( local['targets'] != layout['targets'] ):
+		message = "Worker targets (%s) do not match the run's (%s)" % (", ".join(local['targets']),", ".join(layout['targets']))
+	elif( sorted(local['types']) != sorted(layout['types']) ):
+		message = "Worker restraint types (%s) do not match the run's (%s)" % (", ".join(sorted(local['types'])),", ".join(sorted(layout['types'])))
+	else:
+		message = None
+	if( message is not None ):
+		conn.send( message )
+		raise mesSetupError("ERROR:\t%s." % (message))
+
+	# component indices may differ from the run's if the files were found in a different order
+	missing = [name for name in layout['names'] if name is not None and not name in components]
+	if( len(missing) > 0 ):
+		raise mesComponentError("ERROR:\tComponent \"%s\" used by the MESMER run was not loaded." % (missing[0]))
+	lookup = array( [components[name].index if name is not None else 0 for name in layout['names']], dtype=int32 )
+
+	# plugins may have loaded in a different order than the run's, so the columns follow the run's restraint type order
+	local['types'] = layout['types']
+
+	# the plugin times are sent back with each chunk when the run is profiling
+	profile = None
+	if( args.profile ):
+		profile = mesProfile()
+		profile.wrap_plugins( plugins )
+
+	# the ensembles are optimized in this process, with the same code as the run's local workers
+	worker = Worker( args, plugins, targets, components, None, None, None, None, None, profile )
+
+	# sends are shared with the heartbeat thread
+	lock = Lock()
+	def send( message ):
+		with lock:
+			conn.send( message )
+
+	def beat():
+		try:
+			while( True ):
+				sleep( args.heartbeat )
+				send( 'heartbeat' )
+		except (IOError,EOFError):
+			return
+
+	heartbeat = Thread( target=beat )
+	heartbeat.daemon = True
+	heartbeat.start()
+
+	send( 'ready' )
+
+	while( True ):
+		try:
+			message = conn.recv()
+		except (IOError,EOFError):
+			break
+		if( message is None ):
+			break
+
+		(codes,ratios,optimized,dirty,status,cutoff,seed) = message
+
+		population = mesPopulation( None, None, args.size, len(codes), local )
+		population.components[:] = lookup[codes]
+		population.ratios[:] = ratios
+		population.optimized[:] = optimized
+		population.dirty[:] = dirty
+		population.opt_status[:] = _STATUSES[status]
+
+		ensembles = population.get_ensembles()
+		for (row,(e,optimized)) in enumerate(zip(ensembles,worker.optimize_batch(ensembles, cutoff if cutoff < inf else None, seed))):
+			for i in optimized:
+				status[row,i] = encode_status( e.opt_status[targets[i].name] )
+
+		try:
+			send( (population.ratios,population.fitness,population.optimized,population.dirty,status,worker.abandoned,worker.saved,profile.collect() if profile is not None else None,worker.telemetry) )
+		except (IOError,EOFError):
+			break
+
+		worker.abandoned,worker.saved = 0,0
+		worker.telemetry = []
+
+	conn.close()
+
+	return
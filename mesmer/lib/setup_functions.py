@@ -7,6 +7,7 @@ import multiprocessing
 
 from exceptions				import *
 from utility_functions		import *
+from log_objects			import mesLog
 
 def parse_arguments(args=None,prefs=None):
 	"""Parses the command-line parameters (or those provided in a configuration file)"""
@@ -34,27 +35,42 @@ def parse_arguments(args=None,prefs=None):
 	group0.add_argument('-target',		action='append',	default=[],						metavar='FILE.target',			help='MESMER target file')
 	group0.add_argument('-components',	action='append',	default=[],		nargs='*',		metavar='FILE.component/DIR',	help='MESMER component files or directory ')
 	group0.add_argument('-resume',															metavar='STATE.tbl',			help='Resume from a provided ensemble state')
+	group0.add_argument('-restart',		action='store_true',default=False,									help='Continue the run in the -dir/-name results directory from its last checkpoint, with the same arguments')
 
 	group1 = parser.add_argument_group('Simulation size and convergence parameters')
 	group1.add_argument('-name',		action='store',		default='MESMER_Results',		metavar='NAME',	help='Name of this run - a directory will be created with this name to contain all MESMER output')
 	group1.add_argument('-dir',			action='store',		default='./',					metavar='DIR',	help='Directory in which to create results folder')
 	group1.add_argument('-ensembles',	action='store',		default=1000,	type=int,		metavar='1000',	help='Number of ensembles to use in the algorithm')
 	group1.add_argument('-size',		action='store',		default=3,		type=int,		metavar='3',	help='Number of components per ensemble')
-	group1.add_argument('-Fmin',		action='store',		default=0.00,	type=float,		metavar='0.00',	help='Maximum ensemble fitness to stop algorithm')
+	group1.add_argument('-Fmin',		action='store',		default=0.00,	type=float,		metavar='0.00',	help='Maximum ensemble fitness to stop algorithm, once every ensemble selected for the next generation scores below it')
 	group1.add_argument('-Smin',		action='store',		default=0.00,	type=float,		metavar='0.01',	help='Minimum ensemble fitness stdev to stop algorithm')
+	group1.add_argument('-Gstall',		action='store',		default=0,		type=int,		metavar='0',	help='Number of generations in which neither the best nor the average ensemble fitness improves by Gimprove to stop algorithm (or restart, see Grestarts), 0=never')
+	group1.add_argument('-Gimprove',	action='store',		default=0.001,	type=float,		metavar='0.001',	help='Minimum relative improvement in the best or average ensemble fitness that resets the Gstall count')
+	group1.add_argument('-Gdiversity',	action='store',		default=0.0,	type=float,		metavar='0.0',	help='Minimum fraction of unique ensembles to stop algorithm (or restart, see Grestarts)')
+	group1.add_argument('-Grestarts',	action='store',		default=0,		type=int,		metavar='0',	help='Number of times to replace all but the best distinct ensembles with new random ones instead of stopping on Gstall or Gdiversity. Not available with islands')
 
 	group2 = parser.add_argument_group('Genetic algorithm coefficients')
 	group2.add_argument('-Gmax',		action='store',		default=-1,		type=int,		metavar='Inf',	help='Maximum number of generations, set to -1 to run indefinitely')
+	group2.add_argument('-Gtime',		action='store',		default=0.0,	type=float,		metavar='0',	help='Maximum run time in minutes since the run was (re)started, 0=unlimited')
 	group2.add_argument('-Gcross',		action='store',		default=0.8,	type=float,		metavar='0.8',	help='Ensemble component crossing frequency')
 	group2.add_argument('-Gmutate',		action='store',		default=1.0,	type=float,		metavar='1.0',	help='Ensemble component mutation frequency')
 	group2.add_argument('-Gsource',		action='store',		default=0.1,	type=float,		metavar='0.1',	help='Ensemble component mutation source frequency')
+	group2.add_argument('-islands',		action='store',		default=0,		type=int,		metavar='0',	help='Number of islands (processes) evolving separate sub-populations of the ensembles without waiting for each other, 0=evolve a single population. Gmax then counts the generations of each island')
+	group2.add_argument('-Gmigrate',	action='store',		default=5,		type=int,		metavar='5',	help='Number of island generations between migrations of the best ensembles to the next island')
+	group2.add_argument('-Gmigrants',	action='store',		default=0.05,	type=float,		metavar='0.05',	help='Fraction of each island\'s ensembles that migrate to the next island')
+	group2.add_argument('-Greport',		action='store',		default=1,		type=int,		metavar='1',	help='Number of island migrations between each output generation of the combined island ensembles')
 	group2.add_argument('-Gtolerance',	action='store',		default=0.0,	type=float,		metavar='0.0',	help='Tolerance in ensemble fitness to use during down-selection')
 
 	group3 = parser.add_argument_group('Variable component ratio parameters')
 	group3.add_argument('-Rforce'	,	action='store_true',default=False,									help='Force ensemble ratio reoptimization at every generation.')
-	group3.add_argument('-Ralgorithm',	action='store',		default=3,	type=int,	choices=[0,1,2,3,4,5,6],	metavar='6',	help='Algorithm to use for optimal component ratios (0-6), 0=no ratio optimization. Consult the mesmer docs for more information.')
+	group3.add_argument('-Ralgorithm',	action='store',		default=3,	type=int,	choices=[0,1,2,3,4,5,6,7,8],	metavar='8',	help='Algorithm to use for optimal component ratios (0-8), 0=no ratio optimization, 7=linear least squares, 8=projected gradient descent optimizing many ensembles at once. Consult the mesmer docs for more information.')
 	group3.add_argument('-Rprecision',	action='store',		default=0.01,	type=float,		metavar='0.01',	help='Precision of weighting algorithm')
 	group3.add_argument('-Rn',			action='store',		default=-1,		type=int,		metavar='10*size',	help='Number of weighting algorithm iterations. Defaults to ensemble size x10')
+	group3.add_argument('-Rwarm',		action='store',		default=0.5,	type=float,		metavar='0.5',	help='Fraction of -Rn used to reoptimize ensembles that differ from their optimized parent by a single component, starting from the parent\'s ratios')
+	group3.add_argument('-Rabandon',	action='store',		default=0.0,	type=float,		metavar='0.0',	help='Fraction of the ratio optimization budget after which offspring that still can\'t beat the worst parent are abandoned, 0=always optimize fully')
+	group3.add_argument('-Rmargin',		action='store',		default=0.5,	type=float,		metavar='0.5',	help='Relative margin above the worst parent\'s score that abandoned offspring must still be at, see -Rabandon')
+	group3.add_argument('-titration',	action='store_true',default=False,									help='Treat the targets as a titration series in the order given, starting each target\'s ratio optimization from the previous target\'s optimum')
+	group3.add_argument('-Rcache',		action='store',		default=10000,	type=int,		metavar='10000',	help='Number of optimized component sets to remember and reuse, 0=no caching. Disabled by -Rforce')
 	group3.add_argument('-boots',		action='store',		default=200,	type=int,		metavar='200',	help='The number of bootstrap samples for component weighting error analysis. 0=no error analysis')
 
 	group4 = parser.add_argument_group('Output options')
@@ -63,14 +79,20 @@ def parse_arguments(args=None,prefs=None):
 	group4.add_argument('-Pstate',		action='store_true',default=True,									help='Print ensemble ratio state at each generation')
 	group4.add_argument('-Popt',		action='store_true',default=False,									help='Print optimization convergence status for all ensembles.')
 	group4.add_argument('-Pextra',		action='store_true',default=False,									help='Print extra restraint-specific information.')
+	group4.add_argument('-profile',		action='store_true',default=False,									help='Save the wall and CPU time of each phase of every generation, and of the plugins\' fitness calculations for each restraint type, and summarize them at the end of the run.')
 	group4.add_argument('-Pmin',		action='store',		default=1.0,	type=float,		metavar='1.0',	help='Print conformer statistics only if they exist in this percentage of ensembles or greater.')
 	group4.add_argument('-Pcorr',		action='store',		default=1.0,	type=float,		metavar='1.0',	help='Print conformer correlations only if they exist in this percentage of ensembles or greater.')
 
 	group5 = parser.add_argument_group('Miscellaneous options')
 	group5.add_argument('-seed',		action='store',		default=1,		type=int,		metavar='N',	help='Random number generator seed value to use.')
 	group5.add_argument('-uniform',		action='store_true',default=False,									help='Load ensembles uniformly from available components instead of randomly')
+	group5.add_argument('-checkpoint',	action='store',		default=10,		type=int,		metavar='10',	help='Save a checkpoint of the complete algorithm state every N generations, 0=never')
+	group5.add_argument('-Ctime',		action='store',		default=30.0,	type=float,		metavar='30',	help='Also save a checkpoint if this many minutes have passed since the last one, 0=never')
 	group5.add_argument('-force',		action='store_true',default=False,									help='Enable overwriting of previous output directories.')
 	group5.add_argument('-threads',		action='store',		default=multiprocessing.cpu_count(),		type=int,		metavar='N',	help='Number of multiprocessing threads to use.')
+	group5.add_argument('-listen',		action='store',		default=None,					metavar='HOST:PORT',	help='Accept connections from mesmer-worker processes at this address, which optimize ensembles along with the -threads local processes. The host defaults to 127.0.0.1')
+	group5.add_argument('-authkey',		action='store',		default=None,					metavar='KEY',	help='Shared secret that mesmer-worker processes must provide to connect, required with -listen')
+	group5.add_argument('-heartbeat',	action='store',		default=10.0,	type=float,		metavar='10',	help='Interval in seconds between mesmer-worker heartbeats, work is reassigned after three are missed')
 	group5.add_argument('-scratch',		action='store',		default=None,					metavar='DIR',	help='Scratch directory in which to save temporary files.')
 	group5.add_argument('-plugin',		action='store',										metavar='NAME',	help='Print information about the specified plugin and exit.')
 	group5.add_argument('-reset',		action='store_true',default=False,									help='Reset saved MESMER preferences.')
@@ -93,6 +115,22 @@ def parse_arguments(args=None,prefs=None):
 	# argument error checking and defaults
 	if (ret.Rn < 0):
 		ret.Rn = ret.size * 10
+
+	if (ret.islands > 0) and (ret.ensembles < 2 * ret.islands):
+		parser.error("each island needs at least 2 ensembles")
+
+	if (ret.Gmigrate < 1) or (ret.Greport < 1):
+		parser.error("Gmigrate and Greport must be at least 1")
+
+	if (ret.Grestarts > 0) and (ret.islands > 0):
+		parser.error("Grestarts can't be used with islands")
+
+	if (ret.threads < 1) and not ret.listen:
+		parser.error("at least 1 thread is needed without remote workers")
+
+	# workers exchange pickled data with the run, so only ones that know a secret key may connect
+	if ret.listen and not ret.authkey:
+		parser.error("an -authkey is required with -listen")
 		
 	#if (ret.Gtolerance > ret.Smin):
 	#	print "INFO:\tGtolerance is greater than Smin, setting to Smin."
@@ -100,6 +138,26 @@ def parse_arguments(args=None,prefs=None):
 
 	return ret
 
+def parse_worker_arguments(args=None):
+	"""Parses the command-line parameters of mesmer-worker"""
+
+	parser = argparse.ArgumentParser(description='Optimize ensembles for a MESMER run started with -listen, usually on another host')
+	parser.add_argument('address',											metavar='HOST:PORT',	help='The -listen address of the MESMER run')
+	parser.add_argument('-authkey',		action='store',		default=None,		metavar='KEY',	help='The -authkey of the MESMER run, required')
+	parser.add_argument('-threads',		action='store',		default=multiprocessing.cpu_count(),	type=int,	metavar='N',	help='Number of worker processes to connect.')
+	parser.add_argument('-scratch',		action='store',		default=None,		metavar='DIR',	help='Scratch directory in which to save temporary files.')
+	parser.add_argument('-timeout',		action='store',		default=60,			type=float,	metavar='60',	help='Number of seconds to keep trying to connect for.')
+
+	if args != None:
+		ret = parser.parse_args(args)
+	else:
+		ret = parser.parse_args()
+
+	if not ret.authkey:
+		parser.error("the -authkey of the MESMER run is required")
+
+	return ret
+
 def make_results_dir( args ):
 	"""
 	Creates a directory in which to save MESMER output files, and copies the parameters file into it
@@ -107,6 +165,9 @@ def make_results_dir( args ):
 
 	args.dir = os.path.join( args.dir, args.name)
 
+	if args.restart:
+		return reopen_results_dir( args )
+
 	oWrite = False
 	if args.force and os.path.isdir(args.dir):
 		oWrite = True
@@ -130,15 +191,41 @@ def make_results_dir( args ):
 		raise mesSetupError("ERROR:\tCouldn't open MESMER log file: %s" % e)
 
 	try:
-		db = shelve.open( os.path.join(args.dir,'mesmer_log.db') )
-		db['args'] = args
-		db.close()
+		mesLog.create( args.dir, args )
 	except:
 		raise mesSetupError("ERROR:\tCouldn't open MESMER results database file.")
 
 	if(oWrite):
 		print_msg("INFO:\tOverwriting old result directory \"%s\"." % (args.dir))
 		
+def reopen_results_dir( args ):
+	"""
+	Continues writing to the results directory of a previous run, for -restart
+	"""
+
+	if not os.path.isfile(os.path.join(args.dir,"mesmer_checkpoint.dat")):
+		raise mesSetupError("ERROR:\tNo checkpoint found in MESMER results directory \"%s\"." % (args.dir))
+
+	try:
+		log = mesLog( args.dir )
+		previous = vars(log.get_args())
+	except Exception as e:
+		raise mesSetupError("ERROR:\tCouldn't open MESMER results database file: %s" % e)
+
+	try:
+		print_msg('',os.path.join(args.dir,"mesmer_log.txt"))
+	except Exception as e:
+		raise mesSetupError("ERROR:\tCouldn't open MESMER log file: %s" % e)
+
+	print_msg("INFO:\tRestarting run in result directory \"%s\"." % (args.dir))
+
+	# arguments that don't affect the algorithm may change between restarts
+	for k in sorted(vars(args)):
+		if k in ('restart','force','threads','scratch','dir','name','checkpoint','Ctime'):
+			continue
+		if k in previous and previous[k] != vars(args)[k]:
+			print_msg("WARNING:\tArgument \"-%s\" differs from the original run (%s, was %s)." % (k,vars(args)[k],previous[k]))
+
 def open_user_prefs( mode='w', reset=False ):
 	from . import __version__ as base_version
 	from gui import __version__ as gui_version
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# MESMER - Minimal Ensemble Solutions to Multiple Experimental Restraints
+# Copyright (C) 2017 SteelSnowflake Software LLC
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import sys
+import os
+
+from multiprocessing			import Process
+
+from lib 						import __author__,__version__
+
+from lib.exceptions				import *
+from lib.setup_functions		import parse_worker_arguments,open_user_prefs
+from lib.utility_functions		import print_msg
+from lib.plugin_functions		import load_plugins,unload_plugins
+from lib.target_functions		import load_targets
+from lib.component_functions	import load_components
+from lib.remote_objects			import parse_address,connect_worker,serve_worker
+
+def serve( address, authkey, timeout, plugins, targets, components ):
+	"""Open an additional connection to the MESMER run, and optimize its ensembles until it finishes"""
+
+	try:
+		(conn,args,layout) = connect_worker( address, authkey, timeout )
+		serve_worker( conn, args, layout, plugins, targets, components )
+	except mesError as e:
+		print e.msg
+		sys.exit(1)
+
+def run():
+	print("-"*40)
+	print("MESMER worker v. %s \n(c) %s" % (__version__,__author__))
+	print("-"*40+"\n")
+
+	# get mesmer user preferences
+	try:
+		prefs = open_user_prefs(mode='c')
+	except mesSetupError as e:
+		print "ERROR:\tCannot read or create MESMER preferences file: %s"%(e)
+		sys.exit(1)
+
+	# the run provides its parameters, including the target and component files to load
+	try:
+		worker_args = parse_worker_arguments()
+		address = parse_address( worker_args.address )
+		(conn,args,layout) = connect_worker( address, worker_args.authkey, worker_args.timeout )
+	except mesSetupError as e:
+		print e.msg
+		sys.exit(1)
+
+	print_msg("INFO:\tConnected to MESMER run at %s:%i." % address)
+
+	args.scratch = worker_args.scratch
+
+	# attempt to load available plugin modules
+	plugins = []
+	try:
+		for id,ok,msg,module in load_plugins(prefs['mesmer_base_dir'], 'mesmer', args=args ):
+			if ok:
+				plugins.append( module )
+			else:
+				print("WARNING:\tPlugin \"%s\" failed to load: (%s)."%(id,msg))
+	except mesPluginError as e:
+		print "%s\nPerhaps the MESMER preferences are misconfigured?"%(e)
+
+	# load target restraints by passing off to plugins
+	try:
+		targets = load_targets( args, plugins )
+	except mesTargetError as e:
+		print e.msg
+		sys.exit(1)
+
+	# create component database
+	try:
+		components = load_components( args, plugins, targets )
+	except mesComponentError as e:
+		print e.msg
+		sys.exit(1)
+
+	# the other processes share the loaded components
+	processes = []
+	for i in xrange(worker_args.threads-1):
+		processes.append( Process(target=serve, args=(address, worker_args.authkey, worker_args.timeout, plugins, targets, components)) )
+		processes[-1].start()
+
+	print_msg("INFO:\tOptimizing ensembles with %i processes." % (worker_args.threads))
+
+	try:
+		serve_worker( conn, args, layout, plugins, targets, components )
+	except mesError as e:
+		print e.msg
+		sys.exit(1)
+
+	for p in processes:
+		p.join()
+
+	print_msg("INFO:\tMESMER run finished, exiting.")
+
+	# finished, unload plugins
+	try:
+		unload_plugins( plugins )
+	except mesPluginError as e:
+		print e.msg
+		sys.exit(1)
+
+if( __name__ == "__main__" ):
+	try:
+		run()
+	except KeyboardInterrupt:
+		print_msg( "\nINFO:\tUser forced quit, exiting.\n" )
+		sys.exit(0)
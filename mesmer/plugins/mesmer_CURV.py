@@ -43,6 +43,9 @@ class plugin( mesPluginDB ):
 
 		self._plot_handles = {}
 
+		# the x values each restraint type's dense matrix rows were interpolated onto
+		self._grids = {}
+
 	def showplot(self,id,x,y,yfit,saxs=False):
 
 		try:
@@ -225,13 +228,17 @@ class plugin( mesPluginDB ):
 		# attempt to interpolate the XY values against the target restraint X values
 		try:
 			temp = interpolate.splrep( values[0], values[1] )
-			interpolate.splev( attribute.restraint.data['x'], temp )
+			y = interpolate.splev( attribute.restraint.data['x'], temp )
 		except TypeError:
 			raise mesPluginError("Could not interpolate the component's curve data to the target's. Perhaps the x values are not ordered?")
 
-		# save the spline to the database
+		# save the spline to the database, used only for targets sampled at different x values
 		attribute.data['key'] = self.put(data=temp)
 
+		# save the interpolated curve as a row of the restraint type's dense matrix
+		attribute.data['row'] = self.put_row(attribute.restraint.type, y, attribute.index)
+		self._grids[attribute.restraint.type] = attribute.restraint.data['x']
+
 		return messages
 
 	def load_bootstrap( self, bootstrap, restraint, ensemble_data, target_data ):
@@ -241,11 +248,24 @@ class plugin( mesPluginDB ):
 
 		return []
 
+	def is_dense( self, restraint, target_data ):
+		"""Determine if the attribute curves were interpolated onto this restraint's x values when they were loaded"""
+
+		if( not 'dense' in target_data ):
+			x = self._grids.get(restraint.type, [])
+			target_data['dense'] = (len(x) == len(restraint.data['x'])) and scipy.allclose(x, restraint.data['x'])
+
+		return target_data['dense']
+
 	def calc_fitness( self, restraint, target_data, ensemble_data, attributes, ratios ):
 		assert(len(attributes) == len(ratios))
 
-		# average the attribute data - this is slow due to the lookup penalty each time. Optimize?
-		ensemble_data['y'] = scipy.average([interpolate.splev(restraint.data['x'], self.get(a.data['key'])) for a in attributes],0,ratios)
+		# average the attribute data
+		if( self.is_dense( restraint, target_data ) ):
+			rows = [a.data['row'] for a in attributes]
+			ensemble_data['y'] = scipy.average(self.get_rows(restraint.type)[rows],0,ratios)
+		else:
+			ensemble_data['y'] = scipy.average([interpolate.splev(restraint.data['x'], self.get(a.data['key'])) for a in attributes],0,ratios)
 		ensemble_data['x'] = restraint.data['x']
 
 		# determine the scaling and/or offset coefficients
@@ -295,3 +315,133 @@ class plugin( mesPluginDB ):
 			return tools.get_volatility_ratio( restraint.data['y'], ensemble_data['y'] )
 
 		return tools.get_chisq_reduced( restraint.data['y'], restraint.data['d'], ensemble_data['y'] )
+
+	def calc_fitness_gradient( self, restraint, target_data, ensemble_data, attributes, ratios ):
+		if( target_data['args'].fitness == 'Vr' ):
+			return None
+
+		# the attribute curves, sampled at the restraint's x values
+		if( self.is_dense( restraint, target_data ) ):
+			curves = self.get_rows(restraint.type)[[a.data['row'] for a in attributes]]
+		else:
+			curves = scipy.array([interpolate.splev(restraint.data['x'], self.get(a.data['key'])) for a in attributes])
+
+		y,d2 = scipy.array(restraint.data['y'],dtype=float),scipy.square(scipy.array(restraint.data['d'],dtype=float))
+		n = len(y)
+
+		# derivative of the reduced chisq with respect to the final fitted curve
+		grad = -2.0 * (y - ensemble_data['y']) / (d2 * n)
+
+		# back through the SAXS offset, which is the mean difference over the high-angle points
+		if(target_data['args'].saxs_offset):
+			i = target_data['saxs_offset_n']
+			grad[i:] -= grad.sum() / (n-i)
+
+		# back through the DEER modulation depth, or the scaling and/or offset transforms. The optimal
+		# lambda contributes no gradient of its own (it's at a minimum), but the optimal scale does.
+		f = scipy.average(curves,0,ratios)
+		if(target_data['type'] == 'DEER'):
+			grad *= ensemble_data['lambda']
+		elif(target_data['args'].scale and target_data['args'].offset):
+			f -= f.mean()
+			b = scipy.sum(f * f / d2)
+			scale = ensemble_data['scale']
+			dscale = ((y - y.mean()) - (2.0 * scale * f)) / (d2 * b) if b > 0 else 0.0 * f
+			grad = (scale * grad) + (dscale * scipy.dot(f,grad))
+			grad -= grad.mean()
+		elif(target_data['args'].scale):
+			b = scipy.sum(f * f / d2)
+			scale = ensemble_data['scale']
+			dscale = (y - (2.0 * scale * f)) / (d2 * b) if b > 0 else 0.0 * f
+			grad = (scale * grad) + (dscale * scipy.dot(f,grad))
+		elif(target_data['args'].offset):
+			grad -= grad.mean()
+
+		return list(scipy.dot(curves,grad))
+
+	def calc_fitness_batch( self, restraint, target_data, component_index_matrix, ratio_matrix ):
+		if( not self.is_dense( restraint, target_data ) ):
+			return None
+
+		y,d = scipy.array(restraint.data['y'],dtype=float),scipy.array(restraint.data['d'],dtype=float)
+		n = len(y)
+		d2 = scipy.square(d)
+
+		# average the attribute data for every ensemble
+		y_fit = tools.average_rows( self.get_rows(restraint.type), component_index_matrix, ratio_matrix )
+
+		def divide( a, b ):
+			return a / scipy.where(b == 0, 1.0, b) * (b != 0)
+
+		# the modulation depth fit to DEER data is linear least squares, so no need for brent here
+		if(target_data['type'] == 'DEER'):
+			g = y_fit - 1.0
+			l = divide( ((y - 1.0) * g / d2).sum(1), (g * g / d2).sum(1) )
+			y_fit = 1.0 + (l[:,scipy.newaxis] * g)
+
+		# apply the scaling and/or offset coefficients, see tools.get_curve_transforms() etc.
+		elif(target_data['args'].scale and target_data['args'].offset):
+			mean = y_fit.mean(1)[:,scipy.newaxis]
+			centered = y_fit - mean
+			scale = divide( ((y - y.mean()) * centered / d2).sum(1), (centered * centered / d2).sum(1) )[:,scipy.newaxis]
+			y_fit = (y_fit * scale) + (y.mean() - (mean * scale))
+		elif(target_data['args'].scale):
+			scale = divide( (y * y_fit / d2).sum(1), (y_fit * y_fit / d2).sum(1) )
+			y_fit *= scale[:,scipy.newaxis]
+		elif(target_data['args'].offset):
+			y_fit += ((y.sum() - y_fit.sum(1)) / n)[:,scipy.newaxis]
+
+		# apply additional small SAXS offset if necessary
+		if(target_data['args'].saxs_offset):
+			if( not 'saxs_offset_n' in target_data):
+				for i in range(n):
+					if( restraint.data['x'][i] > target_data['args'].saxs_offset ):
+						target_data['saxs_offset_n'] = i
+						break
+
+			i = target_data['saxs_offset_n']
+			y_fit += ((y[i:].sum() - y_fit[:,i:].sum(1)) / (n-i))[:,scipy.newaxis]
+
+		if( target_data['args'].fitness == 'Vr' ):
+			ratios = y / y_fit
+			ratios /= ratios.sum(1)[:,scipy.newaxis]
+			return scipy.fabs( (ratios[:,:-1] - ratios[:,1:]) / ((ratios[:,:-1] + ratios[:,1:]) / 2.0) ).sum(1)
+
+		return (scipy.square(y - y_fit) / d2).sum(1) / n
+
+	def get_linear_system( self, restraint, target_data, component_indices ):
+		if( target_data['type'] == 'DEER' or target_data['args'].fitness == 'Vr' or not self.is_dense( restraint, target_data ) ):
+			return None
+
+		n = len(restraint.data['y'])
+
+		# an offset fit is the same as comparing mean-centered curves
+		P = scipy.identity(n)
+		if(target_data['args'].offset):
+			P -= 1.0 / n
+
+		weights = 1.0 / scipy.array(restraint.data['d'],dtype=float)[:,scipy.newaxis]
+		system = {
+			'A':			self.get_rows(restraint.type)[component_indices].T,
+			'b':			scipy.array(restraint.data['y'],dtype=float),
+			'P':			weights * P,
+			'scale':		target_data['args'].scale,
+			'norm':			2,
+			'coefficient':	1.0 / n
+			}
+
+		# the SAXS offset removes the mean difference over the high-angle points from every point, after the scale is fit
+		if(target_data['args'].saxs_offset):
+			if( not 'saxs_offset_n' in target_data):
+				for i in range(n):
+					if( restraint.data['x'][i] > target_data['args'].saxs_offset ):
+						target_data['saxs_offset_n'] = i
+						break
+
+			i = target_data['saxs_offset_n']
+			tail = scipy.identity(n)
+			tail[:,i:] -= 1.0 / (n-i)
+			system['Q'] = system['P']
+			system['P'] = weights * scipy.dot(tail, P)
+
+		return system
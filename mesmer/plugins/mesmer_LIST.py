@@ -3,6 +3,8 @@
 import argparse
 import sys
 
+import scipy
+
 from scipy import sqrt,mean,average,array,interpolate
 from scipy.stats import linregress
 
@@ -201,8 +203,8 @@ class plugin( mesPluginDB ):
 		if( len(seen)>0 ):
 			raise mesPluginError( "\n".join(messages) )
 
-		# save the data to the database
-		attribute.data['key'] = self.put(data=temp)
+		# save the data as a row of the restraint type's dense matrix
+		attribute.data['row'] = self.put_row(attribute.restraint.type, temp['y'], attribute.index)
 
 		return messages
 
@@ -216,11 +218,12 @@ class plugin( mesPluginDB ):
 	def calc_fitness( self, restraint, target_data, ensemble_data, attributes, ratios ):
 		assert(len(attributes) == len(ratios))
 
-		# average the attribute data - this is slow due to the lookup penalty each time. Optimize?
-		ensemble_data['y'] = average( [self.get(a.data['key'])['y'] for a in attributes], 0, ratios )
+		# average the attribute data
+		rows = [a.data['row'] for a in attributes]
+		ensemble_data['y'] = average( self.get_rows(restraint.type)[rows], 0, ratios )
 
 		if( restraint.data['args'].fitness=='SSE' ):
-			return get_sse( restraint.data['y'], ensemble_data['y'] )
+			return tools.get_sse( restraint.data['y'], ensemble_data['y'] )
 
 		elif( restraint.data['args'].fitness=='Harmonic' ):
 			n = len(restraint.data['x'])
@@ -240,3 +243,127 @@ class plugin( mesPluginDB ):
 			return 1.0/(r**2)
 		else:
 			return tools.get_chisq_reduced( restraint.data['y'], restraint.data['d'], ensemble_data['y'] )
+
+	def calc_fitness_gradient( self, restraint, target_data, ensemble_data, attributes, ratios ):
+		y,d = array(restraint.data['y']),array(restraint.data['d'])
+		n = len(y)
+		diffs = y - ensemble_data['y']
+
+		# derivative of the fitness with respect to the averaged attribute data
+		if( restraint.data['args'].fitness=='SSE' ):
+			grad = -2.0 * diffs
+
+		elif( restraint.data['args'].fitness=='Harmonic' ):
+			high,low = y+d,y-d
+			grad = 2.0 * ((ensemble_data['y'] - low) * (ensemble_data['y'] < low) + (ensemble_data['y'] - high) * (ensemble_data['y'] > high)) / y
+
+		elif( restraint.data['args'].fitness=='Quality' ):
+			rms = tools.get_rms(diffs)
+			if( rms == 0 ):
+				grad = 0.0 * diffs
+			else:
+				grad = -diffs / (n * rms * restraint.data['rms'])
+
+		elif( restraint.data['args'].fitness=='Rsquared' or len(d) != n ):
+			return None
+
+		else:
+			grad = -2.0 * diffs / (scipy.square(d) * n)
+
+		rows = [a.data['row'] for a in attributes]
+		return list(scipy.dot(self.get_rows(restraint.type)[rows],grad))
+
+	def calc_fitness_batch( self, restraint, target_data, component_index_matrix, ratio_matrix ):
+		y,d = array(restraint.data['y']),array(restraint.data['d'])
+
+		# average the attribute data for every ensemble
+		y_fit = tools.average_rows( self.get_rows(restraint.type), component_index_matrix, ratio_matrix )
+
+		if( restraint.data['args'].fitness=='SSE' ):
+			return scipy.square(y - y_fit).sum(1)
+
+		elif( restraint.data['args'].fitness=='Harmonic' ):
+			# see tools.get_flat_harmonic()
+			high,low = y+d,y-d
+			return ((scipy.square(low - y_fit) * (y_fit < low) + scipy.square(y_fit - high) * (y_fit > high)) / y).sum(1)
+
+		elif( restraint.data['args'].fitness=='Quality' ):
+			if(not 'rms' in restraint.data):
+				restraint.data['rms'] = tools.get_rms(y)
+
+			return sqrt( scipy.square(y - y_fit).mean(1) ) / restraint.data['rms']
+
+		elif( restraint.data['args'].fitness=='Rsquared' ):
+			# the squared correlation coefficient, as from linregress()
+			a = y - y.mean()
+			b = y_fit - y_fit.mean(1)[:,scipy.newaxis]
+			return (a*a).sum() * scipy.square(b).sum(1) / scipy.square((a*b).sum(1))
+
+		# chisq requires an uncertainty for every point
+		if( len(d) != len(y) ):
+			return None
+
+		return scipy.square((y - y_fit) / d).sum(1) / len(y)
+
+	def calc_fitness_gradient_batch( self, restraint, target_data, component_index_matrix, ratio_matrix ):
+		y,d = array(restraint.data['y']),array(restraint.data['d'])
+		n = len(y)
+
+		# see calc_fitness_gradient()
+		rows = self.get_rows(restraint.type)
+		y_fit = tools.average_rows( rows, component_index_matrix, ratio_matrix )
+		diffs = y - y_fit
+
+		if( restraint.data['args'].fitness=='SSE' ):
+			grad = -2.0 * diffs
+
+		elif( restraint.data['args'].fitness=='Harmonic' ):
+			high,low = y+d,y-d
+			grad = 2.0 * ((y_fit - low) * (y_fit < low) + (y_fit - high) * (y_fit > high)) / y
+
+		elif( restraint.data['args'].fitness=='Quality' ):
+			if(not 'rms' in restraint.data):
+				restraint.data['rms'] = tools.get_rms(y)
+
+			rms = sqrt( scipy.square(diffs).mean(1) )[:,scipy.newaxis]
+			grad = -diffs / (n * scipy.where(rms == 0, 1.0, rms) * restraint.data['rms']) * (rms != 0)
+
+		elif( restraint.data['args'].fitness=='Rsquared' or len(d) != n ):
+			return None
+
+		else:
+			grad = -2.0 * diffs / (scipy.square(d) * n)
+
+		return scipy.column_stack( [(rows[component_index_matrix[:,j]] * grad).sum(1) for j in range(component_index_matrix.shape[1])] )
+
+	def get_linear_system( self, restraint, target_data, component_indices ):
+		y,d = array(restraint.data['y']),array(restraint.data['d'])
+		n = len(y)
+
+		system = {
+			'A':			self.get_rows(restraint.type)[component_indices].T,
+			'b':			y,
+			'P':			scipy.identity(n),
+			'scale':		False,
+			'norm':			2,
+			'coefficient':	1.0
+			}
+
+		if( restraint.data['args'].fitness=='SSE' ):
+			return system
+
+		elif( restraint.data['args'].fitness=='Quality' ):
+			if(not 'rms' in restraint.data):
+				restraint.data['rms'] = tools.get_rms(y)
+
+			# the RMS of the residuals is the norm of the residual vector over sqrt(n)
+			system['norm'] = 1
+			system['coefficient'] = 1.0 / (sqrt(n) * restraint.data['rms'])
+			return system
+
+		elif( restraint.data['args'].fitness in ('Harmonic','Rsquared') or len(d) != n ):
+			return None
+
+		system['P'] /= d[:,scipy.newaxis]
+		system['coefficient'] = 1.0 / n
+		return system
@@ -9,6 +9,7 @@ Component file arguments:
 
 import argparse
 import math
+import scipy
 
 from mesmer.lib.exceptions		import *
 from mesmer.lib.plugin_objects	import mesPluginError,mesPluginBasic
@@ -24,6 +25,9 @@ class plugin( mesPluginBasic ):
 		self.info = 'This plugin compares experimental and predicted stoichiometry of the components present in multicomponent mixtures.'
 		self.types = ('STCH','STCH0','STCH1','STCH2','STCH3','STCH4','STCH5','STCH6','STCH7','STCH8','STCH9')
 
+		# component counts of each attribute, by restraint type and then component index
+		self._counts = {}
+
 	def load_restraint( self, restraint, block, target_data ):
 		parser = argparse.ArgumentParser(prog=self.type[0])
 		parser.add_argument('-scale',		default=1.0, type=float, metavar='1.0', help='')
@@ -61,6 +65,9 @@ class plugin( mesPluginBasic ):
 		for component in args.component:
 			attribute.data['components'][component[0]] = float(component[1])
 
+		if( attribute.index != None ):
+			self._counts.setdefault(attribute.restraint.type, {})[attribute.index] = attribute.data['components']
+
 		return []
 
 	def load_bootstrap( self, bootstrap, restraint, ensemble_data, target_data ):
@@ -103,3 +110,23 @@ class plugin( mesPluginBasic ):
 
 		return fitness
 
+	def calc_fitness_batch( self, restraint, target_data, component_index_matrix, ratio_matrix ):
+		names = restraint.data['components'].keys()
+
+		# build the component count matrix (components x names) once all the attributes have been loaded
+		if( not 'counts' in target_data ):
+			counts = self._counts.get(restraint.type, {})
+			target_data['counts'] = scipy.zeros( (max(counts.keys()+[-1])+1,len(names)) )
+			for (index,components) in counts.iteritems():
+				target_data['counts'][index] = [components.get(name,0.0) for name in names]
+
+		# convert component count to ratios
+		fractions = tools.average_rows( target_data['counts'], component_index_matrix, ratio_matrix )
+		sum = fractions.sum(1)[:,scipy.newaxis]
+		fractions /= scipy.where(sum == 0.0, 1.0, sum)
+
+		# see calc_fitness()
+		expected = scipy.array([restraint.data['components'][name] for name in names])
+		present = (fractions > 0)
+		fitness = scipy.fabs( target_data['args'].scale * scipy.log( expected / scipy.where(present, fractions, 1.0) ) )
+		return scipy.where(present, fitness, 1.0).sum(1)
@@ -44,6 +44,7 @@ setup(
 		'console_scripts': [
 			'mesmer = mesmer.mesmer_cli:run',
 			'mesmer-gui = mesmer.mesmer_gui:run',
+			'mesmer-worker = mesmer.mesmer_worker:run',
 			'get_ensemble_stats = mesmer.utilities.get_ensemble_stats:run',
 			'make_attribute_plot = mesmer.utilities.make_attribute_plot:run',
 			'make_attribute_spec = mesmer.utilities.make_attribute_spec:run',
@@ -29,6 +29,127 @@ def tests():
 			],[]
 		)
 
+	def mesmer_lsq( paths, args):
+		return(
+			[
+				os.path.join(paths[0],'mesmer_cli.py'),
+				'-threads',
+				'3',
+				'-dir',
+				paths[2],
+				'-name',
+				'cam_mesmer_lsq',
+				'-target',
+				os.path.join(paths[1],'test_cam_1.target'),
+				'-components',
+				os.path.join(paths[1],'cam_components'),
+				'-size',
+				'3',
+				'-ensembles',
+				'1000',
+				'-Gmax',
+				'3',
+				'-Ralgorithm',
+				'7',
+				'-Pbest',
+				'-Popt'
+			],[]
+		)
+
+	def mesmer_batch( paths, args):
+		return(
+			[
+				os.path.join(paths[0],'mesmer_cli.py'),
+				'-threads',
+				'3',
+				'-dir',
+				paths[2],
+				'-name',
+				'cam_mesmer_batch',
+				'-target',
+				os.path.join(paths[1],'test_cam_1.target'),
+				'-components',
+				os.path.join(paths[1],'cam_components'),
+				'-size',
+				'3',
+				'-ensembles',
+				'1000',
+				'-Gmax',
+				'3',
+				'-Ralgorithm',
+				'8',
+				'-Pbest',
+				'-Popt'
+			],[]
+		)
+
+	def mesmer_remote( paths, args):
+		return(
+			[
+				os.path.join(os.path.dirname(__file__),'scenarios.py'),
+				'remote',
+				paths[0],
+				paths[1],
+				paths[2]
+			],[]
+		)
+
+	def mesmer_restart( paths, args):
+		return(
+			[
+				os.path.join(os.path.dirname(__file__),'scenarios.py'),
+				'restart',
+				paths[0],
+				paths[1],
+				paths[2]
+			],[]
+		)
+
+	def mesmer_log( paths, args):
+		return(
+			[
+				os.path.join(os.path.dirname(__file__),'units.py'),
+				paths[0],
+				'LogTests'
+			],[]
+		)
+
+	def mesmer_ensemble_stats( paths, args):
+		return(
+			[
+				os.path.join(os.path.dirname(__file__),'units.py'),
+				paths[0],
+				'EnsembleStatsTests'
+			],[]
+		)
+
+	def mesmer_convergence( paths, args):
+		return(
+			[
+				os.path.join(os.path.dirname(__file__),'units.py'),
+				paths[0],
+				'ConvergenceTests'
+			],[]
+		)
+
+	def mesmer_optimizer( paths, args):
+		return(
+			[
+				os.path.join(os.path.dirname(__file__),'units.py'),
+				paths[0],
+				'RunTests',
+				paths[1]
+			],[]
+		)
+
 	return [
-		('mesmer',mesmer)
+		('mesmer',mesmer),
+		('mesmer_lsq',mesmer_lsq),
+		('mesmer_batch',mesmer_batch),
+		('mesmer_remote',mesmer_remote),
+		('mesmer_restart',mesmer_restart),
+		('mesmer_log',mesmer_log),
+		('mesmer_ensemble_stats',mesmer_ensemble_stats),
+		('mesmer_convergence',mesmer_convergence),
+		('mesmer_optimizer',mesmer_optimizer)
 	]
\ No newline at end of file
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import shutil
+import socket
+import signal
+import subprocess
+
+"""
+Tests of MESMER features that take more than a single program run, started by the tests in mesmer.py
+
+Usage: scenarios.py SCENARIO EXE_DIR DATA_DIR OUT_DIR
+Exits with a non-zero status if the scenario fails.
+"""
+
+def fail( msg ):
+	print "FAILED:\t%s" % (msg)
+	sys.exit(1)
+
+def start( cmd, log_path ):
+	"""Start a MESMER program in the background, with unbuffered output to a log file"""
+
+	log = open( log_path, 'w' )
+	return subprocess.Popen( [sys.executable,'-u'] + cmd, stdout=log, stderr=subprocess.STDOUT )
+
+def wait( handle, timeout ):
+	"""Wait for a program to exit, killing it if it takes longer than timeout seconds. Returns its exit code, or None if it was killed"""
+
+	began = time.time()
+	while( handle.poll() is None ):
+		if( time.time()-began > timeout ):
+			handle.kill()
+			handle.wait()
+			return None
+		time.sleep(0.5)
+	return handle.returncode
+
+def wait_for_text( path, text, timeout ):
+	"""Wait for text to appear in a log file. Returns True if it did within timeout seconds"""
+
+	began = time.time()
+	while( time.time()-began < timeout ):
+		if( text in open(path).read() ):
+			return True
+		time.sleep(0.5)
+	return False
+
+def free_port():
+	"""Get a local port that isn't in use"""
+
+	s = socket.socket()
+	s.bind( ('127.0.0.1',0) )
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+def mesmer_args( exe_dir, data_dir, out_dir, name ):
+	return [
+		os.path.join(exe_dir,'mesmer_cli.py'),
+		'-dir',
+		out_dir,
+		'-name',
+		name,
+		'-target',
+		os.path.join(data_dir,'test_cam_1.target'),
+		'-components',
+		os.path.join(data_dir,'cam_components'),
+		'-size',
+		'3',
+		'-ensembles',
+		'100'
+	]
+
+def remote( exe_dir, data_dir, out_dir ):
+	"""
+	Run with remote workers on the local host only: a worker with the wrong key has to be rejected, and the chunk held by a worker that stops
+	sending heartbeats has to be optimized by another worker
+	"""
+
+	address = "127.0.0.1:%i" % (free_port())
+	worker = [os.path.join(exe_dir,'mesmer_worker.py'), address, '-threads', '1', '-timeout', '60']
+	logs = [os.path.join(out_dir,"mesmer_remote_%s.txt" % (name)) for name in ('run','rejected','stopped','worker')]
+
+	run = start( mesmer_args(exe_dir,data_dir,out_dir,'cam_mesmer_remote') + ['-threads','0','-listen',address,'-authkey','test','-heartbeat','1','-Gmax','2'], logs[0] )
+	workers = []
+
+	try:
+		if( wait( start(worker + ['-authkey','wrong'], logs[1]), 120 ) in (0,None) ):
+			fail("Worker with the wrong -authkey was not rejected, see %s" % (logs[1]))
+
+		# stop the first worker once it's taking work, without closing its connection
+		workers.append( start(worker + ['-authkey','test'], logs[2]) )
+		if( not wait_for_text( logs[2], "Optimizing ensembles", 300 ) ):
+			fail("Worker did not connect, see %s" % (logs[2]))
+		time.sleep(1)
+		workers[0].send_signal( signal.SIGSTOP )
+
+		workers.append( start(worker + ['-authkey','test'], logs[3]) )
+
+		if( wait( run, 600 ) != 0 ):
+			fail("Run did not finish, see %s" % (logs[0]))
+		if( not "Lost remote worker" in open(logs[0]).read() ):
+			fail("Stopped worker was not noticed, see %s" % (logs[0]))
+		if( wait( workers[1], 60 ) != 0 ):
+			fail("Worker did not finish, see %s" % (logs[3]))
+
+	finally:
+		for handle in [run] + workers:
+			if( handle.poll() is None ):
+				handle.kill()
+				handle.wait()
+
+	return
+
+def restart( exe_dir, data_dir, out_dir ):
+	"""
+	Restart a run twice from the same checkpoint: both have to continue identically, including the random searches of the worker processes,
+	the bootstrap error analysis and restarts with new ensembles
+	"""
+
+	names = ('cam_mesmer_restart','cam_mesmer_restart_copy')
+	options = ['-threads','2','-checkpoint','1','-Ralgorithm','2','-Gstall','1','-Gimprove','0.5','-Grestarts','10','-Pbest','-boots','5','-Pstate']
+	logs = [os.path.join(out_dir,"mesmer_restart_%i.txt" % (i)) for i in xrange(3)]
+
+	if( wait( start(mesmer_args(exe_dir,data_dir,out_dir,names[0]) + options + ['-Gmax','2'], logs[0]), 600 ) != 0 ):
+		fail("Run did not finish, see %s" % (logs[0]))
+
+	shutil.copytree( os.path.join(out_dir,names[0]), os.path.join(out_dir,names[1]) )
+
+	for (name,log) in zip(names,logs[1:]):
+		if( wait( start(mesmer_args(exe_dir,data_dir,out_dir,name) + options + ['-Gmax','4','-restart'], log), 600 ) != 0 ):
+			fail("Restarted run did not finish, see %s" % (log))
+
+	for generation in (3,4):
+		(a,b) = [open(os.path.join(out_dir,name,"ensembles_test_cam_1_%05i.tbl" % (generation))).read() for name in names]
+		if( a != b ):
+			fail("Restarted runs differ in generation %i" % (generation))
+
+	return
+
+if(__name__ == "__main__"):
+	scenarios = {
+		'remote':	remote,
+		'restart':	restart
+	}
+
+	scenarios[sys.argv[1]]( *sys.argv[2:5] )
+	sys.exit(0)
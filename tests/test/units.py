@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import scipy
+import shutil
+import tempfile
+import unittest
+
+"""
+Unit tests of MESMER library functions, started by the tests in mesmer.py
+
+Usage: units.py EXE_DIR TESTCASE [DATA_DIR]
+Exits with a non-zero status if any of the tests fail.
+"""
+
+if(__name__ == "__main__"):
+	# in place of this script's directory, whose mesmer.py would hide the mesmer package from the plugins
+	sys.path[0] = sys.argv[1]
+
+from lib.log_objects			import mesLog,_INDEX_SIZE
+from lib.ensemble_objects		import mesPopulation,copy_ensembles
+from lib.ga_functions_misc		import get_unique_ensembles,get_ensemble_counts,make_ensembles,update_plugin_data
+from lib.ga_functions_stats		import get_component_correlations,get_ratio_errors,check_convergence
+from lib.ga_objects				import Optimizer,_CONVERGED
+from lib.setup_functions		import parse_arguments,open_user_prefs
+from lib.plugin_functions		import load_plugins,unload_plugins
+from lib.target_functions		import load_targets
+from lib.component_functions	import load_components
+
+# the directory of the test targets and components, for the tests that need them
+DATA_DIR = None
+
+class LogTests(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.log = mesLog.create( self.dir, {'name':'test'} )
+
+	def tearDown(self):
+		shutil.rmtree( self.dir )
+
+	def test_append_read(self):
+		for i in xrange(5):
+			self.log.append( {'generation':i} )
+
+		self.assertEqual( len(self.log), 5 )
+		self.assertEqual( self.log.get_args(), {'name':'test'} )
+		self.assertEqual( [r['generation'] for r in self.log.read()], range(5) )
+		self.assertEqual( [r['generation'] for r in self.log.read(1,3)], [1,2] )
+		self.assertEqual( self.log.get(4)['generation'], 4 )
+
+		# a reader opened before the records were written sees them too
+		self.assertEqual( [r['generation'] for r in mesLog(self.dir).read(3)], [3,4] )
+
+	def test_truncate_append(self):
+		for i in xrange(2):
+			self.log.append( {'generation':i} )
+		size = os.path.getsize( self.log.data_path )
+
+		for i in xrange(2,5):
+			self.log.append( {'generation':i} )
+		self.log.read()
+
+		# the records after the truncated ones are discarded, including any already read
+		self.log.truncate( 2 )
+		self.assertEqual( len(self.log), 2 )
+		self.assertEqual( os.path.getsize(self.log.data_path), size )
+
+		for i in xrange(2,4):
+			self.log.append( {'generation':i, 'again':True} )
+
+		self.assertEqual( len(self.log), 4 )
+		self.assertEqual( [(r['generation'],r.get('again',False)) for r in self.log.read()], [(0,False),(1,False),(2,True),(3,True)] )
+		self.assertEqual( [(r['generation'],r.get('again',False)) for r in mesLog(self.dir).read()], [(0,False),(1,False),(2,True),(3,True)] )
+
+		# truncating to beyond the end changes nothing
+		self.log.truncate( 10 )
+		self.assertEqual( len(self.log), 4 )
+
+	def test_unindexed_record(self):
+		for i in xrange(2):
+			self.log.append( {'generation':i} )
+
+		# a record whose writer was killed before it was indexed isn't read
+		f = open( self.log.data_path, 'ab' )
+		f.write( 'partial record' )
+		f.close()
+
+		self.assertEqual( len(self.log), 2 )
+		self.assertEqual( [r['generation'] for r in mesLog(self.dir).read()], [0,1] )
+
+		self.log.append( {'generation':2} )
+		self.assertEqual( [r['generation'] for r in mesLog(self.dir).read()], [0,1,2] )
+
+	def test_partial_index_entry(self):
+		for i in xrange(2):
+			self.log.append( {'generation':i} )
+
+		# an index entry that was only partly written is ignored, and overwritten by the next one
+		f = open( self.log.index_path, 'ab' )
+		f.write( '\0' * (_INDEX_SIZE // 2) )
+		f.close()
+
+		self.assertEqual( len(self.log), 2 )
+		self.assertEqual( [r['generation'] for r in mesLog(self.dir).read()], [0,1] )
+
+		self.log.append( {'generation':2} )
+		self.assertEqual( len(self.log), 3 )
+		self.assertEqual( [r['generation'] for r in mesLog(self.dir).read()], [0,1,2] )
+
+def make_population( sets ):
+	"""Make a population of ensembles of the given component names, without any targets"""
+
+	population = mesPopulation( [], [], len(sets[0]), len(sets) )
+	for (e,names) in zip(population.get_ensembles(),sets):
+		e.component_names = names
+
+	return population.get_ensembles()
+
+# ensembles never contain the same component twice (see mesEnsemble.fill()), but many contain the same components in a different order
+_SETS = [
+	['a','b','c'],
+	['c','b','a'],
+	['a','b','d'],
+	['d','e','f'],
+	['b','a','c'],
+	['f','e','d'],
+	['a','c','e'],
+	['b','d','f'],
+	['a','b','d'],
+	['c','e','a']]
+
+class EnsembleStatsTests(unittest.TestCase):
+
+	def setUp(self):
+		# half of the ensembles are copies in a second population with the same layout, as after selection
+		ensembles = make_population( _SETS )
+		self.ensembles = ensembles[:5] + copy_ensembles( ensembles[5:] )
+
+	def test_unique_ensembles(self):
+		# the quadratic search that get_unique_ensembles() replaced
+		unique = [self.ensembles[0]]
+		for e in self.ensembles:
+			for seen in unique:
+				if( set(seen.component_names) == set(e.component_names) ):
+					break
+			else:
+				unique.append(e)
+
+		self.assertEqual( [list(e.component_names) for e in get_unique_ensembles(self.ensembles)], [list(e.component_names) for e in unique] )
+
+	def test_ensemble_counts(self):
+		counts = get_ensemble_counts( self.ensembles )
+
+		expected = {}
+		for e in self.ensembles:
+			key = frozenset(e.component_names)
+			expected[key] = expected.get(key,0) + 1
+
+		names = self.ensembles[0]._population.layout['names']
+		self.assertEqual( dict([(frozenset([names[code] for code in key]),count) for (key,count) in counts.iteritems()]), expected )
+
+	def test_component_correlations(self):
+		class args:
+			Pcorr = 35.0
+
+		(names,relative,absolute) = get_component_correlations( args, self.ensembles )
+
+		# the loops that the sparse products replaced
+		counts = {}
+		for e in self.ensembles:
+			for name in e.component_names:
+				counts[name] = counts.get(name,0) + 1
+		n = len(self.ensembles)
+		expected = sorted([name for name in counts if float(counts[name])/n*100.0 >= args.Pcorr], key=counts.get, reverse=True)
+
+		self.assertEqual( sorted(names), sorted(expected) )
+		self.assertEqual( [counts[name] for name in names], [counts[name] for name in expected] )
+
+		for (i,a) in enumerate(names):
+			for (j,b) in enumerate(names):
+				(r,s) = (0.0,0.0)
+				for e in self.ensembles:
+					if( a in e.component_names and b in e.component_names ):
+						r += 1.0/counts[b]
+						s += 1.0/n
+				self.assertAlmostEqual( relative[i,j], r )
+				self.assertAlmostEqual( absolute[i,j], s )
+
+class ConvergenceTests(unittest.TestCase):
+
+	def get_stats(self, totals, unique=None):
+		"""Statistics of a generation of ensembles with the given total scores, parents and offspring, see get_best_ensembles()"""
+
+		totals = scipy.sort( scipy.array(totals, dtype=float) )
+		selected = totals[:self.args.ensembles]
+		return {
+		'scores':	scipy.column_stack( (scipy.arange(len(totals)), totals, totals) ),
+		'total':	[selected[0], selected.mean(), selected.std()],
+		'unique':	self.args.ensembles if unique is None else unique
+		}
+
+	def setUp(self):
+		self.args = parse_arguments( ['-target','none','-components','none','-ensembles','4'] )
+
+	def test_fmin(self):
+		# the default Fmin of 0 never stops the run
+		self.assertEqual( check_convergence( self.args, {'started':time.time()}, self.get_stats([0.1,0.2,0.5,0.9,2,3,4,5]), 0 ), (None,False) )
+
+		# the best ensembles scoring below Fmin isn't enough, all of those selected for the next generation have to
+		self.args.Fmin = 1.0
+		self.assertEqual( check_convergence( self.args, {'started':time.time()}, self.get_stats([0.1,0.2,0.5,1.5,2,3,4,5]), 0 ), (None,False) )
+
+		stats = self.get_stats([0.1,0.2,0.5,0.9,2,3,4,5])
+		self.assertEqual( check_convergence( self.args, {'started':time.time()}, stats, 0 ), ("Maximum ensemble score is less than Fmin",False) )
+		self.assertEqual( stats['stop'], "Maximum ensemble score is less than Fmin" )
+
+	def test_stall(self):
+		self.args.Gstall = 2
+		self.args.Gimprove = 0.1
+		reason = "Ensemble scores have not improved by Gimprove in Gstall generations"
+
+		# improvements smaller than Gimprove don't reset the count of stalled generations
+		state = {'started':time.time()}
+		for (totals,expected) in (([1,2,3,4,5,6,7,8],(None,False)), ([1,2,3,4,5,6,7,8],(None,False)), ([0.95,2,3,4,5,6,7,8],(reason,False))):
+			stats = self.get_stats(totals)
+			self.assertEqual( check_convergence( self.args, state, stats, 0 ), expected )
+		self.assertEqual( stats['stop'], reason )
+		self.assertEqual( stats['convergence']['stalled'], 2 )
+
+		# an improvement of either the best or the average score by Gimprove does
+		state = {'started':time.time()}
+		for (totals,stalled) in (([1,2,3,4,5,6,7,8],0), ([1,2,3,4,5,6,7,8],1), ([1,1.5,2,3,5,6,7,8],0), ([0.5,1.5,2,3,5,6,7,8],0), ([0.5,1.5,2,3,5,6,7,8],1)):
+			stats = self.get_stats(totals)
+			self.assertEqual( check_convergence( self.args, state, stats, 0 ), (None,False) )
+			self.assertEqual( stats['convergence']['stalled'], stalled )
+			self.assertFalse( 'stop' in stats )
+
+	def test_diversity(self):
+		self.args.Gdiversity = 0.5
+		self.assertEqual( check_convergence( self.args, {'started':time.time()}, self.get_stats([1,2,3,4,5,6,7,8],2), 0 ), (None,False) )
+
+		stats = self.get_stats([1,2,3,4,5,6,7,8],1)
+		self.assertEqual( check_convergence( self.args, {'started':time.time()}, stats, 0 ), ("Fraction of unique ensembles is less than Gdiversity",False) )
+		self.assertEqual( stats['stop'], "Fraction of unique ensembles is less than Gdiversity" )
+		self.assertEqual( stats['convergence']['unique'], 0.25 )
+
+	def test_time(self):
+		# Gtime is in minutes since the run was started
+		self.args.Gtime = 1.0
+		self.assertEqual( check_convergence( self.args, {'started':time.time()-30}, self.get_stats([1,2,3,4,5,6,7,8]), 0 ), (None,False) )
+
+		stats = self.get_stats([1,2,3,4,5,6,7,8])
+		self.assertEqual( check_convergence( self.args, {'started':time.time()-61}, stats, 0 ), ("Run time has reached Gtime",False) )
+		self.assertEqual( stats['stop'], "Run time has reached Gtime" )
+
+	def test_restarts(self):
+		self.args.Gdiversity = 0.5
+		self.args.Grestarts = 1
+		reason = "Fraction of unique ensembles is less than Gdiversity"
+
+		# the first time the run restarts instead of stopping, and the stall count starts over
+		state = {'started':time.time()}
+		stats = self.get_stats([1,2,3,4,5,6,7,8],1)
+		self.assertEqual( check_convergence( self.args, state, stats, 0 ), (None,True) )
+		self.assertEqual( stats['restart'], reason )
+		self.assertFalse( 'stop' in stats )
+		self.assertEqual( state['restarts'], 1 )
+		self.assertFalse( 'reference' in state )
+
+		# once the restarts are used up it stops
+		stats = self.get_stats([1,2,3,4,5,6,7,8],1)
+		self.assertEqual( check_convergence( self.args, state, stats, 0 ), (reason,False) )
+		self.assertEqual( stats['stop'], reason )
+		self.assertFalse( 'restart' in stats )
+		self.assertEqual( state['restarts'], 1 )
+
+class RunTests(unittest.TestCase):
+	"""Tests of the optimizer and the statistics that use it, with the test data and the installed plugins"""
+
+	def setUp(self):
+		self.optimizer = None
+
+	def tearDown(self):
+		if( self.optimizer is not None ):
+			self.optimizer.close()
+			unload_plugins( self.plugins )
+
+	def start(self, *options):
+		"""Load the test target and components, and start an optimizer, with the given options in addition to the defaults"""
+
+		prefs = open_user_prefs( mode='r' )
+		self.args = parse_arguments( ['-threads','1','-target',os.path.join(DATA_DIR,'test_cam_1.target'),'-components',os.path.join(DATA_DIR,'cam_components'),'-size','3','-ensembles','10'] + list(options), prefs )
+		self.plugins = [module for (id,ok,msg,module) in load_plugins(prefs['mesmer_base_dir'], 'mesmer', args=self.args) if ok]
+		self.targets = load_targets( self.args, self.plugins )
+		self.components = load_components( self.args, self.plugins, self.targets )
+		self.optimizer = Optimizer( self.args, self.plugins, self.targets, self.components )
+
+	def test_cache(self):
+		self.start()
+		ensembles = self.optimizer.optimize( make_ensembles( self.args, self.plugins, self.targets, self.components ), print_status=False )
+		self.assertEqual( self.optimizer.get_cache_stats(), (0,len(ensembles)) )
+		self.optimizer.get_optimization_stats()
+
+		# the same components in another order reuse the converged results, without another optimization
+		converged = [e for e in ensembles if all([e.opt_status[t.name] in _CONVERGED for t in self.targets])]
+		self.assertTrue( len(converged) > 0 )
+
+		repeated = copy_ensembles( converged[:1] )[0]
+		order = range(len(repeated.component_names))[::-1]
+		repeated.component_names = [converged[0].component_names[i] for i in order]
+		for t in self.targets:
+			repeated.optimized[t.name] = False
+			repeated.ratios[t.name] = [1.0/self.args.size] * self.args.size
+
+		self.optimizer.optimize( [repeated], print_status=False )
+		self.assertEqual( self.optimizer.get_cache_stats(), (1,0) )
+		self.assertEqual( len(self.optimizer.get_optimization_stats()), 0 )
+
+		for t in self.targets:
+			self.assertEqual( list(repeated.ratios[t.name]), [converged[0].ratios[t.name][i] for i in order] )
+			self.assertEqual( dict(repeated.fitness[t.name]), dict(converged[0].fitness[t.name]) )
+			# flagged as optimized only where the workers would have, see Worker.optimize_ensemble()
+			self.assertEqual( repeated.optimized[t.name], converged[0].optimized[t.name] )
+
+	def test_ratio_errors(self):
+		# the random search finds different ratios with every fit, so a bootstrap fit written back into the ensemble shows
+		self.start( '-boots', '5', '-Ralgorithm', '2' )
+		ensembles = self.optimizer.optimize( make_ensembles( self.args, self.plugins, self.targets, self.components ), print_status=False )
+
+		# the bootstrap samples are made from the ensemble's plugin data, as for the best ensemble of each generation
+		update_plugin_data( self.components, self.plugins, self.targets, ensembles[0] )
+		before = copy_ensembles( ensembles )
+
+		# the bootstrap fits must not replace the ratios and fitness of the ensemble they estimate the errors of
+		stats = get_ratio_errors( self.args, self.plugins, self.targets, ensembles[:1], self.optimizer )
+		self.assertEqual( len(stats), 1 )
+
+		for t in self.targets:
+			self.assertEqual( list(ensembles[0].ratios[t.name]), list(before[0].ratios[t.name]) )
+			self.assertEqual( dict(ensembles[0].fitness[t.name]), dict(before[0].fitness[t.name]) )
+			self.assertEqual( ensembles[0].opt_status[t.name], before[0].opt_status[t.name] )
+			self.assertEqual( ensembles[0].optimized[t.name], before[0].optimized[t.name] )
+
+if(__name__ == "__main__"):
+	if( len(sys.argv) > 3 ):
+		DATA_DIR = sys.argv[3]
+
+	suite = unittest.TestLoader().loadTestsFromTestCase( globals()[sys.argv[2]] )
+	result = unittest.TextTestRunner( stream=sys.stdout, verbosity=2 ).run( suite )
+	sys.exit( 0 if result.wasSuccessful() else 1 )